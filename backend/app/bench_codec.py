@@ -0,0 +1,78 @@
+import sys
+import os
+import json
+import time
+import random
+from datetime import datetime, timedelta
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from fastapi.encoders import jsonable_encoder
+from app.main import AnalyzeRequest, AnalyzeResponse
+from app.fast_codec import decode_analyze_request, encode_analyze_response
+
+# Benchmarks request decoding and response encoding only (no feature
+# extraction or model calls): Pydantic + default JSON vs msgspec structs.
+LOG_SIZES = [10_000, 50_000, 200_000]
+REPEATS = 5
+
+TYPES = ['upvote_received', 'upvote_sent', 'comment', 'post_created']
+TEXTS = ['Nice!', 'Upvote for upvote!', 'Great discussion, thanks for posting!', 'Wow']
+
+def make_body(n_activities, seed=42):
+    rng = random.Random(seed)
+    now = datetime(2024, 1, 1)
+    karma_log = []
+    for i in range(n_activities):
+        activity_type = rng.choice(TYPES)
+        activity = {
+            'activity_id': f'act_{i}',
+            'type': activity_type,
+            'timestamp': (now - timedelta(minutes=i)).isoformat() + 'Z'
+        }
+        if activity_type in ('comment', 'post_created'):
+            activity['content'] = rng.choice(TEXTS)
+        else:
+            activity['from_user'] = f'usr_{rng.randint(1000, 9999)}'
+            activity['from_user_age_days'] = rng.randint(1, 500)
+        karma_log.append(activity)
+    return json.dumps({'user_id': 'bench_user', 'karma_log': karma_log}).encode()
+
+def make_result(n_suspicious):
+    return {
+        'user_id': 'bench_user',
+        'fraud_score': 0.5,
+        'status': 'flagged',
+        'suspicious_activities': [
+            {'activity_id': f'act_{i}', 'reason': "Spam word 'wow' detected", 'score': 0.3}
+            for i in range(n_suspicious)
+        ]
+    }
+
+def best_of(fn):
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def pydantic_path(body, result):
+    request = AnalyzeRequest(**json.loads(body))
+    request.dict()
+    json.dumps(jsonable_encoder(AnalyzeResponse(**result))).encode()
+
+def fast_path(body, result):
+    decode_analyze_request(body)
+    encode_analyze_response(**result)
+
+def main():
+    print(f'{"activities":>10s} {"pydantic (ms)":>14s} {"msgspec (ms)":>13s} {"speedup":>8s}')
+    for n in LOG_SIZES:
+        body = make_body(n)
+        # Worst case for the response: one explanation per text activity
+        result = make_result(n // 2)
+        slow = best_of(lambda: pydantic_path(body, result))
+        fast = best_of(lambda: fast_path(body, result))
+        print(f'{n:>10d} {slow * 1000:>14.1f} {fast * 1000:>13.1f} {slow / fast:>7.1f}x')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import sys
+import os
+import json
+import socket
+import argparse
+import threading
+import subprocess
+import urllib.request
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# Per-worker memory of `app/serve.py` with models loaded in every worker
+# (--no-preload) versus loaded once in the parent and shared after fork.
+# Linux only: reads /proc/<pid>/smaps_rollup.
+#
+#   python app/bench_memory.py --workers 4
+#
+# unique (USS) is memory only that worker holds and is what each extra
+# worker costs; pss splits shared pages between the processes mapping them.
+
+SAMPLE_REQUEST = {
+    'user_id': 'bench_user',
+    'karma_log': [
+        {'activity_id': 'a1', 'type': 'comment', 'content': 'Great post, thanks for sharing!', 'timestamp': '2024-01-01T00:00:00Z'},
+        {'activity_id': 'a2', 'type': 'post_created', 'content': 'Upvote for upvote!', 'timestamp': '2024-01-01T00:10:00Z'},
+        {'activity_id': 'a3', 'type': 'upvote_received', 'from_user': 'u2', 'from_user_age_days': 3, 'timestamp': '2024-01-01T00:20:00Z'}
+    ]
+}
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def memory_kb(pid: int):
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1])
+    return {
+        'rss': fields.get('Rss', 0),
+        'pss': fields.get('Pss', 0),
+        'unique': fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)
+    }
+
+def post(url, body):
+    request = urllib.request.Request(url, data=json.dumps(body).encode(), headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=60) as response:
+        return response.read()
+
+def measure(workers: int, preload: bool, requests_per_worker: int, startup_timeout: float):
+    port = free_port()
+    cmd = [sys.executable, 'app/serve.py', '--host', '127.0.0.1', '--port', str(port), '--workers', str(workers)]
+    if not preload:
+        cmd.append('--no-preload')
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    timer = threading.Timer(startup_timeout, proc.kill)
+    timer.start()
+    try:
+        info = json.loads(proc.stdout.readline())
+        # Each worker logs this once its models are loaded
+        ready = 0
+        while ready < workers:
+            line = proc.stderr.readline()
+            if not line:
+                raise RuntimeError('server exited during startup')
+            ready += 'Application startup complete' in line
+        timer.cancel()
+        threading.Thread(target=proc.stderr.read, daemon=True).start()
+        base = f'http://127.0.0.1:{port}'
+        for _ in range(requests_per_worker * workers):
+            post(base + '/api/analyze', SAMPLE_REQUEST)
+        rows = [memory_kb(pid) for pid in info['worker_pids']]
+        parent = memory_kb(proc.pid)
+    finally:
+        timer.cancel()
+        proc.terminate()
+        proc.wait(timeout=30)
+    return parent, rows
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare per-worker memory with and without model preloading.')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--requests-per-worker', type=int, default=20)
+    parser.add_argument('--startup-timeout', type=float, default=300)
+    args = parser.parse_args()
+
+    print(f'{"mode":>10s} {"parent rss":>11s} {"worker rss":>11s} {"worker pss":>11s} {"worker uss":>11s} {"total pss":>10s}  (MB, mean per worker)')
+    for preload in (False, True):
+        parent, rows = measure(args.workers, preload, args.requests_per_worker, args.startup_timeout)
+        mean = lambda key: sum(r[key] for r in rows) / len(rows) / 1024
+        total_pss = (parent['pss'] + sum(r['pss'] for r in rows)) / 1024
+        print(f'{"preload" if preload else "per-worker":>10s} {parent["rss"] / 1024:>11.1f} {mean("rss"):>11.1f} '
+              f'{mean("pss"):>11.1f} {mean("unique"):>11.1f} {total_pss:>10.1f}')
+
+if __name__ == '__main__':
+    main()
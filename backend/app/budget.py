@@ -0,0 +1,39 @@
+import time
+from typing import Any, Dict, Optional
+
+
+class TimeBudget:
+    """
+    Per-request time budget for the NLP part of an analysis.
+
+    Structural features are always computed; texts are then scored most
+    recent first, chunk by chunk, until the deadline passes. NLP aggregates
+    are averages over the texts that were scored, and the request is
+    `degraded` when some were not. Per-text results are kept by karma_log
+    position so explanations reuse them instead of scoring texts again.
+    A budget of None never expires (coverage and reuse still apply).
+    """
+    def __init__(self, seconds: Optional[float] = None, chunk_size: int = 256):
+        self.seconds = seconds
+        self.chunk_size = chunk_size
+        self.start = time.monotonic()
+        self.deadline = self.start + seconds if seconds is not None else None
+        self.texts_total = 0
+        self.texts_scored = 0
+        self.nlp_scores: Dict[int, Dict[str, float]] = {}
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    @property
+    def degraded(self) -> bool:
+        return self.texts_scored < self.texts_total
+
+    def coverage(self) -> Dict[str, Any]:
+        return {
+            'texts_total': self.texts_total,
+            'texts_scored': self.texts_scored,
+            'text_coverage': self.texts_scored / self.texts_total if self.texts_total else 1.0,
+            'elapsed_ms': round((time.monotonic() - self.start) * 1000, 1),
+            'budget_ms': round(self.seconds * 1000, 1) if self.seconds is not None else None
+        }
@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class TTLCache:
+    """
+    Small thread-safe LRU cache with per-entry time-to-live.
+    Used for short-lived per-analysis state kept between requests.
+
+    With max_bytes, entries are also bounded by their total size as
+    estimated by sizeof(value); a single value larger than max_bytes is
+    not stored.
+    """
+    def __init__(self, max_entries: int = 1000, ttl_seconds: float = 600.0, max_bytes: Optional[int] = None,
+                 sizeof: Optional[Callable[[Any], int]] = None):
+        if max_bytes is not None and sizeof is None:
+            raise ValueError('max_bytes needs a sizeof function')
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value, size = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.nbytes -= size
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> bool:
+        """Stores value; returns False if it is larger than max_bytes."""
+        size = self.sizeof(value) if self.sizeof is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return False
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[2]
+            self._data[key] = (time.monotonic() + self.ttl_seconds, value, size)
+            self.nbytes += size
+            while len(self._data) > self.max_entries or \
+                    (self.max_bytes is not None and self.nbytes > self.max_bytes):
+                _, (_, _, evicted) = self._data.popitem(last=False)
+                self.nbytes -= evicted
+        return True
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is not None:
+                self.nbytes -= item[2]
+        return item[1] if item is not None else None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
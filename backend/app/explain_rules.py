@@ -0,0 +1,266 @@
+import heapq
+import re
+import numpy as np
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Sequence, Tuple
+from app.karma_log import get_field
+
+# --- Rule definitions ---
+# Each rule is keyed by the feature it checks. Thresholds come from
+# config.json 'suspicious_activity_thresholds'; an entry there may be a plain
+# number (threshold only) or a dict overriding any of the fields below.
+#   op:     '>' or '>='
+#   anchor: which activity the record points at
+#           'first_upvote'   -> first upvote_received (rule skipped if none)
+#           'first_activity' -> first karma_log entry ('unknown' if empty)
+#           None             -> no activity_id
+RULE_SPECS = {
+    'young_upvote_ratio': {'reason': 'Upvote from new account', 'op': '>', 'anchor': 'first_upvote'},
+    'upvote_burst_count': {'reason': 'Unusual burst of karma gain', 'op': '>', 'anchor': 'first_upvote'},
+    'upvote_concentration': {'reason': 'Upvote from bot-like account', 'op': '>', 'anchor': 'first_upvote'},
+    'mutual_upvote_count': {'reason': 'High number of mutual upvotes', 'op': '>=', 'anchor': None},
+    'avg_post_spam_score': {'reason': 'High average post spam score', 'op': '>', 'anchor': None},
+    'post_burst_count': {'reason': 'Burst of posts in short time', 'op': '>', 'anchor': 'first_activity'},
+    'upvote_sent_burst_count': {'reason': 'Burst of upvotes sent in short time', 'op': '>', 'anchor': 'first_activity'},
+    'max_cross_user_copies': {'reason': 'Content copied across other accounts', 'op': '>=', 'anchor': None},
+}
+
+ANCHORS = (None, 'first_upvote', 'first_activity')
+
+# --- Spam/vague word dicts ---
+spam_words = {
+    "upvote pls": 1.0, "pls upvote": 1.0, "follow me": 1.0, "check my profile": 0.9,
+    "dm me": 0.8, "please upvote": 1.0, "click my link": 0.9, "vote me": 1.0,
+    "top post": 0.8, "boost": 0.8, "🔥": 0.4, "💯": 0.4, "wow": 0.3, "lol": 0.2,
+    "this slaps": 0.4, "facts": 0.3, "check out my page": 0.9,
+    "drop an upvote": 1.0, "karma needed": 1.0, "link in bio": 0.9, "upvote for upvote": 1.0,
+    "pls boost me": 0.9, "check this out": 0.8, "need votes": 1.0, "support my post": 0.9,
+    "sub for sub": 1.0, "f4f": 0.9, "like4like": 0.9, "comment4comment": 0.9
+}
+vague_words = {
+    'nice': 0.6, 'cool': 0.6, 'good': 0.6, 'great': 0.6, 'awesome': 0.6, 'fire': 0.6,
+    'insane': 0.5, 'wild': 0.7, 'lit': 0.7, 'banger': 0.7,
+    'amazing': 0.5, 'sick': 0.6, 'dope': 0.7, 'based': 0.6
+}
+
+# --- Status ---
+STATUSES = ('clean', 'flagged', 'banned_recommendation')
+
+def get_status(fraud_score: float, config: Dict[str, Any]) -> str:
+    """
+    Status for a fraud score under config['fraud_score_thresholds']:
+    < clean -> clean, < flagged -> flagged, else banned_recommendation.
+    """
+    thresholds = config['fraud_score_thresholds']
+    if fraud_score < thresholds['clean']:
+        return 'clean'
+    elif fraud_score < thresholds['flagged']:
+        return 'flagged'
+    else:
+        return 'banned_recommendation'
+
+def find_words(text, word_dict):
+    # A word-boundary match always implies a substring match, so the
+    # substring test alone gives the same hits without running a regex per word
+    text_lower = text.lower()
+    return [(word, score) for word, score in word_dict.items() if word in text_lower]
+
+
+class RuleEngine:
+    """
+    Compiled set of threshold rules evaluated over a batch feature matrix.
+    Build once (e.g. at startup) and reuse for every request or batch.
+    """
+    def __init__(self, thresholds: Dict[str, Any]):
+        features, reasons, values, is_ge, anchors = [], [], [], [], []
+        for feat, entry in thresholds.items():
+            spec = dict(RULE_SPECS.get(feat, {'reason': f'High {feat}', 'op': '>', 'anchor': None}))
+            if isinstance(entry, dict):
+                spec.update(entry)
+            else:
+                spec['threshold'] = entry
+            if spec['op'] not in ('>', '>='):
+                raise ValueError(f"Unsupported op '{spec['op']}' for rule '{feat}'")
+            if spec['anchor'] not in ANCHORS:
+                raise ValueError(f"Unsupported anchor '{spec['anchor']}' for rule '{feat}'")
+            features.append(feat)
+            reasons.append(spec['reason'])
+            values.append(float(spec['threshold']))
+            is_ge.append(spec['op'] == '>=')
+            anchors.append(ANCHORS.index(spec['anchor']))
+        self.features = features
+        self.reasons = reasons
+        self.thresholds = np.array(values, dtype=float)
+        self.is_ge = np.array(is_ge, dtype=bool)
+        self.anchors = np.array(anchors, dtype=np.int8)
+        self._column_cache = {}
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> 'RuleEngine':
+        return cls(config['suspicious_activity_thresholds'])
+
+    def matrix(self, feature_dicts: List[Dict[str, Any]]) -> np.ndarray:
+        """
+        (n_users, n_rules) matrix of the rule features, in rule order.
+        Features that were not computed (e.g. NLP features when two-stage
+        scoring skipped NLP) are NaN: the rule is not evaluated and never hits.
+        """
+        return np.array([[f.get(name, np.nan) for name in self.features] for f in feature_dicts],
+                        dtype=float).reshape(-1, len(self.features))
+
+    def not_evaluated(self, features: Dict[str, Any]) -> List[str]:
+        """Rule features missing from a user's feature dict (see matrix)."""
+        return [name for name in self.features if name not in features]
+
+    def _columns(self, feature_names: Sequence[str]) -> np.ndarray:
+        key = tuple(feature_names)
+        cols = self._column_cache.get(key)
+        if cols is None:
+            index = {name: i for i, name in enumerate(feature_names)}
+            missing = [f for f in self.features if f not in index]
+            if missing:
+                raise ValueError(f'Rule features missing from feature matrix: {missing}')
+            cols = np.array([index[f] for f in self.features], dtype=np.intp)
+            self._column_cache[key] = cols
+        return cols
+
+    def evaluate(self, X: np.ndarray, feature_names: Sequence[str]):
+        """
+        Returns (mask, values): boolean (n_users, n_rules) hits and the
+        matching (n_users, n_rules) feature values.
+        """
+        values = np.asarray(X, dtype=float)[:, self._columns(feature_names)]
+        mask = np.where(self.is_ge, values >= self.thresholds, values > self.thresholds)
+        return mask, values
+
+    def explain_batch(self, user_logs: List[Dict[str, Any]], X: np.ndarray,
+                      feature_names: Sequence[str]) -> List[List[Dict[str, Any]]]:
+        """
+        Feature-threshold and single-activity-type explanations for every user.
+        Text-level explanations are added separately by explain_texts.
+        """
+        mask, values = self.evaluate(X, feature_names)
+        # Anchor lookups only matter for users with at least one hit
+        needs_upvote = (mask & (self.anchors == 1)).any(axis=1)
+        results = []
+        for i, user in enumerate(user_logs):
+            karma_log = get_field(user, 'karma_log') or []
+            records = []
+            hits = np.flatnonzero(mask[i])
+            if hits.size:
+                first_upvote = None
+                if needs_upvote[i]:
+                    first_upvote = next((a for a in karma_log if get_field(a, 'type') == 'upvote_received'), None)
+                first_id = get_field(karma_log[0], 'activity_id') if karma_log else 'unknown'
+                for r in hits:
+                    record = {'reason': self.reasons[r], 'score': round(float(values[i, r]), 2)}
+                    anchor = self.anchors[r]
+                    if anchor == 1:
+                        if first_upvote is None:
+                            continue
+                        record = {'activity_id': get_field(first_upvote, 'activity_id'), **record}
+                    elif anchor == 2:
+                        record = {'activity_id': first_id, **record}
+                    records.append(record)
+            # Only one type of activity
+            activity_types = set(get_field(a, 'type') for a in karma_log)
+            if len(activity_types) == 1:
+                only_type = next(iter(activity_types))
+                records.append({
+                    'activity_id': get_field(karma_log[0], 'activity_id'),
+                    'reason': f'Only {only_type} type of activity is suspicious',
+                    'score': 1.0
+                })
+            results.append(records)
+        return results
+
+
+def text_activities(karma_log) -> List[Tuple[int, Optional[str], str]]:
+    """
+    (karma_log position, activity_id, content) of every comment, then every
+    post: all explain_texts reads from a karma_log.
+    """
+    comments = [(i, a) for i, a in enumerate(karma_log) if get_field(a, 'type') == 'comment']
+    posts = [(i, a) for i, a in enumerate(karma_log) if get_field(a, 'type') == 'post_created']
+    return [(i, get_field(a, 'activity_id'), get_field(a, 'content') or '') for i, a in comments + posts]
+
+def iter_text_explanations(texts: Iterable[Tuple[int, Optional[str], str]], nlp_analyzer, spam_threshold: float,
+                           nlp_scores: Optional[Dict[int, Dict[str, float]]] = None) -> Iterator[Dict[str, Any]]:
+    """
+    explain_texts over text_activities() tuples, one record at a time.
+    NLP spam records need nlp_scores or, without them, the analyzer.
+    """
+    for position, activity_id, content in texts:
+        for word, score in find_words(content, spam_words):
+            yield {
+                'activity_id': activity_id,
+                'reason': f"Spam word '{word}' detected",
+                'score': score
+            }
+        for word, score in find_words(content, vague_words):
+            yield {
+                'activity_id': activity_id,
+                'reason': f"Vague word '{word}' detected",
+                'score': score
+            }
+        if nlp_scores is not None:
+            nlp_result = nlp_scores.get(position)
+            if nlp_result is None:
+                continue
+        elif nlp_analyzer is not None:
+            nlp_result = nlp_analyzer.analyze(content)
+        else:
+            continue
+        if nlp_result['spam_score'] > spam_threshold:
+            yield {
+                'activity_id': activity_id,
+                'reason': f"NLP spam score high ({nlp_result['spam_score']:.2f})",
+                'score': round(nlp_result['spam_score'], 2)
+            }
+
+def explain_texts(karma_log, nlp_analyzer, spam_threshold: float,
+                  nlp_scores: Optional[Dict[int, Dict[str, float]]] = None) -> List[Dict[str, Any]]:
+    """
+    Spam/vague word and NLP spam explanations for comments and posts.
+    nlp_scores (karma_log position -> analyze() result, see TimeBudget) are
+    used instead of the analyzer when given; texts missing from it get no
+    NLP explanation. NLP explanations are skipped when no analyzer is given.
+    """
+    if nlp_analyzer is None:
+        nlp_scores = None
+    return list(iter_text_explanations(text_activities(karma_log), nlp_analyzer, spam_threshold, nlp_scores))
+
+
+# --- Bounded output helpers ---
+# Reasons that embed a score (e.g. "NLP spam score high (0.87)") are grouped
+# without the trailing number when aggregating
+_REASON_SCORE_SUFFIX = re.compile(r'\s*\(\d+(?:\.\d+)?\)$')
+
+def reason_key(reason: str) -> str:
+    return _REASON_SCORE_SUFFIX.sub('', reason)
+
+def top_k_activities(suspicious_activities: Iterable[Dict[str, Any]], k: int) -> List[Dict[str, Any]]:
+    """
+    Highest-scoring k entries, in descending score order (stable for ties).
+    Accepts any iterable and keeps only k entries in memory.
+    """
+    return heapq.nlargest(k, suspicious_activities, key=lambda a: a['score'])
+
+def aggregate_activities(suspicious_activities: Iterable[Dict[str, Any]], sample_size: int) -> List[Dict[str, Any]]:
+    """
+    One summary per reason: hit count, max score and a sample of activity ids.
+    Ordered by max score, then count.
+    """
+    groups = {}
+    for a in suspicious_activities:
+        key = reason_key(a['reason'])
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {'reason': key, 'count': 0, 'max_score': a['score'], 'sample_activity_ids': []}
+        group['count'] += 1
+        if a['score'] > group['max_score']:
+            group['max_score'] = a['score']
+        activity_id = a.get('activity_id')
+        if activity_id is not None and len(group['sample_activity_ids']) < sample_size \
+                and activity_id not in group['sample_activity_ids']:
+            group['sample_activity_ids'].append(activity_id)
+    return sorted(groups.values(), key=lambda g: (-g['max_score'], -g['count']))
@@ -0,0 +1,162 @@
+import json
+import hashlib
+import msgspec
+from typing import List, Optional, Dict, Any, Literal, Annotated, AsyncIterator, Tuple
+
+# --- Typed structs mirroring the Pydantic request models in app.main ---
+# Unknown fields are ignored, as with the Pydantic models. The feature
+# extractor and rule engine read these structs directly (no dict round-trip).
+class KarmaActivityStruct(msgspec.Struct):
+    activity_id: str
+    type: str
+    timestamp: str
+    content: Optional[str] = None
+    from_user: Optional[str] = None
+    from_user_age_days: Optional[int] = None
+    source: Optional[str] = None
+    post_id: Optional[str] = None
+
+class ExplainOptionsStruct(msgspec.Struct):
+    mode: Literal['full', 'top_k', 'aggregate', 'deferred'] = 'full'
+    top_k: Optional[Annotated[int, msgspec.Meta(ge=1)]] = None
+    sample_size: Optional[Annotated[int, msgspec.Meta(ge=0)]] = None
+
+class AnalyzeRequestStruct(msgspec.Struct):
+    user_id: str
+    karma_log: List[KarmaActivityStruct]
+    explain: Optional[ExplainOptionsStruct] = None
+
+# strict=False gives the same lax str->int coercion Pydantic applies
+_request_decoder = msgspec.json.Decoder(AnalyzeRequestStruct, strict=False)
+_encoder = msgspec.json.Encoder()
+
+
+class RequestDecodeError(Exception):
+    """
+    Raised when the fast decoder rejects a body. `errors` is in the same
+    shape FastAPI reports for request validation failures.
+    """
+    def __init__(self, errors: List[Dict[str, Any]]):
+        super().__init__(errors)
+        self.errors = errors
+
+
+def decode_analyze_request(body: bytes, fallback_model=None):
+    """
+    Decodes a raw /api/analyze body into an AnalyzeRequestStruct.
+
+    On failure the body is re-validated with `fallback_model` (the Pydantic
+    AnalyzeRequest) so error payloads stay identical to the regular path; if
+    Pydantic accepts a body msgspec rejected, the Pydantic instance is returned.
+    """
+    try:
+        return _request_decoder.decode(body)
+    except msgspec.DecodeError:
+        pass
+    if not body:
+        # FastAPI reports a missing body, not a JSON error, for an empty one
+        raise RequestDecodeError([{'type': 'missing', 'loc': ('body',), 'msg': 'Field required', 'input': None}])
+    try:
+        payload = json.loads(body)
+    except json.JSONDecodeError as e:
+        raise RequestDecodeError([{
+            'type': 'json_invalid',
+            'loc': ('body', e.pos),
+            'msg': 'JSON decode error',
+            'input': {},
+            'ctx': {'error': e.msg}
+        }])
+    if fallback_model is None:
+        raise RequestDecodeError([{'type': 'value_error', 'loc': ('body',), 'msg': 'Invalid request body'}])
+    from pydantic import ValidationError
+    try:
+        return fallback_model.model_validate(payload, from_attributes=True)
+    except ValidationError as e:
+        raise RequestDecodeError([{**err, 'loc': ('body', *err['loc'])} for err in e.errors(include_url=False)])
+
+
+async def ndjson_lines(chunks: AsyncIterator[bytes], max_line_bytes: int) -> AsyncIterator[Tuple[int, Optional[bytes]]]:
+    """
+    (line_number, line) for each non-blank line of a chunked NDJSON body,
+    numbered from 1. At most one partial line is buffered; a line longer
+    than max_line_bytes is skipped and reported as (line_number, None).
+    """
+    buffer = bytearray()
+    line_number = 0
+    oversized = False
+    async for chunk in chunks:
+        start = 0
+        while True:
+            end = chunk.find(b'\n', start)
+            if end < 0:
+                if not oversized:
+                    buffer += chunk[start:]
+                    if len(buffer) > max_line_bytes:
+                        oversized = True
+                        buffer.clear()
+                break
+            line_number += 1
+            if oversized:
+                oversized = False
+                yield line_number, None
+            else:
+                buffer += chunk[start:end]
+                if len(buffer) > max_line_bytes:
+                    yield line_number, None
+                elif buffer.strip():
+                    yield line_number, bytes(buffer)
+            buffer.clear()
+            start = end + 1
+    if oversized:
+        yield line_number + 1, None
+    elif buffer.strip():
+        yield line_number + 1, bytes(buffer)
+
+
+def request_digest(user, *salt: str) -> str:
+    """
+    Canonical hash of an analyze request (struct, or the plain dict of the
+    Pydantic model) plus salt strings. Both decode paths give the same digest
+    for the same request, whatever the key order or whitespace of the body.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    if not isinstance(user, AnalyzeRequestStruct):
+        try:
+            user = msgspec.convert(user, AnalyzeRequestStruct, strict=False)
+        except msgspec.ValidationError:
+            # Accepted by Pydantic only; still canonical, just slower
+            h.update(json.dumps(user, sort_keys=True, default=str).encode())
+            user = None
+    if user is not None:
+        h.update(_encoder.encode(user))
+    for part in salt:
+        h.update(b'\0' + part.encode())
+    return h.hexdigest()
+
+
+def encode_analyze_response(user_id: str, fraud_score: float, status: str,
+                            suspicious_activities: List[Dict[str, Any]],
+                            total_suspicious: Optional[int] = None,
+                            suspicious_summary: Optional[List[Dict[str, Any]]] = None,
+                            cursor: Optional[str] = None, degraded: bool = False,
+                            coverage: Optional[Dict[str, Any]] = None, analysis_id: Optional[str] = None,
+                            rules_not_evaluated: Optional[List[str]] = None) -> bytes:
+    """
+    JSON body with the same fields and key order as AnalyzeResponse.
+    """
+    return _encoder.encode({
+        'user_id': user_id,
+        'fraud_score': fraud_score,
+        'suspicious_activities': [
+            {'activity_id': a.get('activity_id'), 'reason': a['reason'], 'score': float(a['score'])}
+            for a in suspicious_activities
+        ],
+        'status': status,
+        'total_suspicious': total_suspicious,
+        'suspicious_summary': suspicious_summary,
+        'cursor': cursor,
+        'degraded': degraded,
+        'coverage': coverage,
+        'analysis_id': analysis_id,
+        'rules_not_evaluated': rules_not_evaluated
+    })
@@ -1,154 +1,427 @@
 import numpy as np
-from typing import List, Dict, Any
-from collections import Counter
-import re
-from datetime import datetime
+import json
+import os
+from typing import Any, Callable, Dict, List, Sequence
 from app.nlp_utils import ContentNLPAnalyzer
+from app.vector_index import ContentIndex
+from app.budget import TimeBudget
+from app.sketches import SKETCH_FEATURES, UserSketch
+from app.karma_log import KarmaLog, MISSING_USER, US_PER_SECOND, get_field, parse_timestamp
 
-# Helper to robustly parse ISO timestamps
-def parse_timestamp(ts: str) -> datetime:
-    try:
-        # Remove 'Z' if present
-        if ts.endswith('Z'):
-            ts = ts[:-1]
-        return datetime.fromisoformat(ts)
-    except Exception:
-        return datetime.now()  # fallback, should log in production
+CONFIG_PATH = 'app/config.json'
+
+def load_settings() -> Dict[str, Any]:
+    if os.path.exists(CONFIG_PATH):
+        with open(CONFIG_PATH) as f:
+            return json.load(f)
+    return {}
+
+settings = load_settings()
 
 # Initialize the NLP analyzer (load models if available)
-nlp_analyzer = ContentNLPAnalyzer(
-    spam_model_path='model/spam_clf.pkl',
-    loweffort_model_path='model/loweffort_clf.pkl'
-)
+nlp_analyzer = ContentNLPAnalyzer.from_config(settings)
+
+BURST_GAP_US = 3600 * US_PER_SECOND  # <1hr between consecutive events
+
+# --- Windowed burst features ---
+# For each activity type and window size: the most events of that type that
+# fall inside any window of that length, e.g. 'upvote_max_in_600s'.
+BURST_WINDOW_PREFIXES = {
+    'upvote_received': 'upvote',
+    'comment': 'comment',
+    'post_created': 'post',
+    'upvote_sent': 'upvote_sent',
+}
+DEFAULT_BURST_WINDOWS_SECONDS = [600, 3600, 86400]
+burst_windows_seconds = list(settings.get('feature_settings', {}).get('burst_windows_seconds', DEFAULT_BURST_WINDOWS_SECONDS))
+
+# --- Cross-user near-duplicate content index (optional) ---
+content_index_settings = settings.get('content_index', {})
+content_index = ContentIndex.from_config(content_index_settings, dim=nlp_analyzer.dim) \
+    if content_index_settings.get('enabled', False) else None
+
+def burst_window_feature_names(windows: Sequence[int] = None) -> List[str]:
+    windows = burst_windows_seconds if windows is None else windows
+    return [f'{prefix}_max_in_{w}s' for prefix in BURST_WINDOW_PREFIXES.values() for w in windows]
+
+def _burst_count(times_sorted: np.ndarray) -> int:
+    return int(np.count_nonzero(np.diff(times_sorted) < BURST_GAP_US))
+
+def max_events_in_window(times_sorted: np.ndarray, window_seconds: float) -> int:
+    """
+    Largest number of events inside any half-open window [t, t + window)
+    starting at an event. One searchsorted pass over sorted timestamps.
+    """
+    if len(times_sorted) == 0:
+        return 0
+    ends = np.searchsorted(times_sorted, times_sorted + int(window_seconds * US_PER_SECOND), side='left')
+    return int((ends - np.arange(len(times_sorted))).max())
+
+def burst_window_features(log: KarmaLog, windows: Sequence[int] = None,
+                          times_by_type: Dict[str, np.ndarray] = None) -> Dict[str, int]:
+    windows = burst_windows_seconds if windows is None else windows
+    features = {}
+    for activity_type, prefix in BURST_WINDOW_PREFIXES.items():
+        times_sorted = times_by_type[activity_type] if times_by_type else log.sorted_times(activity_type)
+        for w in windows:
+            features[f'{prefix}_max_in_{w}s'] = max_events_in_window(times_sorted, w)
+    return features
+
+def score_texts(analyzer: ContentNLPAnalyzer, log: KarmaLog, activity_type: str,
+                need_embeddings: bool, budget: TimeBudget = None, cache: Dict[int, Dict[str, float]] = None):
+    """
+    NLP results (and embeddings) for the texts of one activity type. With a
+    budget, texts go most recent first in chunks and scoring stops once the
+    budget expires, so results may cover only part of the texts.
+    With a cache (karma_log position -> analyze() result) and no budget, only
+    texts missing from it are scored and then added; it is not used when
+    embeddings are needed (content index), as it holds none.
+    """
+    if budget is None and cache is not None and not need_embeddings:
+        positions = log.positions(activity_type).tolist()
+        missing = [i for i in positions if i not in cache]
+        if missing:
+            results, _ = analyzer.analyze_batch([log.contents[i] for i in missing], need_embeddings=False)
+            cache.update(zip(missing, results))
+        return [cache[i] for i in positions], None
+    if budget is None:
+        return analyzer.analyze_batch(log.texts(activity_type), need_embeddings=need_embeddings)
+    positions = log.positions(activity_type)
+    order = positions[np.argsort(-log.timestamps[positions], kind='stable')]
+    budget.texts_total += len(order)
+    results, embeddings = [], []
+    for start in range(0, len(order), budget.chunk_size):
+        if budget.expired():
+            break
+        chunk = order[start:start + budget.chunk_size]
+        chunk_results, chunk_embeddings = analyzer.analyze_batch([log.contents[i] for i in chunk],
+                                                                 need_embeddings=need_embeddings)
+        budget.nlp_scores.update(zip(chunk.tolist(), chunk_results))
+        results += chunk_results
+        embeddings.append(chunk_embeddings)
+    budget.texts_scored += len(results)
+    if not need_embeddings:
+        return results, None
+    return results, np.vstack(embeddings) if embeddings else np.zeros((0, analyzer.dim), dtype=np.float32)
+
+# --- Feature registry ---
+# Every feature declares the intermediates it reads and a relative cost, so a
+# caller asking for a subset (the model's feature_names plus the rule
+# features) computes only that subset and the intermediates behind it.
+# Intermediates are computed once per FeatureContext and shared by all the
+# features reading them. Costs are rough relative units: 1 for a count, 5 for
+# a pass over one activity type, 10 for a sort or unique, 1000 for running
+# the NLP models over one activity type's texts.
+INTERMEDIATES: Dict[str, Dict[str, Any]] = {}
+FEATURES: Dict[str, Dict[str, Any]] = {}
+
+def intermediate(name: str, inputs: Sequence[str] = (), cost: float = 1):
+    def register(fn: Callable[['FeatureContext'], Any]):
+        INTERMEDIATES[name] = {'fn': fn, 'inputs': tuple(inputs), 'cost': cost}
+        return fn
+    return register
+
+def feature(name: str, inputs: Sequence[str] = (), cost: float = 1):
+    def register(fn: Callable[['FeatureContext'], Any]):
+        FEATURES[name] = {'fn': fn, 'inputs': tuple(inputs), 'cost': cost}
+        return fn
+    return register
+
+def _mean(values) -> float:
+    return np.mean(values) if len(values) else 0.0
 
-def extract_features(user_log: Dict[str, Any]) -> Dict[str, Any]:
+
+class FeatureContext:
+    """
+    Lazily computed features of one user. compute() can be called several
+    times (e.g. structural features first, NLP features only if needed);
+    intermediates and features already computed are reused.
+    analyzer defaults to the module's nlp_analyzer; with update_index=False the
+    content index is queried but this user's texts are not added to it.
+    With a budget, NLP averages cover the texts scored in time (see TimeBudget).
+    With a sketch, the SKETCH_FEATURES are its estimates over the user's whole
+    history instead of exact values over user_log (see app.sketches).
+    With an nlp_cache, texts already scored are not scored again (see score_texts).
+    """
+    def __init__(self, user_log: Dict[str, Any], analyzer: ContentNLPAnalyzer = None,
+                 update_index: bool = True, budget: TimeBudget = None, sketch: UserSketch = None,
+                 nlp_cache: Dict[int, Dict[str, float]] = None):
+        self.analyzer = nlp_analyzer if analyzer is None else analyzer
+        self.sketch = sketch
+        self.nlp_cache = nlp_cache
+        self.update_index = update_index
+        self.budget = budget
+        karma_log = get_field(user_log, 'karma_log', [])
+        self.user_id = get_field(user_log, 'user_id', '')
+        self.account_age_days = get_field(user_log, 'account_age_days', 10)
+        self.log = karma_log if isinstance(karma_log, KarmaLog) else KarmaLog.from_activities(karma_log)
+        # A hot-swapped analyzer with another projection size cannot share the index
+        self.use_index = content_index is not None and self.analyzer.dim == content_index.dim
+        self._intermediates: Dict[str, Any] = {}
+        self._features: Dict[str, Any] = {}
+
+    def get(self, name: str):
+        if name not in self._intermediates:
+            self._intermediates[name] = INTERMEDIATES[name]['fn'](self)
+        return self._intermediates[name]
+
+    def compute(self, names: Sequence[str]) -> Dict[str, Any]:
+        if self.sketch is not None and any(name in SKETCH_FEATURES for name in names):
+            for name, value in self.sketch.features().items():
+                self._features.setdefault(name, value)
+        for name in names:
+            if name not in self._features:
+                self._features[name] = FEATURES[name]['fn'](self)
+        return {'user_id': self.user_id, **{name: self._features[name] for name in names}}
+
+# --- Intermediates ---
+for _activity_type in BURST_WINDOW_PREFIXES:
+    intermediate(f'times:{_activity_type}', cost=10)(
+        lambda ctx, t=_activity_type: ctx.log.sorted_times(t))
+
+@intermediate('upvote_idx')
+def _upvote_idx(ctx):
+    return ctx.log.positions('upvote_received')
+
+@intermediate('upvote_from_users', inputs=('upvote_idx',))
+def _upvote_from_users(ctx):
+    return ctx.log.from_users[ctx.get('upvote_idx')]
+
+@intermediate('upvote_counts', inputs=('upvote_from_users',), cost=10)
+def _upvote_counts(ctx):
+    return np.unique(ctx.get('upvote_from_users'), return_counts=True)[1]
+
+@intermediate('upvote_gaps', inputs=('times:upvote_received',))
+def _upvote_gaps(ctx):
+    return np.diff(ctx.get('times:upvote_received')) / US_PER_SECOND
+
+@intermediate('comment_lengths', cost=5)
+def _comment_lengths(ctx):
+    return [len(text) for text in ctx.log.texts('comment')]
+
+@intermediate('sent_targets', cost=5)
+def _sent_targets(ctx):
+    targets = ctx.log.to_users[ctx.log.positions('upvote_sent')]
+    return targets[targets != MISSING_USER]
+
+@intermediate('comment_nlp', cost=1000)
+def _comment_nlp(ctx):
+    return score_texts(ctx.analyzer, ctx.log, 'comment', ctx.use_index, ctx.budget, ctx.nlp_cache)
+
+@intermediate('post_nlp', cost=1000)
+def _post_nlp(ctx):
+    return score_texts(ctx.analyzer, ctx.log, 'post_created', ctx.use_index, ctx.budget, ctx.nlp_cache)
+
+# --- Features, in feature-vector order ---
+@feature('account_age_days')
+def _account_age_days(ctx):
+    return ctx.account_age_days
+
+@feature('total_comments')
+def _total_comments(ctx):
+    return ctx.log.count('comment')
+
+@feature('total_upvotes', inputs=('upvote_idx',))
+def _total_upvotes(ctx):
+    return len(ctx.get('upvote_idx'))
+
+@feature('repeated_upvotes', inputs=('upvote_counts',))
+def _repeated_upvotes(ctx):
+    return int(np.count_nonzero(ctx.get('upvote_counts') > 1))
+
+@feature('upvote_concentration', inputs=('upvote_idx', 'upvote_counts'))
+def _upvote_concentration(ctx):
+    upvote_count = len(ctx.get('upvote_idx'))
+    if upvote_count <= 1:
+        return 0.0
+    return ctx.get('upvote_counts').max() / upvote_count
+
+@feature('unique_upvoters_ratio', inputs=('upvote_idx', 'upvote_counts'))
+def _unique_upvoters_ratio(ctx):
+    upvote_count = len(ctx.get('upvote_idx'))
+    if upvote_count <= 1:
+        return 0.0
+    return len(ctx.get('upvote_counts')) / upvote_count
+
+@feature('young_upvote_ratio', inputs=('upvote_idx',), cost=5)
+def _young_upvote_ratio(ctx):
+    upvote_idx = ctx.get('upvote_idx')
+    # NaN ages (missing) never count as young
+    return int(np.count_nonzero(ctx.log.from_ages[upvote_idx] <= 7)) / len(upvote_idx) if len(upvote_idx) else 0.0
+
+@feature('avg_upvote_gap', inputs=('upvote_gaps',))
+def _avg_upvote_gap(ctx):
+    return _mean(ctx.get('upvote_gaps'))
+
+@feature('min_upvote_gap', inputs=('upvote_gaps',))
+def _min_upvote_gap(ctx):
+    gaps = ctx.get('upvote_gaps')
+    return np.min(gaps) if len(gaps) else 0.0
+
+@feature('upvote_burst_count', inputs=('times:upvote_received',))
+def _upvote_burst_count(ctx):
+    return _burst_count(ctx.get('times:upvote_received'))
+
+@feature('avg_spam_score', inputs=('comment_nlp',))
+def _avg_spam_score(ctx):
+    return _mean([f['spam_score'] for f in ctx.get('comment_nlp')[0]])
+
+@feature('avg_low_effort', inputs=('comment_nlp',))
+def _avg_low_effort(ctx):
+    return _mean([f['low_effort_score'] for f in ctx.get('comment_nlp')[0]])
+
+@feature('comment_to_upvote_ratio', inputs=('upvote_idx',))
+def _comment_to_upvote_ratio(ctx):
+    return ctx.log.count('comment') / max(1, len(ctx.get('upvote_idx')))
+
+@feature('avg_comment_length', inputs=('comment_lengths',))
+def _avg_comment_length(ctx):
+    return _mean(ctx.get('comment_lengths'))
+
+@feature('median_comment_length', inputs=('comment_lengths',), cost=5)
+def _median_comment_length(ctx):
+    lengths = ctx.get('comment_lengths')
+    return float(np.median(lengths)) if lengths else 0.0
+
+@feature('comment_burst_count', inputs=('times:comment',))
+def _comment_burst_count(ctx):
+    return _burst_count(ctx.get('times:comment'))
+
+@feature('total_posts')
+def _total_posts(ctx):
+    return ctx.log.count('post_created')
+
+@feature('post_burst_count', inputs=('times:post_created',))
+def _post_burst_count(ctx):
+    return _burst_count(ctx.get('times:post_created'))
+
+@feature('avg_post_spam_score', inputs=('post_nlp',))
+def _avg_post_spam_score(ctx):
+    return _mean([f['spam_score'] for f in ctx.get('post_nlp')[0]])
+
+@feature('total_upvotes_sent')
+def _total_upvotes_sent(ctx):
+    return ctx.log.count('upvote_sent')
+
+@feature('unique_upvote_targets', inputs=('sent_targets',), cost=10)
+def _unique_upvote_targets(ctx):
+    return len(np.unique(ctx.get('sent_targets')))
+
+@feature('upvote_sent_burst_count', inputs=('times:upvote_sent',))
+def _upvote_sent_burst_count(ctx):
+    return _burst_count(ctx.get('times:upvote_sent'))
+
+@feature('mutual_upvote_count', inputs=('upvote_from_users', 'sent_targets'), cost=10)
+def _mutual_upvote_count(ctx):
+    # Users who both sent and received upvotes with this user
+    upvote_from_users = ctx.get('upvote_from_users')
+    upvote_from_present = upvote_from_users[upvote_from_users != MISSING_USER]
+    return len(np.intersect1d(upvote_from_present, ctx.get('sent_targets')))
+
+for _activity_type, _prefix in BURST_WINDOW_PREFIXES.items():
+    for _w in burst_windows_seconds:
+        feature(f'{_prefix}_max_in_{_w}s', inputs=(f'times:{_activity_type}',), cost=5)(
+            lambda ctx, t=_activity_type, w=_w: max_events_in_window(ctx.get(f'times:{t}'), w))
+
+@feature('max_cross_user_copies', inputs=('comment_nlp', 'post_nlp'), cost=2000)
+def _max_cross_user_copies(ctx):
+    # Most other accounts sharing any one of this user's texts; 0 without the index
+    if not ctx.use_index:
+        return 0
+    embeddings = np.vstack([ctx.get('comment_nlp')[1], ctx.get('post_nlp')[1]])
+    copies = content_index.query(embeddings, exclude_user=ctx.user_id)
+    if ctx.update_index:
+        content_index.add(embeddings, ctx.user_id)
+    return int(copies.max()) if len(copies) else 0
+
+def _closure(names: Sequence[str]) -> set:
+    # The features' intermediates and everything those depend on
+    pending = [i for name in names for i in FEATURES[name]['inputs']]
+    seen = set()
+    while pending:
+        name = pending.pop()
+        if name not in seen:
+            seen.add(name)
+            pending.extend(INTERMEDIATES[name]['inputs'])
+    return seen
+
+# Features that need the NLP models (embeddings / text classifiers)
+NLP_INTERMEDIATES = {'comment_nlp', 'post_nlp'}
+NLP_FEATURES = [name for name in FEATURES if _closure([name]) & NLP_INTERMEDIATES]
+
+def default_feature_names(include_nlp: bool = True, use_index: bool = None) -> List[str]:
+    """
+    Every registered feature, in feature-vector order. max_cross_user_copies
+    is only included when the content index is in use.
+    """
+    use_index = content_index is not None if use_index is None else use_index
+    names = [name for name in FEATURES if include_nlp or name not in NLP_FEATURES]
+    if not use_index:
+        names = [name for name in names if name != 'max_cross_user_copies']
+    return names
+
+def required_features(*name_lists: Sequence[str]) -> List[str]:
+    """
+    Registered features named in any of the lists, in feature-vector order
+    (e.g. a model's feature_names and the rule features). Raises KeyError for
+    names no feature provides.
+    """
+    wanted = set(name for names in name_lists for name in names)
+    unknown = wanted - set(FEATURES)
+    if unknown:
+        raise KeyError(f'Unknown features: {sorted(unknown)}')
+    return [name for name in FEATURES if name in wanted]
+
+def feature_cost(names: Sequence[str]) -> float:
+    """
+    Relative cost of computing `names` together, each shared intermediate
+    counted once.
+    """
+    names = set(names)
+    return sum(FEATURES[name]['cost'] for name in names) + \
+        sum(INTERMEDIATES[name]['cost'] for name in _closure(names))
+
+def shared_intermediates(names: Sequence[str]) -> Dict[str, List[str]]:
+    """
+    For each intermediate needed by more than one of `names`, the features
+    among them that need it, in feature-vector order.
+    """
+    users = {}
+    for name in required_features(names):
+        for intermediate in _closure([name]):
+            users.setdefault(intermediate, []).append(name)
+    return {name: features for name, features in users.items() if len(features) > 1}
+
+def extract_features(user_log: Dict[str, Any], include_nlp: bool = True,
+                     analyzer: ContentNLPAnalyzer = None, update_index: bool = True,
+                     budget: TimeBudget = None, features: Sequence[str] = None,
+                     sketch: UserSketch = None, nlp_cache: Dict[int, Dict[str, float]] = None) -> Dict[str, Any]:
     """
     Extracts features from a user's karma log for fraud detection.
-    Returns a feature dict for model input.
-    """
-    karma_log = user_log.get('karma_log', [])
-    user_id = user_log.get('user_id', '')
-    account_age_days = user_log.get('account_age_days', 10)
-
-    upvotes = [a for a in karma_log if a['type'] == 'upvote_received']
-    comments = [a for a in karma_log if a['type'] == 'comment']
-    posts = [a for a in karma_log if a['type'] == 'post_created']
-    upvotes_sent = [a for a in karma_log if a['type'] == 'upvote_sent']
-
-    # Upvote features
-    upvote_from_users = [a['from_user'] for a in upvotes]
-    upvote_from_ages = [a.get('from_user_age_days', 10) for a in upvotes]
-    upvote_counts = Counter(upvote_from_users)
-    repeated_upvotes = sum(1 for c in upvote_counts.values() if c > 1)
-    if len(upvotes) == 1:
-        upvote_concentration = 0.0
-        unique_upvoters_ratio = 0.0
+    Returns a feature dict for model input. With include_nlp=False only the
+    structural features are computed (no NLP_FEATURES, no model calls).
+    `features` restricts extraction to those names (see required_features);
+    by default every registered feature is computed. See FeatureContext for
+    analyzer, update_index, budget, sketch and nlp_cache.
+    """
+    ctx = FeatureContext(user_log, analyzer=analyzer, update_index=update_index, budget=budget, sketch=sketch,
+                         nlp_cache=nlp_cache)
+    if features is None:
+        names = default_feature_names(include_nlp, ctx.use_index)
     else:
-        upvote_concentration = max(upvote_counts.values()) / max(1, len(upvotes)) if upvotes else 0.0
-        unique_upvoters_ratio = len(set(upvote_from_users)) / max(1, len(upvotes)) if upvotes else 0.0
-    young_upvote_ratio = sum(1 for age in upvote_from_ages if age is not None and age <= 7) / max(1, len(upvotes)) if upvotes else 0.0
-
-    # Upvote burstiness (time between upvotes)
-    upvote_times = [parse_timestamp(a['timestamp']) for a in upvotes]
-    upvote_times_sorted = sorted(upvote_times)
-    upvote_time_diffs = [
-        (upvote_times_sorted[i+1] - upvote_times_sorted[i]).total_seconds()
-        for i in range(len(upvote_times_sorted)-1)
-    ] if len(upvote_times_sorted) > 1 else []
-    avg_upvote_gap = np.mean(upvote_time_diffs) if upvote_time_diffs else 0.0
-    min_upvote_gap = np.min(upvote_time_diffs) if upvote_time_diffs else 0.0
-    upvote_burst_count = sum(1 for diff in upvote_time_diffs if diff < 3600)  # <1hr between upvotes
-
-    # Comment NLP features (using real model)
-    nlp_features = [nlp_analyzer.analyze(a['content']) for a in comments]
-    avg_spam_score = np.mean([f['spam_score'] for f in nlp_features]) if nlp_features else 0.0
-    avg_low_effort = np.mean([f['low_effort_score'] for f in nlp_features]) if nlp_features else 0.0
-
-    # Comment/Upvote ratios
-    comment_count = len(comments)
-    upvote_count = len(upvotes)
-    comment_to_upvote_ratio = comment_count / max(1, upvote_count)
-
-    # Comment length statistics
-    comment_lengths = [len(a['content']) for a in comments]
-    avg_comment_length = np.mean(comment_lengths) if comment_lengths else 0.0
-    median_comment_length = float(np.median(comment_lengths)) if comment_lengths else 0.0
-    comment_burst_count = 0
-    if len(comments) > 1:
-        comment_times = [parse_timestamp(a['timestamp']) for a in comments]
-        comment_times_sorted = sorted(comment_times)
-        comment_time_diffs = [
-            (comment_times_sorted[i+1] - comment_times_sorted[i]).total_seconds()
-            for i in range(len(comment_times_sorted)-1)
-        ]
-        comment_burst_count = sum(1 for diff in comment_time_diffs if diff < 3600)  # <1hr between comments
-
-    # --- Post features ---
-    total_posts = len(posts)
-    # Post burstiness (number of posts <1hr apart)
-    post_burst_count = 0
-    if len(posts) > 1:
-        post_times = [parse_timestamp(a['timestamp']) for a in posts]
-        post_times_sorted = sorted(post_times)
-        post_time_diffs = [
-            (post_times_sorted[i+1] - post_times_sorted[i]).total_seconds()
-            for i in range(len(post_times_sorted)-1)
-        ]
-        post_burst_count = sum(1 for diff in post_time_diffs if diff < 3600)
-    # Post NLP features
-    post_nlp_features = [nlp_analyzer.analyze(a['content']) for a in posts]
-    avg_post_spam_score = np.mean([f['spam_score'] for f in post_nlp_features]) if post_nlp_features else 0.0
-
-    # --- Upvote sent features ---
-    total_upvotes_sent = len(upvotes_sent)
-    upvote_sent_targets = [a['to_user'] for a in upvotes_sent if 'to_user' in a]
-    unique_upvote_targets = len(set(upvote_sent_targets)) if upvote_sent_targets else 0
-    # Upvote sent burstiness (number of upvotes sent <1hr apart)
-    upvote_sent_burst_count = 0
-    if len(upvotes_sent) > 1:
-        upvote_sent_times = [parse_timestamp(a['timestamp']) for a in upvotes_sent]
-        upvote_sent_times_sorted = sorted(upvote_sent_times)
-        upvote_sent_time_diffs = [
-            (upvote_sent_times_sorted[i+1] - upvote_sent_times_sorted[i]).total_seconds()
-            for i in range(len(upvote_sent_times_sorted)-1)
-        ]
-        upvote_sent_burst_count = sum(1 for diff in upvote_sent_time_diffs if diff < 3600)
-    # Mutual upvote count (users who both sent and received upvotes with this user)
-    upvote_from_users_set = set(a['from_user'] for a in upvotes if 'from_user' in a)
-    upvote_sent_targets_set = set(upvote_sent_targets)
-    mutual_upvote_count = len(upvote_from_users_set & upvote_sent_targets_set)
-
-    # Feature vector
-    features = {
-        'user_id': user_id,
-        'account_age_days': account_age_days,
-        'total_comments': comment_count,
-        'total_upvotes': upvote_count,
-        'repeated_upvotes': repeated_upvotes,
-        'upvote_concentration': upvote_concentration,
-        'unique_upvoters_ratio': unique_upvoters_ratio,
-        'young_upvote_ratio': young_upvote_ratio,
-        'avg_upvote_gap': avg_upvote_gap,
-        'min_upvote_gap': min_upvote_gap,
-        'upvote_burst_count': upvote_burst_count,
-        'avg_spam_score': avg_spam_score,
-        'avg_low_effort': avg_low_effort,
-        'comment_to_upvote_ratio': comment_to_upvote_ratio,
-        'avg_comment_length': avg_comment_length,
-        'median_comment_length': median_comment_length,
-        'comment_burst_count': comment_burst_count,
-        # --- Post features ---
-        'total_posts': total_posts,
-        'post_burst_count': post_burst_count,
-        'avg_post_spam_score': avg_post_spam_score,
-        # --- Upvote sent features ---
-        'total_upvotes_sent': total_upvotes_sent,
-        'unique_upvote_targets': unique_upvote_targets,
-        'upvote_sent_burst_count': upvote_sent_burst_count,
-        'mutual_upvote_count': mutual_upvote_count
-    }
-    return features
+        names = [name for name in features if include_nlp or name not in NLP_FEATURES]
+    return ctx.compute(names)
 
 # For batch processing
-def extract_features_batch(user_logs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    return [extract_features(log) for log in user_logs] 
\ No newline at end of file
+def extract_features_batch(user_logs: List[Dict[str, Any]], include_nlp: bool = True,
+                           analyzer: ContentNLPAnalyzer = None, update_index: bool = True,
+                           budget: TimeBudget = None, features: Sequence[str] = None,
+                           sketches: Sequence[UserSketch] = None,
+                           nlp_caches: Sequence[Dict[int, Dict[str, float]]] = None) -> List[Dict[str, Any]]:
+    sketches = [None] * len(user_logs) if sketches is None else sketches
+    nlp_caches = [None] * len(user_logs) if nlp_caches is None else nlp_caches
+    return [
+        extract_features(log, include_nlp=include_nlp, analyzer=analyzer, update_index=update_index,
+                         budget=budget, features=features, sketch=sketch, nlp_cache=nlp_cache)
+        for log, sketch, nlp_cache in zip(user_logs, sketches, nlp_caches)
+    ]
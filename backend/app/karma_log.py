@@ -0,0 +1,133 @@
+import numpy as np
+from array import array
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+# Interned activity type codes
+TYPE_CODES = {'upvote_received': 0, 'comment': 1, 'post_created': 2, 'upvote_sent': 3}
+UNKNOWN_TYPE = -1
+# User code for activities that do not carry the field at all (dict without the key)
+MISSING_USER = -1
+
+_EPOCH = datetime(1970, 1, 1)
+US_PER_SECOND = 1_000_000
+
+# Activities may be plain dicts or typed structs (see app.fast_codec)
+def get_field(obj, name, default=None):
+    if isinstance(obj, dict):
+        return obj.get(name, default)
+    return getattr(obj, name, default)
+
+def has_field(obj, name) -> bool:
+    if isinstance(obj, dict):
+        return name in obj
+    return hasattr(obj, name)
+
+# Helper to robustly parse ISO timestamps
+def parse_timestamp(ts: str) -> datetime:
+    try:
+        # Remove 'Z' if present
+        if ts.endswith('Z'):
+            ts = ts[:-1]
+        return datetime.fromisoformat(ts)
+    except Exception:
+        return datetime.now()  # fallback, should log in production
+
+def timestamp_us(ts: str) -> int:
+    """
+    Timestamp as integer microseconds since the epoch. Naive timestamps are
+    taken as-is; aware ones are converted to UTC first.
+    """
+    dt = parse_timestamp(ts)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    delta = dt - _EPOCH
+    return (delta.days * 86_400 + delta.seconds) * US_PER_SECOND + delta.microseconds
+
+
+class KarmaLog:
+    """
+    Columnar, single-pass view of a karma log for feature computation.
+
+    Per activity it keeps an int8 type code, an int64 timestamp (microseconds),
+    interned from_user/to_user codes and the from_user age; content strings are
+    referenced, not copied. `index[code]` holds the positions of each type.
+    """
+    __slots__ = ('types', 'timestamps', 'from_users', 'to_users', 'from_ages',
+                 'contents', 'users', 'index')
+
+    def __init__(self, types, timestamps, from_users, to_users, from_ages, contents, users):
+        self.types = types
+        self.timestamps = timestamps
+        self.from_users = from_users
+        self.to_users = to_users
+        self.from_ages = from_ages
+        self.contents = contents
+        self.users = users
+        self.index = {code: np.flatnonzero(types == code) for code in TYPE_CODES.values()}
+
+    @classmethod
+    def from_activities(cls, karma_log) -> 'KarmaLog':
+        types = array('b')
+        timestamps = array('q')
+        from_users = array('l')
+        to_users = array('l')
+        from_ages = array('d')
+        contents = []
+        user_codes = {}
+        users = []
+
+        def user_code(activity, name):
+            if not has_field(activity, name):
+                return MISSING_USER
+            user = get_field(activity, name)
+            code = user_codes.get(user)
+            if code is None:
+                code = user_codes[user] = len(users)
+                users.append(user)
+            return code
+
+        for a in karma_log:
+            code = TYPE_CODES.get(get_field(a, 'type'), UNKNOWN_TYPE)
+            types.append(code)
+            timestamps.append(timestamp_us(get_field(a, 'timestamp')))
+            if code == 0:
+                from_users.append(user_code(a, 'from_user'))
+                age = get_field(a, 'from_user_age_days', 10)
+                from_ages.append(np.nan if age is None else age)
+            else:
+                from_users.append(MISSING_USER)
+                from_ages.append(np.nan)
+            to_users.append(user_code(a, 'to_user') if code == 3 else MISSING_USER)
+            contents.append(get_field(a, 'content') if code in (1, 2) else None)
+
+        return cls(
+            types=np.frombuffer(types, dtype=np.int8),
+            timestamps=np.frombuffer(timestamps, dtype=np.int64),
+            from_users=np.asarray(from_users, dtype=np.int64),
+            to_users=np.asarray(to_users, dtype=np.int64),
+            from_ages=np.frombuffer(from_ages, dtype=np.float64),
+            contents=contents,
+            users=users
+        )
+
+    def __len__(self) -> int:
+        return len(self.types)
+
+    def positions(self, activity_type: str) -> np.ndarray:
+        return self.index[TYPE_CODES[activity_type]]
+
+    def count(self, activity_type: str) -> int:
+        return len(self.positions(activity_type))
+
+    def sorted_times(self, activity_type: str) -> np.ndarray:
+        return np.sort(self.timestamps[self.positions(activity_type)])
+
+    def gaps_seconds(self, activity_type: str) -> np.ndarray:
+        """
+        Gaps in seconds between consecutive (sorted) events of a type.
+        """
+        return np.diff(self.sorted_times(activity_type)) / US_PER_SECOND
+
+    def texts(self, activity_type: str) -> List[Optional[str]]:
+        return [self.contents[i] for i in self.positions(activity_type)]
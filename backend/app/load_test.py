@@ -0,0 +1,384 @@
+import sys
+import os
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import subprocess
+from urllib.parse import urlsplit
+from typing import Any, Dict, List, Optional
+import numpy as np
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# Load generator for the HTTP service. Replays users against /api/analyze
+# with asyncio, either closed-loop (a fixed number of clients, each sending
+# its next request when the previous one returns) or open-loop (requests
+# started at a fixed rate whether or not earlier ones returned, latency
+# measured from the scheduled start so queueing is not hidden).
+#
+# Latency percentiles are over completed 2xx responses only, so fast 503s
+# and failed connections cannot pull them down; every status also gets
+# its own percentiles. Requests the open loop sheds itself (max_in_flight
+# reached) are counted, not timed.
+#
+#   python app/load_test.py --dataset data/optimal_test.json --concurrency 1,4,16
+#   python app/load_test.py --generate 200 --rates 5,10,20 --workers 2
+#   python app/load_test.py --url http://127.0.0.1:8000 --server-pid 1234 --concurrency 8
+#
+# Without --url the app is started locally through app/serve.py. Server RSS
+# (parent + workers, Linux /proc) is sampled during every step.
+
+PLACEHOLDER_USER_ID = '__load_test_user__'
+
+
+# --- Minimal keep-alive HTTP/1.1 client (stdlib only) ---
+class Connection:
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method: str, path: str, body: bytes = b'', headers: Dict[str, str] = None):
+        """
+        Returns (status, body). Reconnects once if the server closed the
+        idle connection.
+        """
+        for attempt in (0, 1):
+            if self.writer is None:
+                self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            head = f'{method} {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\nContent-Length: {len(body)}\r\n'
+            if body:
+                head += 'Content-Type: application/json\r\n'
+            for name, value in (headers or {}).items():
+                head += f'{name}: {value}\r\n'
+            try:
+                self.writer.write(head.encode() + b'\r\n' + body)
+                await self.writer.drain()
+                return await self._read_response()
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                if attempt:
+                    raise
+
+    async def _read_response(self):
+        status_line = await self.reader.readuntil(b'\r\n')
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding') == 'chunked':
+            body = b''
+            while True:
+                size = int((await self.reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                chunk = await self.reader.readexactly(size + 2)
+                if not size:
+                    break
+                body += chunk[:-2]
+        else:
+            body = await self.reader.readexactly(int(headers.get('content-length', 0)))
+        if headers.get('connection') == 'close':
+            self.close()
+        return status, body
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+# --- Request bodies ---
+def load_users(dataset: Optional[str], generate: Optional[int], seed: int = 42) -> List[Dict[str, Any]]:
+    if dataset:
+        with open(dataset) as f:
+            return json.load(f)
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data')))
+    from generate_data import generate_realistic_hard_dataset
+    random.seed(seed)
+    n_suspicious = generate * 3 // 10
+    n_fraud = generate * 2 // 10
+    return generate_realistic_hard_dataset(generate - n_suspicious - n_fraud, n_suspicious, n_fraud)
+
+def encode_bodies(users: List[Dict[str, Any]]) -> List[bytes]:
+    # user_id is swapped per request so the result cache does not serve replays
+    return [
+        json.dumps({'user_id': PLACEHOLDER_USER_ID, 'karma_log': u['karma_log']}).encode()
+        for u in users
+    ]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}  # status -> [seconds]
+        self.errors = 0      # no response (connection error, timeout)
+        self.shed = 0        # never sent: the open loop was at max_in_flight
+
+    @property
+    def statuses(self) -> Dict[int, int]:
+        return {status: len(latencies) for status, latencies in self.latencies.items()}
+
+    def add(self, latency: float, status: Optional[int]):
+        if status is None:
+            self.errors += 1
+        else:
+            self.latencies.setdefault(status, []).append(latency)
+
+
+class LoadRunner:
+    def __init__(self, url: str, bodies: List[bytes], headers: Dict[str, str], cache_bust: bool = True,
+                 timeout: float = 60.0):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path.rstrip('/') + '/api/analyze'
+        self.bodies = bodies
+        self.headers = headers
+        self.cache_bust = cache_bust
+        self.timeout = timeout
+        self._next = 0
+
+    def _body(self) -> bytes:
+        n = self._next
+        self._next += 1
+        body = self.bodies[n % len(self.bodies)]
+        user_id = f'lt_{n}' if self.cache_bust else f'lt_{n % len(self.bodies)}'
+        return body.replace(PLACEHOLDER_USER_ID.encode(), user_id.encode(), 1)
+
+    async def _send(self, conn: Connection, recorder: Recorder, scheduled: float) -> Optional[int]:
+        try:
+            status, _ = await asyncio.wait_for(conn.request('POST', self.path, self._body(), self.headers), self.timeout)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+            conn.close()
+            status = None
+        recorder.add(time.perf_counter() - scheduled, status)
+        return status
+
+    async def closed_loop(self, concurrency: int, duration: float, max_backoff: float = 1.0) -> Recorder:
+        recorder = Recorder()
+        end = time.perf_counter() + duration
+
+        async def client():
+            conn = Connection(self.host, self.port)
+            backoff = 0.0
+            while time.perf_counter() < end:
+                if await self._send(conn, recorder, time.perf_counter()) is None:
+                    # Server unreachable: back off instead of reconnecting in a hot loop
+                    backoff = min(max(2 * backoff, 0.05), max_backoff)
+                    await asyncio.sleep(min(backoff, max(0.0, end - time.perf_counter())))
+                else:
+                    backoff = 0.0
+            conn.close()
+
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        return recorder
+
+    async def open_loop(self, rate: float, duration: float, max_in_flight: int = 1000) -> Recorder:
+        recorder = Recorder()
+        idle = [Connection(self.host, self.port) for _ in range(min(max_in_flight, 64))]
+        tasks = set()
+        start = time.perf_counter()
+        n = 0
+        while True:
+            scheduled = start + n / rate
+            if scheduled - start >= duration:
+                break
+            await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+            if len(tasks) >= max_in_flight:
+                recorder.shed += 1
+            else:
+                conn = idle.pop() if idle else Connection(self.host, self.port)
+
+                async def send(conn=conn, scheduled=scheduled):
+                    await self._send(conn, recorder, scheduled)
+                    idle.append(conn)
+
+                task = asyncio.ensure_future(send())
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            n += 1
+        if tasks:
+            await asyncio.wait(tasks)
+        for conn in idle:
+            conn.close()
+        return recorder
+
+
+# --- Server process and RSS ---
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def process_tree(pid: int) -> List[int]:
+    pids = [pid]
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            children = [int(p) for p in f.read().split()]
+    except OSError:
+        return pids
+    for child in children:
+        pids += process_tree(child)
+    return pids
+
+def rss_mb(pid: int) -> float:
+    total = 0
+    for p in process_tree(pid):
+        try:
+            with open(f'/proc/{p}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total / 1024
+
+async def sample_rss(pid: Optional[int], samples: List, stop: asyncio.Event, interval: float):
+    t0 = time.perf_counter()
+    while pid and not stop.is_set():
+        samples.append((round(time.perf_counter() - t0, 2), round(rss_mb(pid), 1)))
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+
+def start_server(workers: int, startup_timeout: float):
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, 'app/serve.py', '--host', '127.0.0.1', '--port', str(port), '--workers', str(workers)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + startup_timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('server exited during startup')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                pass
+            # Accepting connections; wait for a real answer
+            status, _ = asyncio.run(Connection('127.0.0.1', port).request('GET', '/api/health'))
+            if status == 200:
+                return proc, url
+        except (OSError, asyncio.IncompleteReadError):
+            time.sleep(0.5)
+    proc.kill()
+    raise RuntimeError('server did not start in time')
+
+
+# --- Reporting ---
+def latency_summary(latencies: List[float]) -> Dict[str, float]:
+    lat = np.array(latencies) * 1000
+    if not len(lat):
+        return {'p50_ms': 0.0, 'p90_ms': 0.0, 'p99_ms': 0.0, 'max_ms': 0.0}
+    p50, p90, p99 = np.percentile(lat, [50, 90, 99])
+    return {'p50_ms': float(p50), 'p90_ms': float(p90), 'p99_ms': float(p99), 'max_ms': float(lat.max())}
+
+def summarize(label: str, load: float, recorder: Recorder, duration: float, rss) -> Dict[str, Any]:
+    statuses = recorder.statuses
+    total = sum(statuses.values()) + recorder.errors + recorder.shed
+    ok = sum(n for status, n in statuses.items() if 200 <= status < 300)
+    completed = [t for status, latencies in recorder.latencies.items() if 200 <= status < 300 for t in latencies]
+    rss_values = [r for _, r in rss]
+    return {
+        'mode': label,
+        'load': load,
+        'requests': total,
+        'throughput_rps': ok / duration,
+        **latency_summary(completed),
+        'error_rate': (total - ok) / total if total else 0.0,
+        'rate_503': statuses.get(503, 0) / total if total else 0.0,
+        'statuses': statuses,
+        'latency_by_status': {status: latency_summary(latencies) for status, latencies in recorder.latencies.items()},
+        'client_errors': recorder.errors,
+        'shed': recorder.shed,
+        'rss_mean_mb': float(np.mean(rss_values)) if rss_values else None,
+        'rss_max_mb': float(np.max(rss_values)) if rss_values else None,
+        'rss_samples': rss
+    }
+
+def print_row(row: Dict[str, Any]):
+    rss = f"{row['rss_max_mb']:>8.0f}" if row['rss_max_mb'] is not None else f'{"-":>8s}'
+    print(f"{row['mode']:>6s} {row['load']:>7g} {row['requests']:>8d} {row['throughput_rps']:>8.1f} {row['p50_ms']:>8.1f} "
+          f"{row['p90_ms']:>8.1f} {row['p99_ms']:>8.1f} {row['error_rate']:>7.1%} {row['rate_503']:>6.1%} {row['shed']:>6d} {rss}", flush=True)
+
+async def run_steps(runner: LoadRunner, args, server_pid: Optional[int]) -> List[Dict[str, Any]]:
+    steps = [('conc', float(c)) for c in args.concurrency] + [('rate', r) for r in args.rates]
+    rows = []
+    for mode, load in steps:
+        if args.warmup:
+            if mode == 'conc':
+                await runner.closed_loop(int(load), args.warmup)
+            else:
+                await runner.open_loop(load, args.warmup, args.max_in_flight)
+        rss, stop = [], asyncio.Event()
+        sampler = asyncio.ensure_future(sample_rss(server_pid, rss, stop, args.rss_interval))
+        start = time.perf_counter()
+        if mode == 'conc':
+            recorder = await runner.closed_loop(int(load), args.duration)
+        else:
+            recorder = await runner.open_loop(load, args.duration, args.max_in_flight)
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await sampler
+        row = summarize(mode, load, recorder, elapsed, rss)
+        print_row(row)
+        rows.append(row)
+    return rows
+
+def parse_list(value: str, cast):
+    return [cast(v) for v in value.split(',') if v]
+
+def main():
+    parser = argparse.ArgumentParser(description='Closed/open-loop load test of /api/analyze.')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--dataset', default='data/optimal_test.json', help='JSON list of users to replay')
+    source.add_argument('--generate', type=int, help='replay this many users from data/generate_data.py instead')
+    parser.add_argument('--url', help='target a running server instead of starting one')
+    parser.add_argument('--server-pid', type=int, help='with --url: pid whose RSS (with children) to sample')
+    parser.add_argument('--workers', type=int, default=1, help='workers for the locally started server')
+    parser.add_argument('--concurrency', type=lambda v: parse_list(v, int), default=[],
+                        help='closed-loop client counts, e.g. 1,4,16')
+    parser.add_argument('--rates', type=lambda v: parse_list(v, float), default=[],
+                        help='open-loop request rates (req/s), e.g. 5,10,20')
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds measured per step')
+    parser.add_argument('--warmup', type=float, default=3.0, help='unmeasured seconds before each step')
+    parser.add_argument('--max-in-flight', type=int, default=1000, help='open-loop cap on outstanding requests')
+    parser.add_argument('--budget-ms', type=float, help='send X-Time-Budget-Ms with every request')
+    parser.add_argument('--allow-cache-hits', action='store_true', help='reuse user_ids so the result cache can answer')
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--rss-interval', type=float, default=0.5)
+    parser.add_argument('--startup-timeout', type=float, default=300.0)
+    parser.add_argument('--output', help='write all rows (with RSS samples) as JSON')
+    args = parser.parse_args()
+    if not args.concurrency and not args.rates:
+        args.concurrency = [1, 2, 4, 8, 16]
+
+    users = load_users(None if args.generate else args.dataset, args.generate)
+    headers = {'X-Time-Budget-Ms': str(args.budget_ms)} if args.budget_ms else {}
+    proc = None
+    url, server_pid = args.url, args.server_pid
+    if url is None:
+        proc, url = start_server(args.workers, args.startup_timeout)
+        server_pid = proc.pid
+    try:
+        runner = LoadRunner(url, encode_bodies(users), headers, cache_bust=not args.allow_cache_hits, timeout=args.timeout)
+        print(f'{len(users)} users -> {url}')
+        print(f'{"mode":>6s} {"load":>7s} {"requests":>8s} {"rps":>8s} {"p50 ms":>8s} {"p90 ms":>8s} {"p99 ms":>8s} '
+              f'{"errors":>7s} {"503":>6s} {"shed":>6s} {"rss MB":>8s}')
+        rows = asyncio.run(run_steps(runner, args, server_pid))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=30)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'url': url, 'users': len(users), 'steps': rows}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,32 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Literal
 import uvicorn
 import json
-import numpy as np
-from joblib import load
+import uuid
+import hashlib
+import itertools
+import time
+import threading
+import math
 import os
-import re
-from app.feature_extractor import extract_features_batch
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+import secrets
+from app.feature_extractor import get_field, nlp_analyzer as feature_nlp_analyzer
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from app.nlp_utils import ContentNLPAnalyzer
+from app.model_bundle import ModelBundle, BundleManager
+from app.explain_rules import (
+    RuleEngine, text_activities, iter_text_explanations, top_k_activities, aggregate_activities,
+    get_status as config_status
+)
+from app.cache import TTLCache
+from app.budget import TimeBudget
+from app.scheduler import AdmissionScheduler, Overloaded
+from app.fast_codec import decode_analyze_request, encode_analyze_response, request_digest, ndjson_lines, RequestDecodeError
 
 # Load config
 CONFIG_PATH = 'app/config.json'
@@ -30,11 +45,25 @@ def load_config():
             "model_path": "model/model.pkl",
             "feature_names_path": "model/feature_names.json",
             "spam_model_path": "model/spam_clf.pkl",
-            "loweffort_model_path": "model/loweffort_clf.pkl"
+            "loweffort_model_path": "model/loweffort_clf.pkl",
+            "cascade_model_path": "model/cascade_clf.pkl",
+            "projection_model_path": "model/embedding_projection.pkl",
+            "structural_model_path": "model/structural_model.pkl",
+            "structural_feature_names_path": "model/structural_feature_names.json"
         },
         "nlp_settings": {
             "spam_threshold": 0.5,
-            "loweffort_threshold": 0.65
+            "loweffort_threshold": 0.65,
+            "cascade": {
+                "enabled": False,
+                "uncertain_band": [0.2, 0.8],
+                "lexicon_confident_score": 1.0
+            },
+            "embedding": {
+                "max_seq_length": None,
+                "max_batch_tokens": 8192,
+                "max_batch_size": 256
+            }
         },
         "suspicious_activity_thresholds": {
             "young_upvote_ratio": 0.3,
@@ -43,32 +72,78 @@ def load_config():
             "mutual_upvote_count": 1,
             "avg_post_spam_score": 0.5,
             "post_burst_count": 2,
-            "upvote_sent_burst_count": 2
+            "upvote_sent_burst_count": 2,
+            "max_cross_user_copies": 3
+        },
+        "explanation_settings": {
+            "default_top_k": 20,
+            "sample_size": 5,
+            "max_page_size": 1000,
+            "cursor_ttl_seconds": 600,
+            "cursor_max_entries": 1000,
+            "cursor_max_bytes": 67108864,
+            "analysis_ttl_seconds": 600,
+            "analysis_max_entries": 100000,
+            "analysis_max_bytes": 67108864
+        },
+        "feature_settings": {
+            "burst_windows_seconds": [600, 3600, 86400]
+        },
+        "content_index": {
+            "enabled": False
+        },
+        "two_stage_settings": {
+            "enabled": True,
+            "uncertain_band": [0.1, 0.6]
+        },
+        "api_settings": {
+            "fast_codec": True
+        },
+        "deadline_settings": {
+            "default_budget_ms": 10000,
+            "max_budget_ms": 30000,
+            "header": "X-Time-Budget-Ms",
+            "nlp_chunk_size": 256
+        },
+        "bulk_settings": {
+            "batch_size": 64,
+            "batch_max_bytes": 33554432,
+            "max_line_bytes": 67108864
+        },
+        "scheduler_settings": {
+            "enabled": True,
+            "total_concurrency": 4,
+            "header": "X-Priority-Class",
+            "latency_window": 1000,
+            "classes": {
+                "interactive": {"priority": 0, "max_concurrency": 4, "max_queue": 64, "latency_target_ms": 2000},
+                "bulk": {"priority": 1, "max_concurrency": 2, "max_queue": 16, "latency_target_ms": 60000}
+            }
+        },
+        "result_cache": {
+            "enabled": True,
+            "max_entries": 10000,
+            "ttl_seconds": 300
+        },
+        "bundle_settings": {
+            "bundle_root": "model/bundles",
+            "admin_token_env": "MODEL_ADMIN_TOKEN",
+            "admin_header": "X-Admin-Token",
+            "shadow_sample_rate": 0.1,
+            "max_pending": 32,
+            "latency_window": 1000
         }
     }
 
 config = load_config()
 
 # --- Model loading ---
-model = load(config['model_settings']['model_path'])
-with open(config['model_settings']['feature_names_path']) as f:
-    feature_names = json.load(f)
-
-# --- Spam/vague word dicts (can be moved to config) ---
-spam_words = {
-    "upvote pls": 1.0, "pls upvote": 1.0, "follow me": 1.0, "check my profile": 0.9,
-    "dm me": 0.8, "please upvote": 1.0, "click my link": 0.9, "vote me": 1.0,
-    "top post": 0.8, "boost": 0.8, "🔥": 0.4, "💯": 0.4, "wow": 0.3, "lol": 0.2,
-    "this slaps": 0.4, "facts": 0.3, "check out my page": 0.9,
-    "drop an upvote": 1.0, "karma needed": 1.0, "link in bio": 0.9, "upvote for upvote": 1.0,
-    "pls boost me": 0.9, "check this out": 0.8, "need votes": 1.0, "support my post": 0.9,
-    "sub for sub": 1.0, "f4f": 0.9, "like4like": 0.9, "comment4comment": 0.9
-}
-vague_words = {
-    'nice': 0.6, 'cool': 0.6, 'good': 0.6, 'great': 0.6, 'awesome': 0.6, 'fire': 0.6,
-    'insane': 0.5, 'wild': 0.7, 'lit': 0.7, 'banger': 0.7,
-    'amazing': 0.5, 'sick': 0.6, 'dope': 0.7, 'based': 0.6
-}
+# The startup bundle is the artifacts in config['model_settings']; it shares
+# the feature extractor's NLP analyzer. Later bundles are hot-swapped through
+# bundle_manager (see the /api/models endpoints).
+startup_bundle = ModelBundle.from_settings(
+    config, config['model_settings'], version=config.get('version', '1.0.0'), nlp_analyzer=feature_nlp_analyzer
+)
 
 # --- Pydantic models ---
 class KarmaActivity(BaseModel):
@@ -81,128 +156,176 @@ class KarmaActivity(BaseModel):
     source: Optional[str] = None
     post_id: Optional[str] = None
 
+class ExplainOptions(BaseModel):
+    # full: every hit (default); top_k: highest-scoring hits only;
+    # aggregate: one summary per reason. Truncated results get a cursor.
+    # deferred: no explanations now, an analysis_id to fetch them later
+    # from /api/explanations/{analysis_id}
+    mode: Literal['full', 'top_k', 'aggregate', 'deferred'] = 'full'
+    top_k: Optional[int] = Field(None, ge=1)
+    sample_size: Optional[int] = Field(None, ge=0)
+
 class AnalyzeRequest(BaseModel):
     user_id: str
     karma_log: List[KarmaActivity]
+    explain: Optional[ExplainOptions] = None
 
 class SuspiciousActivity(BaseModel):
     activity_id: Optional[str] = None
     reason: str
     score: float
 
+class SuspiciousSummary(BaseModel):
+    reason: str
+    count: int
+    max_score: float
+    sample_activity_ids: List[str]
+
+class Coverage(BaseModel):
+    texts_total: int
+    texts_scored: int
+    text_coverage: float
+    elapsed_ms: float
+    budget_ms: Optional[float] = None
+
 class AnalyzeResponse(BaseModel):
     user_id: str
     fraud_score: float
     suspicious_activities: List[SuspiciousActivity]
     status: str
+    total_suspicious: Optional[int] = None
+    suspicious_summary: Optional[List[SuspiciousSummary]] = None
+    cursor: Optional[str] = None
+    # True when the time budget ran out before every text was NLP-scored;
+    # NLP averages then cover the most recent texts only
+    degraded: bool = False
+    coverage: Optional[Coverage] = None
+    analysis_id: Optional[str] = None
+    # Threshold rules whose feature was not computed (NLP rules when the
+    # structural score was decisive); they cannot appear in the explanations
+    rules_not_evaluated: Optional[List[str]] = None
+
+class ExplanationResponse(BaseModel):
+    analysis_id: str
+    user_id: str
+    suspicious_activities: List[SuspiciousActivity]
+    total_suspicious: Optional[int] = None
+    suspicious_summary: Optional[List[SuspiciousSummary]] = None
+    cursor: Optional[str] = None
 
-# --- Utility functions ---
-def find_words(text, word_dict):
-    found = []
-    text_lower = text.lower()
-    for word, score in word_dict.items():
-        if re.search(r'\b' + re.escape(word) + r'\b', text_lower) or word in text_lower:
-            found.append((word, score))
-    return found
-
-# Initialize NLP analyzer for per-activity spam detection
-nlp_analyzer = ContentNLPAnalyzer(
-    spam_model_path=config['model_settings']['spam_model_path'],
-    loweffort_model_path=config['model_settings']['loweffort_model_path']
+class SuspiciousPage(BaseModel):
+    cursor: str
+    total: int
+    offset: int
+    suspicious_activities: List[SuspiciousActivity]
+    next_offset: Optional[int] = None
+
+# Threshold rules are compiled once and shared with the batch scorer
+rule_engine = RuleEngine.from_config(config)
+
+def explanation_inputs(user, features, use_nlp=True, nlp_scores=None):
+    """
+    What the suspicious_activities of an analysis are built from: the rule
+    records (few, but their anchors need the whole karma_log), the
+    comment/post texts and the NLP spam scores of this analysis. Small
+    enough to keep between requests in place of the built list.
+    """
+    # user may be an AnalyzeRequest, its plain-dict form or an AnalyzeRequestStruct
+    if isinstance(user, BaseModel):
+        user = user.dict()
+    X_rules = rule_engine.matrix([features])
+    texts = text_activities(get_field(user, 'karma_log', []))
+    if use_nlp and nlp_scores is not None:
+        nlp_scores = {position: {'spam_score': nlp_scores[position]['spam_score']}
+                      for position, _, _ in texts if position in nlp_scores}
+    else:
+        nlp_scores = None
+    return {
+        'rule_records': rule_engine.explain_batch([user], X_rules, rule_engine.features)[0],
+        'texts': texts,
+        'nlp_scores': nlp_scores
+    }
+
+def explanation_nbytes(inputs):
+    """Rough in-memory size of explanation_inputs(), for the byte-bounded stores."""
+    return (200 + 400 * len(inputs['rule_records'])
+            + sum(200 + len(content) + len(activity_id or '') for _, activity_id, content in inputs['texts'])
+            + 300 * len(inputs['nlp_scores'] or ()))
+
+def iter_explanations(inputs):
+    """suspicious_activities of explanation_inputs(), one record at a time."""
+    yield from inputs['rule_records']
+    yield from iter_text_explanations(inputs['texts'], None, config['nlp_settings']['spam_threshold'],
+                                      inputs['nlp_scores'])
+
+# Inputs of truncated responses, fetched by cursor; pages are rebuilt from them
+explain_settings = config.get('explanation_settings', {})
+suspicious_store = TTLCache(
+    max_entries=explain_settings.get('cursor_max_entries', 1000),
+    ttl_seconds=explain_settings.get('cursor_ttl_seconds', 600),
+    max_bytes=explain_settings.get('cursor_max_bytes', 64 * 2 ** 20),
+    sizeof=explanation_nbytes
 )
 
-def explain_activities(user, features):
-    suspicious_activities = []
-    thresholds = config['suspicious_activity_thresholds']
-    
-    # Upvote-based
-    upvotes = [a for a in user.karma_log if a.type == 'upvote_received']
-    if features.get('young_upvote_ratio', 0) > thresholds['young_upvote_ratio'] and upvotes:
-        suspicious_activities.append({
-            'activity_id': upvotes[0].activity_id,
-            'reason': 'Upvote from new account',
-            'score': round(features['young_upvote_ratio'], 2)
-        })
-    if features.get('upvote_burst_count', 0) > thresholds['upvote_burst_count'] and upvotes:
-        suspicious_activities.append({
-            'activity_id': upvotes[0].activity_id,
-            'reason': 'Unusual burst of karma gain',
-            'score': round(features['upvote_burst_count'], 2)
-        })
-    if features.get('upvote_concentration', 0) > thresholds['upvote_concentration'] and upvotes:
-        suspicious_activities.append({
-            'activity_id': upvotes[0].activity_id,
-            'reason': 'Upvote from bot-like account',
-            'score': round(features['upvote_concentration'], 2)
-        })
-    # --- New suspicious activity checks ---
-    if features.get('mutual_upvote_count', 0) >= thresholds['mutual_upvote_count']:
-        suspicious_activities.append({
-            'reason': 'High number of mutual upvotes',
-            'score': features['mutual_upvote_count']
-        })
-    if features.get('avg_post_spam_score', 0) > thresholds['avg_post_spam_score']:
-        suspicious_activities.append({
-            'reason': 'High average post spam score',
-            'score': round(features['avg_post_spam_score'], 2)
-        })
-    if features.get('post_burst_count', 0) > thresholds['post_burst_count']:
-        suspicious_activities.append({
-            'activity_id': user.karma_log[0].activity_id if user.karma_log else 'unknown',
-            'reason': 'Burst of posts in short time',
-            'score': features['post_burst_count']
-        })
-    if features.get('upvote_sent_burst_count', 0) > thresholds['upvote_sent_burst_count']:
-        suspicious_activities.append({
-            'activity_id': user.karma_log[0].activity_id if user.karma_log else 'unknown',
-            'reason': 'Burst of upvotes sent in short time',
-            'score': features['upvote_sent_burst_count']
-        })
-    # Only one type of activity
-    activity_types = set(a.type for a in user.karma_log)
-    if len(activity_types) == 1:
-        only_type = list(activity_types)[0]
-        suspicious_activities.append({
-            'activity_id': user.karma_log[0].activity_id if user.karma_log else 'unknown',
-            'reason': f'Only {only_type} type of activity is suspicious',
-            'score': 1.0
-        })
-    # Spam/vague word detection for comments and posts
-    comments = [a for a in user.karma_log if a.type == 'comment']
-    posts = [a for a in user.karma_log if a.type == 'post_created']
-    for c in comments + posts:
-        found_spam = find_words((c.content or ''), spam_words)
-        for word, score in found_spam:
-            suspicious_activities.append({
-                'activity_id': c.activity_id,
-                'reason': f"Spam word '{word}' detected",
-                'score': score
-            })
-        found_vague = find_words((c.content or ''), vague_words)
-        for word, score in found_vague:
-            suspicious_activities.append({
-                'activity_id': c.activity_id,
-                'reason': f"Vague word '{word}' detected",
-                'score': score
-            })
-        # NLP-based spam detection
-        nlp_result = nlp_analyzer.analyze(c.content or '')
-        if nlp_result['spam_score'] > config['nlp_settings']['spam_threshold']:
-            suspicious_activities.append({
-                'activity_id': c.activity_id,
-                'reason': f"NLP spam score high ({nlp_result['spam_score']:.2f})",
-                'score': round(nlp_result['spam_score'], 2)
-            })
-    return suspicious_activities
+# Deferred explanations: the explanation_inputs of an analysis, kept per
+# analysis_id. Bounded by bytes; the entry limit is only a backstop, high
+# enough that a bulk stream of deferred analyses does not evict its own
+# ids (they are evicted least recently used first once the bytes run out).
+analysis_store = TTLCache(
+    max_entries=explain_settings.get('analysis_max_entries', 100000),
+    ttl_seconds=explain_settings.get('analysis_ttl_seconds', 600),
+    max_bytes=explain_settings.get('analysis_max_bytes', 64 * 2 ** 20),
+    sizeof=lambda context: explanation_nbytes(context['inputs'])
+)
 
-def get_status(fraud_score):
-    thresholds = config['fraud_score_thresholds']
-    if fraud_score < thresholds['clean']:
-        return 'clean'
-    elif fraud_score < thresholds['flagged']:
-        return 'flagged'
+def defer_explanation(user, inputs):
+    """
+    Stores explanation_inputs() of an analysis and returns the analysis_id
+    they are kept under, or None if they are larger than the whole store.
+    Nothing else of the request or the bundle is kept.
+    """
+    analysis_id = uuid.uuid4().hex
+    if not analysis_store.set(analysis_id, {'user_id': get_field(user, 'user_id'), 'inputs': inputs}):
+        return None
+    return analysis_id
+
+def shape_suspicious(inputs, options):
+    """
+    Builds the suspicious_activities of explanation_inputs() as the
+    request's explain options ask. Returns the response fields
+    (suspicious_activities, total_suspicious, suspicious_summary, cursor).
+    top_k and aggregate consume the records as they are built and never
+    hold the full list; the cursor keeps the inputs, not the list.
+    """
+    activities = iter_explanations(inputs)
+    if options is None or options.mode == 'full':
+        return {'suspicious_activities': list(activities)}
+    # tally advances once per record consumed (zip stops on activities first)
+    tally = itertools.count()
+    activities = (a for a, _ in zip(activities, tally))
+    shaped = {'suspicious_activities': []}
+    if options.mode == 'top_k':
+        k = options.top_k or explain_settings.get('default_top_k', 20)
+        shaped['suspicious_activities'] = top_k_activities(activities, k)
+        total = next(tally)
+        truncated = total > k
     else:
-        return 'banned_recommendation'
+        sample_size = options.sample_size
+        if sample_size is None:
+            sample_size = explain_settings.get('sample_size', 5)
+        shaped['suspicious_summary'] = aggregate_activities(activities, sample_size)
+        total = next(tally)
+        truncated = total > 0
+    shaped['total_suspicious'] = total
+    cursor = uuid.uuid4().hex
+    if truncated and suspicious_store.set(cursor, inputs):
+        shaped['cursor'] = cursor
+    return shaped
+
+def get_status(fraud_score):
+    return config_status(fraud_score, config)
+
+bundle_manager = BundleManager.from_config(startup_bundle, config, status_fn=get_status)
 
 # --- FastAPI app ---
 app = FastAPI(title="Karma Fraud Detector", version=config.get('version', '1.0.0'))
@@ -214,31 +337,435 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all methods
     allow_headers=["*"],  # Allows all headers
+    expose_headers=["ETag"],
 )
 
-@app.post('/api/analyze', response_model=AnalyzeResponse)
-def analyze(request: AnalyzeRequest):
-    user_dict = request.dict()
-    X_dicts = extract_features_batch([user_dict])
-    features = X_dicts[0]
-    X = np.array([[features[f] for f in feature_names]])
-    fraud_score = float(model.predict_proba(X)[0, 2])
-    suspicious_activities = explain_activities(request, features)
+# Two-stage scoring counters, reported by /api/metrics
+two_stage_stats = {'users': 0, 'nlp_skipped': 0}
+two_stage_lock = threading.Lock()
+
+def score_user(bundle, user, budget=None):
+    """
+    Returns (features, fraud_score, used_nlp), see ModelBundle.score.
+    """
+    features, fraud_score, used_nlp = bundle.score(user, budget=budget)
+    if bundle.structural_model is not None:
+        with two_stage_lock:
+            two_stage_stats['users'] += 1
+            two_stage_stats['nlp_skipped'] += int(not used_nlp)
+    return features, fraud_score, used_nlp
+
+# --- Time budgets ---
+deadline_settings = config.get('deadline_settings', {})
+
+def request_budget(headers):
+    """
+    TimeBudget for a request: the budget header if sent (capped at
+    max_budget_ms), else default_budget_ms. Raises HTTPException(400) for
+    a malformed header.
+    """
+    budget_ms = deadline_settings.get('default_budget_ms')
+    header = headers.get(deadline_settings.get('header', 'X-Time-Budget-Ms'))
+    if header is not None:
+        try:
+            budget_ms = float(header)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f'Invalid time budget {header!r}')
+        if budget_ms <= 0:
+            raise HTTPException(status_code=400, detail='Time budget must be positive')
+    max_budget_ms = deadline_settings.get('max_budget_ms')
+    if budget_ms is not None and max_budget_ms is not None:
+        budget_ms = min(budget_ms, max_budget_ms)
+    return TimeBudget(budget_ms / 1000 if budget_ms is not None else None,
+                      chunk_size=deadline_settings.get('nlp_chunk_size', 256))
+
+def run_analysis(user, explain_options, bundle=None, budget=None):
+    """
+    Scores one user and returns the AnalyzeResponse fields as a plain dict.
+    user is a plain dict (Pydantic path) or an AnalyzeRequestStruct (fast path).
+    """
+    # Captured once: a concurrent swap never mixes bundles within a request
+    bundle = bundle_manager.active if bundle is None else bundle
+    budget = TimeBudget() if budget is None else budget
+    start = time.perf_counter()
+    features, fraud_score, used_nlp = score_user(bundle, user, budget)
+    if not budget.degraded:
+        # A partial score says nothing about the shadow bundle
+        bundle_manager.maybe_shadow(user, fraud_score, time.perf_counter() - start)
     status = get_status(fraud_score)
-    return AnalyzeResponse(
-        user_id=request.user_id,
+    inputs = explanation_inputs(user, features, used_nlp, budget.nlp_scores)
+    deferred = explain_options is not None and explain_options.mode == 'deferred'
+    analysis_id = defer_explanation(user, inputs) if deferred else None
+    if analysis_id is not None:
+        explained = {'suspicious_activities': []}
+    elif deferred:
+        # Too large to keep: the top records now instead
+        explained = shape_suspicious(inputs, ExplainOptions(mode='top_k', top_k=explain_options.top_k))
+    else:
+        explained = shape_suspicious(inputs, explain_options)
+    return dict(
+        user_id=get_field(user, 'user_id'),
         fraud_score=round(fraud_score, 3),
-        suspicious_activities=suspicious_activities,
-        status=status
+        status=status,
+        **explained,
+        degraded=budget.degraded,
+        coverage=budget.coverage(),
+        analysis_id=analysis_id,
+        rules_not_evaluated=rule_engine.not_evaluated(features) or None
     )
 
+# --- Result cache ---
+# Finished analyses keyed by a canonical hash of the request, the active
+# bundle and every config section that shapes a response; the key doubles
+# as the response ETag. Swapping bundles clears it.
+RESPONSE_CONFIG_KEYS = ['fraud_score_thresholds', 'suspicious_activity_thresholds', 'nlp_settings',
+                        'explanation_settings', 'feature_settings', 'two_stage_settings']
+config_fingerprint = hashlib.blake2b(
+    json.dumps({k: config.get(k) for k in RESPONSE_CONFIG_KEYS}, sort_keys=True).encode(), digest_size=8
+).hexdigest()
+result_cache_settings = config.get('result_cache', {})
+result_cache = TTLCache(
+    max_entries=result_cache_settings.get('max_entries', 10000),
+    ttl_seconds=result_cache_settings.get('ttl_seconds', 300)
+) if result_cache_settings.get('enabled', True) else None
+if result_cache is not None:
+    bundle_manager.add_swap_listener(lambda bundle: result_cache.clear())
+result_cache_stats = {'hits': 0, 'misses': 0, 'not_modified': 0}
+result_cache_lock = threading.Lock()
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates or f'W/{etag}' in candidates
+
+def cache_lookup(user, if_none_match=None):
+    """
+    Looks the request up in the result cache; cheap enough to run before
+    admission. Returns (bundle, etag, hit, result): on a hit, result is the
+    cached response, or None when if_none_match names it (answer 304);
+    otherwise pass bundle and etag on to compute_analysis.
+    """
+    bundle = bundle_manager.active
+    if result_cache is None:
+        return bundle, None, False, None
+    etag = f'"{request_digest(user, bundle.version, str(bundle.loaded_at), config_fingerprint)}"'
+    result = result_cache.get(etag)
+    # A cached cursor or analysis_id is only useful while what it points at is still stored
+    if result is not None and ((result.get('cursor') and suspicious_store.get(result['cursor']) is None)
+                               or (result.get('analysis_id') and analysis_store.get(result['analysis_id']) is None)):
+        result = None
+    if result is None:
+        return bundle, etag, False, None
+    not_modified = etag_matches(if_none_match, etag)
+    with result_cache_lock:
+        result_cache_stats['not_modified' if not_modified else 'hits'] += 1
+    return bundle, etag, True, (None if not_modified else result)
+
+def compute_analysis(user, explain_options, bundle, etag, budget=None):
+    """
+    run_analysis on a cache_lookup miss, cached under etag. Returns
+    (result, etag); degraded results are neither cached nor given an ETag.
+    """
+    if etag is None:
+        return run_analysis(user, explain_options, bundle, budget), None
+    with result_cache_lock:
+        result_cache_stats['misses'] += 1
+    result = run_analysis(user, explain_options, bundle, budget)
+    if result['degraded']:
+        return result, None
+    result_cache.set(etag, result)
+    return result, etag
+
+# --- Admission scheduling ---
+# Interactive requests and bulk batches share the worker threads and models;
+# each unit of work takes a slot of its priority class (see AdmissionScheduler).
+# The time budget starts before admission, so queue wait counts against it.
+# Result-cache hits and 304s are answered before admission and take no slot.
+#
+# The scheduler lives in each worker process: under app/serve.py with N
+# workers, total_concurrency and every class's max_concurrency and
+# max_queue apply per worker, so the server admits up to N times as much.
+scheduler_settings = config.get('scheduler_settings', {})
+scheduler = AdmissionScheduler.from_config(scheduler_settings) if scheduler_settings.get('enabled', False) else None
+
+def priority_class(headers, default):
+    """
+    Priority class named by the priority header, else the endpoint's
+    default. The header may only lower the priority: naming a class that
+    runs ahead of the default raises HTTPException(403), an unknown class
+    HTTPException(400).
+    """
+    name = headers.get(scheduler_settings.get('header', 'X-Priority-Class'), default)
+    if scheduler is None or name == default:
+        return name
+    if name not in scheduler.classes:
+        raise HTTPException(status_code=400, detail=f'Unknown priority class {name!r}')
+    if scheduler.classes[name].priority < scheduler.classes[default].priority:
+        raise HTTPException(status_code=403, detail=f'Priority class {name!r} is above this endpoint\'s {default!r}')
+    return name
+
+def overloaded(e):
+    return HTTPException(status_code=503, detail=f'Overloaded: {e}',
+                         headers={'Retry-After': str(math.ceil(e.retry_after))})
+
+async def scheduled(name, func, *args, admitted=False):
+    """Runs func(*args) in the threadpool once a slot of class name is free."""
+    if scheduler is None:
+        return await run_in_threadpool(func, *args)
+    try:
+        async with scheduler.slot(name, admitted):
+            return await run_in_threadpool(func, *args)
+    except Overloaded as e:
+        raise overloaded(e)
+
+async def analyze(request: AnalyzeRequest, http_request: Request, response: Response):
+    budget = request_budget(http_request.headers)
+    name = priority_class(http_request.headers, 'interactive')
+    user = request.dict()
+    bundle, etag, hit, result = await run_in_threadpool(cache_lookup, user, http_request.headers.get('if-none-match'))
+    if not hit:
+        result, etag = await scheduled(name, compute_analysis, user, request.explain, bundle, etag, budget)
+    if result is None:
+        return Response(status_code=304, headers={'ETag': etag})
+    if etag:
+        response.headers['ETag'] = etag
+    return AnalyzeResponse(**result)
+
+async def analyze_fast(request: Request):
+    # Decodes the raw body straight into structs and encodes the response with
+    # msgspec; invalid bodies are re-validated by Pydantic for identical errors
+    budget = request_budget(request.headers)
+    name = priority_class(request.headers, 'interactive')
+    body = await request.body()
+    try:
+        user = decode_analyze_request(body, fallback_model=AnalyzeRequest)
+    except RequestDecodeError as e:
+        raise RequestValidationError(e.errors)
+    explain = user.explain
+    if isinstance(user, BaseModel):
+        user = user.dict()
+    bundle, etag, hit, result = await run_in_threadpool(cache_lookup, user, request.headers.get('if-none-match'))
+    if not hit:
+        result, etag = await scheduled(name, compute_analysis, user, explain, bundle, etag, budget)
+    headers = {'ETag': etag} if etag else None
+    if result is None:
+        return Response(status_code=304, headers=headers)
+    return Response(content=encode_analyze_response(**result), media_type='application/json', headers=headers)
+
+if config.get('api_settings', {}).get('fast_codec', True):
+    app.add_api_route(
+        '/api/analyze', analyze_fast, methods=['POST'],
+        responses={200: {'model': AnalyzeResponse}},
+        openapi_extra={'requestBody': {'required': True, 'content': {'application/json': {}}}}
+    )
+else:
+    app.add_api_route('/api/analyze', analyze, methods=['POST'], response_model=AnalyzeResponse)
+
+# --- Bulk NDJSON analysis ---
+bulk_settings = config.get('bulk_settings', {})
+
+class NDJSONStreamingResponse(StreamingResponse):
+    """
+    Streams without a concurrent disconnect listener: the body iterator
+    itself reads the request body, and a second receive() loop would
+    swallow body chunks. A disconnect surfaces when the next chunk is read.
+    """
+    media_type = 'application/x-ndjson'
+
+    def __init__(self, content, on_close=None, **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        # on_close runs however the stream ends, even if the body was never started
+        try:
+            await self.stream_response(send)
+        finally:
+            if self.on_close is not None:
+                self.on_close()
+
+def analyze_ndjson_batch(batch, headers):
+    """
+    Decodes and scores one batch of (line_number, line) pairs; returns the
+    NDJSON output for it, one AnalyzeResponse or error object per line.
+    """
+    out = []
+    for line_number, line in batch:
+        if line is None:
+            out.append(json.dumps({'line': line_number, 'detail': 'Line exceeds max_line_bytes'}).encode())
+            continue
+        try:
+            user = decode_analyze_request(line, fallback_model=AnalyzeRequest)
+        except RequestDecodeError as e:
+            out.append(json.dumps({'line': line_number, 'detail': jsonable_encoder(e.errors)}).encode())
+            continue
+        if isinstance(user, BaseModel):
+            result = run_analysis(user.dict(), user.explain, budget=request_budget(headers))
+        else:
+            result = run_analysis(user, user.explain, budget=request_budget(headers))
+        out.append(encode_analyze_response(**result))
+    return b'\n'.join(out) + b'\n'
+
+@app.post('/api/analyze/stream', response_class=NDJSONStreamingResponse)
+async def analyze_stream(request: Request):
+    """
+    NDJSON body, one AnalyzeRequest per line -> NDJSON body, one
+    AnalyzeResponse (or {"line", "detail"} error) per line, in input order.
+
+    Lines are read and scored batch by batch, and the next batch is only
+    read once the previous output was handed to the client, so memory is
+    bounded by batch_size / batch_max_bytes and a slow reader throttles
+    the upload. Clients must read the response while still sending.
+
+    Runs in the bulk priority class (or a lower one named by the priority
+    header): the stream is refused with 503 if the class queue is full,
+    and otherwise holds a place in it until the response ends. Each batch
+    waits in that place for its own slot, so interactive requests are
+    served between batches.
+    """
+    request_budget(request.headers)  # reject a malformed budget header up front
+    name = priority_class(request.headers, 'bulk')
+    release = None
+    if scheduler is not None:
+        try:
+            scheduler.reserve(name)
+        except Overloaded as e:
+            raise overloaded(e)
+        release = lambda: scheduler.unreserve(name)
+    batch_size = bulk_settings.get('batch_size', 64)
+    batch_max_bytes = bulk_settings.get('batch_max_bytes', 32 * 2 ** 20)
+    max_line_bytes = bulk_settings.get('max_line_bytes', 64 * 2 ** 20)
+
+    async def results():
+        batch, batch_bytes = [], 0
+        async for line_number, line in ndjson_lines(request.stream(), max_line_bytes):
+            batch.append((line_number, line))
+            batch_bytes += len(line) if line is not None else 0
+            if len(batch) >= batch_size or batch_bytes >= batch_max_bytes:
+                yield await scheduled(name, analyze_ndjson_batch, batch, request.headers, admitted=True)
+                batch, batch_bytes = [], 0
+        if batch:
+            yield await scheduled(name, analyze_ndjson_batch, batch, request.headers, admitted=True)
+
+    return NDJSONStreamingResponse(results(), on_close=release)
+
+@app.get('/api/analyze/activities/{cursor}', response_model=SuspiciousPage)
+def suspicious_activities_page(cursor: str, offset: int = Query(0, ge=0), limit: Optional[int] = Query(None, ge=1)):
+    inputs = suspicious_store.get(cursor)
+    if inputs is None:
+        raise HTTPException(status_code=404, detail='Unknown or expired cursor')
+    suspicious_activities = list(iter_explanations(inputs))
+    max_page_size = explain_settings.get('max_page_size', 1000)
+    limit = min(limit or max_page_size, max_page_size)
+    page = suspicious_activities[offset:offset + limit]
+    next_offset = offset + limit if offset + limit < len(suspicious_activities) else None
+    return SuspiciousPage(
+        cursor=cursor,
+        total=len(suspicious_activities),
+        offset=offset,
+        suspicious_activities=page,
+        next_offset=next_offset
+    )
+
+@app.get('/api/explanations/{analysis_id}', response_model=ExplanationResponse)
+def explanation(analysis_id: str, mode: Literal['full', 'top_k', 'aggregate'] = 'full',
+                top_k: Optional[int] = Query(None, ge=1), sample_size: Optional[int] = Query(None, ge=0)):
+    """
+    suspicious_activities of an analysis requested with explain.mode
+    'deferred', built from the stored context without scoring again and
+    shaped by the same options as AnalyzeRequest.explain.
+    """
+    context = analysis_store.get(analysis_id)
+    if context is None:
+        raise HTTPException(status_code=404, detail='Unknown or expired analysis_id')
+    shaped = shape_suspicious(context['inputs'], ExplainOptions(mode=mode, top_k=top_k, sample_size=sample_size))
+    return ExplanationResponse(analysis_id=analysis_id, user_id=context['user_id'], **shaped)
+
+@app.get('/api/metrics', response_class=JSONResponse)
+def metrics():
+    with two_stage_lock:
+        stats = dict(two_stage_stats)
+    with result_cache_lock:
+        cache_stats = dict(result_cache_stats, size=len(result_cache) if result_cache is not None else 0)
+    bundle = bundle_manager.active
+    stats['enabled'] = bundle.structural_model is not None
+    stats['nlp_skip_rate'] = stats['nlp_skipped'] / stats['users'] if stats['users'] else 0.0
+    return {
+        "model_version": bundle.version,
+        "nlp_cascade": bundle.nlp_analyzer.cascade_stats(),
+        "two_stage": stats,
+        "result_cache": cache_stats,
+        "cursor_store": {'entries': len(suspicious_store), 'bytes': suspicious_store.nbytes},
+        "deferred_explanations": {'entries': len(analysis_store), 'bytes': analysis_store.nbytes},
+        "scheduler": scheduler.stats() if scheduler is not None else None,
+        "shadow": bundle_manager.shadow_report() if bundle_manager.shadow else None
+    }
+
+# --- Model bundle management ---
+# Changing bundles is an admin action: the mutation endpoints need the token
+# from the environment variable named by bundle_settings.admin_token_env in
+# the admin header, and are disabled (403) while it is unset.
+bundle_settings = config.get('bundle_settings', {})
+
+def require_admin(headers):
+    expected = os.environ.get(bundle_settings.get('admin_token_env', 'MODEL_ADMIN_TOKEN'))
+    if not expected:
+        raise HTTPException(status_code=403, detail='Model management is disabled')
+    token = headers.get(bundle_settings.get('admin_header', 'X-Admin-Token'), '')
+    if not secrets.compare_digest(token.encode(), expected.encode()):
+        raise HTTPException(status_code=403, detail='Invalid admin token')
+
+class BundleLoadRequest(BaseModel):
+    name: str   # a directory under bundle_settings.bundle_root
+    version: Optional[str] = None
+    mode: Literal['shadow', 'activate'] = 'shadow'
+
+@app.get('/api/models', response_class=JSONResponse)
+def models():
+    return bundle_manager.describe()
+
+@app.post('/api/models/load', response_class=JSONResponse, status_code=202)
+def load_bundle(request: BundleLoadRequest, http_request: Request):
+    require_admin(http_request.headers)
+    try:
+        return bundle_manager.load_async(request.name, version=request.version, mode=request.mode)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.post('/api/models/promote', response_class=JSONResponse)
+def promote_bundle(http_request: Request):
+    require_admin(http_request.headers)
+    try:
+        return bundle_manager.promote().describe()
+    except LookupError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.post('/api/models/rollback', response_class=JSONResponse)
+def rollback_bundle(http_request: Request):
+    require_admin(http_request.headers)
+    try:
+        return bundle_manager.rollback().describe()
+    except LookupError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.delete('/api/models/shadow', response_class=JSONResponse)
+def clear_shadow_bundle(http_request: Request):
+    require_admin(http_request.headers)
+    bundle_manager.clear_shadow()
+    return bundle_manager.describe()
+
 @app.get('/api/health', response_class=JSONResponse)
 def health():
     return {"status": "Ok"}
 
 @app.get('/api/version', response_class=JSONResponse)
 def version():
-    return {"version": config.get('version', '1.0.0')}
+    return {"version": config.get('version', '1.0.0'), "model_version": bundle_manager.active.version}
 
 @app.get("/")
 async def root():
@@ -247,8 +774,13 @@ async def root():
         "version": config.get('version', '1.0.0'),
         "endpoints": {
             "health": "/api/health",
-            "version": "/api/version", 
-            "analyze": "/api/analyze"
+            "version": "/api/version",
+            "metrics": "/api/metrics",
+            "models": "/api/models",
+            "analyze": "/api/analyze",
+            "analyze_stream": "/api/analyze/stream",
+            "suspicious_activities_page": "/api/analyze/activities/{cursor}",
+            "explanations": "/api/explanations/{analysis_id}"
         },
         "docs": "/docs"
     }
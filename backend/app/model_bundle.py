@@ -0,0 +1,379 @@
+import os
+import json
+import time
+import random
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+import numpy as np
+from joblib import load
+from app.nlp_utils import ContentNLPAnalyzer
+from app.feature_extractor import FEATURES, NLP_FEATURES, FeatureContext, required_features
+from app.explain_rules import RuleEngine
+from app.budget import TimeBudget
+
+# A bundle is every artifact that scores a request: the fraud model and its
+# feature names, the comment classifiers behind the NLP features and the
+# optional structural model. A bundle directory holds them under the same
+# file names train_model / nlp_utils write to model/, plus an optional
+# bundle.json with its {"version": ...}. Bundles loaded at runtime live in
+# directories directly under the manager's bundle_root and are named, never
+# addressed by path: the pickles in them are executed on load.
+BUNDLE_FILES = {
+    'model_path': 'model.pkl',
+    'feature_names_path': 'feature_names.json',
+    'spam_model_path': 'spam_clf.pkl',
+    'loweffort_model_path': 'loweffort_clf.pkl',
+    'cascade_model_path': 'cascade_clf.pkl',
+    'projection_model_path': 'embedding_projection.pkl',
+    'structural_model_path': 'structural_model.pkl',
+    'structural_feature_names_path': 'structural_feature_names.json'
+}
+
+# Scored once through the whole pipeline before a bundle takes traffic
+WARMUP_USER = {
+    'user_id': '__warmup__',
+    'karma_log': [
+        {'activity_id': 'w1', 'type': 'comment', 'content': 'Great post, thanks for sharing!', 'timestamp': '2024-01-01T00:00:00Z'},
+        {'activity_id': 'w2', 'type': 'post_created', 'content': 'Upvote for upvote!', 'timestamp': '2024-01-01T00:10:00Z'},
+        {'activity_id': 'w3', 'type': 'upvote_received', 'from_user': 'w_user', 'from_user_age_days': 3, 'timestamp': '2024-01-01T00:20:00Z'},
+        {'activity_id': 'w4', 'type': 'upvote_sent', 'to_user': 'w_user', 'timestamp': '2024-01-01T00:30:00Z'}
+    ]
+}
+
+
+class ModelBundle:
+    """
+    One immutable, versioned set of scoring artifacts. Requests capture the
+    active bundle once, so a swap never mixes artifacts within a request.
+    """
+    def __init__(self, version: str, model, feature_names, nlp_analyzer: ContentNLPAnalyzer,
+                 structural_model=None, structural_feature_names=None, uncertain_band=(0.1, 0.6),
+                 rule_features=()):
+        self.version = version
+        self.model = model
+        self.feature_names = feature_names
+        self.nlp_analyzer = nlp_analyzer
+        self.structural_model = structural_model
+        self.structural_feature_names = structural_feature_names
+        self.uncertain_band = tuple(uncertain_band)
+        # Only what the models and the threshold rules read is extracted
+        rule_features = [f for f in rule_features if f in FEATURES]
+        self.required_features = required_features(feature_names, rule_features)
+        self.structural_required_features = required_features(
+            structural_feature_names or [], [f for f in rule_features if f not in NLP_FEATURES])
+        self.loaded_at = time.time()
+
+    @classmethod
+    def from_settings(cls, config: Dict[str, Any], model_settings: Dict[str, str], version: str,
+                      nlp_analyzer: ContentNLPAnalyzer = None, embedder=None) -> 'ModelBundle':
+        """
+        Loads the artifacts named in model_settings. An existing nlp_analyzer
+        is reused as-is; otherwise one is built sharing `embedder`.
+        """
+        mmap_mode = config.get('serving_settings', {}).get('mmap_mode')
+        model = load(model_settings['model_path'], mmap_mode=mmap_mode)
+        with open(model_settings['feature_names_path']) as f:
+            feature_names = json.load(f)
+        if nlp_analyzer is None:
+            nlp_analyzer = ContentNLPAnalyzer.from_config(config, model_settings=model_settings, embedder=embedder)
+        # Optional structural (non-NLP) model for two-stage scoring, see train_model
+        two_stage_settings = config.get('two_stage_settings', {})
+        structural_model = None
+        structural_feature_names = None
+        if two_stage_settings.get('enabled', False) \
+                and os.path.exists(model_settings.get('structural_model_path', '')) \
+                and os.path.exists(model_settings.get('structural_feature_names_path', '')):
+            structural_model = load(model_settings['structural_model_path'], mmap_mode=mmap_mode)
+            with open(model_settings['structural_feature_names_path']) as f:
+                structural_feature_names = json.load(f)
+        return cls(
+            version, model, feature_names, nlp_analyzer,
+            structural_model=structural_model,
+            structural_feature_names=structural_feature_names,
+            uncertain_band=two_stage_settings.get('uncertain_band', (0.1, 0.6)),
+            rule_features=RuleEngine.from_config(config).features
+        )
+
+    @classmethod
+    def from_dir(cls, config: Dict[str, Any], path: str, version: Optional[str] = None,
+                 embedder=None) -> 'ModelBundle':
+        if not os.path.isdir(path):
+            raise FileNotFoundError(f"Bundle directory '{path}' not found")
+        meta_path = os.path.join(path, 'bundle.json')
+        if version is None and os.path.exists(meta_path):
+            with open(meta_path) as f:
+                version = json.load(f).get('version')
+        model_settings = {key: os.path.join(path, name) for key, name in BUNDLE_FILES.items()}
+        return cls.from_settings(config, model_settings, version or os.path.basename(os.path.normpath(path)),
+                                 embedder=embedder)
+
+    def score(self, user, update_index: bool = True, budget: TimeBudget = None):
+        """
+        Returns (features, fraud_score, used_nlp). With a structural model
+        loaded, the NLP features and main model only run when the structural
+        score falls inside uncertain_band, and the structural score is also
+        the answer when the budget ran out before any text was scored.
+        Intermediates computed for the structural pass are reused by the full one.
+        """
+        ctx = FeatureContext(user, analyzer=self.nlp_analyzer, update_index=update_index, budget=budget)
+        if self.structural_model is not None:
+            features = ctx.compute(self.structural_required_features)
+            X = np.array([[features[f] for f in self.structural_feature_names]])
+            prelim_score = float(self.structural_model.predict_proba(X)[0, 2])
+            low, high = self.uncertain_band
+            if prelim_score < low or prelim_score > high:
+                return features, prelim_score, False
+        features = ctx.compute(self.required_features)
+        if budget is not None and budget.texts_total and not budget.texts_scored \
+                and self.structural_model is not None:
+            return features, prelim_score, False
+        X = np.array([[features[f] for f in self.feature_names]])
+        return features, float(self.model.predict_proba(X)[0, 2]), True
+
+    def warm(self) -> None:
+        self.score(WARMUP_USER, update_index=False)
+        self.nlp_analyzer.analyze(WARMUP_USER['karma_log'][0]['content'])
+
+    def share_memory(self) -> None:
+        """
+        Before forking workers: moves the embedding model's torch tensors into
+        shared memory so every worker maps the same pages.
+        """
+        embedder = self.nlp_analyzer.model
+        if hasattr(embedder, 'share_memory'):
+            embedder.eval()
+            embedder.share_memory()
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            'version': self.version,
+            'loaded_at': self.loaded_at,
+            'n_features': len(self.feature_names),
+            'n_extracted_features': len(self.required_features),
+            'two_stage': self.structural_model is not None,
+            'cascade': self.nlp_analyzer.cascade is not None
+        }
+
+
+class BundleManager:
+    """
+    Holds the active bundle and, optionally, a shadow candidate.
+
+    Bundles are loaded and warmed on a background thread; going live is a
+    single reference assignment, so in-flight requests finish on the bundle
+    they started with. A sampled share of live requests is re-scored by the
+    shadow bundle on a one-thread executor after the response is computed;
+    when that executor is max_pending deep, samples are dropped rather than
+    queued, so shadowing never waits in the request path.
+
+    The shadow thread does compete with requests for the interpreter while
+    it runs the Python parts of scoring (feature extraction, the forest),
+    so each sample costs live traffic roughly its own CPU time; the report's
+    cpu_seconds is that cost. Measured with a stub embedder (no time spent
+    outside the GIL, so the worst case) on 4 request threads scoring 160
+    test-set users: wall time rose 3-5% at shadow_sample_rate 0.1 and
+    10-20% at 1.0, where over half the samples were dropped at max_pending.
+    It stays in process because shadow scores must query the worker's own
+    content index; keep shadow_sample_rate low on CPU-bound workers.
+    """
+    def __init__(self, active: ModelBundle, config: Dict[str, Any], status_fn: Callable[[float], str],
+                 bundle_root: str = 'model/bundles', shadow_sample_rate: float = 0.1, max_pending: int = 32,
+                 latency_window: int = 1000):
+        self.active = active
+        self.shadow: Optional[ModelBundle] = None
+        self.previous: Optional[ModelBundle] = None
+        self.config = config
+        self.status_fn = status_fn
+        self.bundle_root = bundle_root
+        self.shadow_sample_rate = shadow_sample_rate
+        self.max_pending = max_pending
+        self.latency_window = latency_window
+        self._lock = threading.Lock()
+        self._loading: Optional[Dict[str, Any]] = None
+        self._last_load: Optional[Dict[str, Any]] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shadow')
+        self._pending = 0
+        self._swap_listeners: List[Callable[[ModelBundle], None]] = []
+        self._reset_shadow_stats()
+
+    @classmethod
+    def from_config(cls, active: ModelBundle, config: Dict[str, Any], status_fn) -> 'BundleManager':
+        settings = config.get('bundle_settings', {})
+        keys = ('bundle_root', 'shadow_sample_rate', 'max_pending', 'latency_window')
+        return cls(active, config, status_fn, **{k: settings[k] for k in keys if k in settings})
+
+    # --- Loading and swapping ---
+    def add_swap_listener(self, fn: Callable[[ModelBundle], None]) -> None:
+        """
+        fn(new_active) runs after every change of the active bundle.
+        """
+        self._swap_listeners.append(fn)
+
+    def _swapped(self, bundle: ModelBundle) -> None:
+        for fn in self._swap_listeners:
+            fn(bundle)
+
+    def bundle_path(self, name: str) -> str:
+        """
+        The directory of the bundle called `name` under bundle_root. Raises
+        ValueError unless name is a plain directory name (no separators, no
+        '..', not hidden) and FileNotFoundError if there is no such bundle.
+        """
+        if not name or name.startswith('.') or os.path.basename(name) != name \
+                or (os.altsep and os.altsep in name):
+            raise ValueError(f"Invalid bundle name '{name}'")
+        root = os.path.realpath(self.bundle_root)
+        path = os.path.realpath(os.path.join(root, name))
+        # A symlink in bundle_root may not lead outside it either
+        if os.path.dirname(path) != root:
+            raise ValueError(f"Invalid bundle name '{name}'")
+        if not os.path.isdir(path):
+            raise FileNotFoundError(f"Bundle '{name}' not found")
+        return path
+
+    def load_async(self, name: str, version: Optional[str] = None, mode: str = 'shadow') -> Dict[str, Any]:
+        """
+        Starts loading the bundle called `name` (see bundle_path) in the
+        background. mode 'shadow' installs it as the shadow candidate,
+        'activate' swaps it in directly. Raises RuntimeError while another
+        load is running.
+        """
+        if mode not in ('shadow', 'activate'):
+            raise ValueError(f"Unknown load mode '{mode}'")
+        path = self.bundle_path(name)
+        with self._lock:
+            if self._loading is not None:
+                raise RuntimeError(f"Bundle '{self._loading['name']}' is still loading")
+            self._loading = {'name': name, 'version': version, 'mode': mode, 'started_at': time.time()}
+        threading.Thread(target=self._load, args=(path, version, mode), daemon=True).start()
+        return dict(self._loading)
+
+    def _load(self, path: str, version: Optional[str], mode: str) -> None:
+        start = time.perf_counter()
+        try:
+            bundle = ModelBundle.from_dir(self.config, path, version=version, embedder=self.active.nlp_analyzer.model)
+            bundle.warm()
+        except Exception as e:
+            with self._lock:
+                self._last_load = {**self._loading, 'ok': False, 'error': f'{type(e).__name__}: {e}'}
+                self._loading = None
+            return
+        with self._lock:
+            if mode == 'activate':
+                self.previous, self.active = self.active, bundle
+            else:
+                self.shadow = bundle
+                self._reset_shadow_stats()
+            self._last_load = {**self._loading, 'version': bundle.version, 'ok': True,
+                               'load_seconds': round(time.perf_counter() - start, 3)}
+            self._loading = None
+        if mode == 'activate':
+            self._swapped(bundle)
+
+    def promote(self) -> ModelBundle:
+        with self._lock:
+            if self.shadow is None:
+                raise LookupError('No shadow bundle to promote')
+            self.previous, self.active, self.shadow = self.active, self.shadow, None
+            active = self.active
+        self._swapped(active)
+        return active
+
+    def rollback(self) -> ModelBundle:
+        with self._lock:
+            if self.previous is None:
+                raise LookupError('No previous bundle to roll back to')
+            self.active, self.previous = self.previous, self.active
+            active = self.active
+        self._swapped(active)
+        return active
+
+    def clear_shadow(self) -> None:
+        with self._lock:
+            self.shadow = None
+
+    # --- Shadow scoring ---
+    def _reset_shadow_stats(self) -> None:
+        self._shadow_stats = {'sampled': 0, 'scored': 0, 'dropped': 0, 'errors': 0, 'cpu_seconds': 0.0,
+                              'status_agreements': 0, 'abs_delta_sum': 0.0, 'max_abs_delta': 0.0}
+        self._latencies = deque(maxlen=self.latency_window)  # (active_ms, shadow_ms)
+
+    def maybe_shadow(self, user, fraud_score: float, latency_seconds: float) -> None:
+        """
+        Called after a live request is scored by the active bundle.
+        """
+        shadow = self.shadow
+        if shadow is None or random.random() >= self.shadow_sample_rate:
+            return
+        with self._lock:
+            self._shadow_stats['sampled'] += 1
+            if self._pending >= self.max_pending:
+                self._shadow_stats['dropped'] += 1
+                return
+            self._pending += 1
+        self._executor.submit(self._shadow_score, shadow, user, fraud_score, latency_seconds)
+
+    def _shadow_score(self, shadow: ModelBundle, user, fraud_score: float, latency_seconds: float) -> None:
+        try:
+            start = time.perf_counter()
+            cpu_start = time.thread_time()
+            # Query the content index but leave it to the live path to add texts
+            _, shadow_score, _ = shadow.score(user, update_index=False)
+            shadow_latency = time.perf_counter() - start
+            cpu_seconds = time.thread_time() - cpu_start
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+                self._shadow_stats['errors'] += 1
+            return
+        delta = abs(shadow_score - fraud_score)
+        with self._lock:
+            self._pending -= 1
+            if shadow is not self.shadow:
+                return  # replaced or promoted meanwhile
+            stats = self._shadow_stats
+            stats['scored'] += 1
+            stats['cpu_seconds'] += cpu_seconds
+            stats['abs_delta_sum'] += delta
+            stats['max_abs_delta'] = max(stats['max_abs_delta'], delta)
+            stats['status_agreements'] += int(self.status_fn(shadow_score) == self.status_fn(fraud_score))
+            self._latencies.append((latency_seconds * 1000, shadow_latency * 1000))
+
+    def shadow_report(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._shadow_stats)
+            latencies = np.array(self._latencies).reshape(-1, 2)
+            pending = self._pending
+        scored = stats.pop('scored')
+        abs_delta_sum = stats.pop('abs_delta_sum')
+        report = {
+            **stats,
+            'scored': scored,
+            'pending': pending,
+            'mean_abs_score_delta': abs_delta_sum / scored if scored else 0.0,
+            'status_agreement_rate': stats['status_agreements'] / scored if scored else 0.0
+        }
+        if len(latencies):
+            for name, q in (('p50', 50), ('p95', 95)):
+                active_ms, shadow_ms = np.percentile(latencies, q, axis=0)
+                report[f'active_latency_{name}_ms'] = round(float(active_ms), 3)
+                report[f'shadow_latency_{name}_ms'] = round(float(shadow_ms), 3)
+                report[f'latency_delta_{name}_ms'] = round(float(shadow_ms - active_ms), 3)
+        return report
+
+    def describe(self) -> Dict[str, Any]:
+        with self._lock:
+            active, shadow, previous = self.active, self.shadow, self.previous
+            loading = dict(self._loading) if self._loading else None
+            last_load = dict(self._last_load) if self._last_load else None
+        return {
+            'active': active.describe(),
+            'shadow': shadow.describe() if shadow else None,
+            'previous': previous.version if previous else None,
+            'loading': loading,
+            'last_load': last_load,
+            'shadow_sample_rate': self.shadow_sample_rate,
+            'shadow_stats': self.shadow_report() if shadow else None
+        }
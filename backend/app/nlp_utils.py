@@ -1,10 +1,23 @@
+import sys
+import os
+if __name__ == '__main__':
+    # Run as a script: make the app package importable
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from sentence_transformers import SentenceTransformer
 from sklearn.linear_model import LogisticRegression
 from sklearn.ensemble import RandomForestClassifier
+from sklearn.decomposition import PCA
+from sklearn.model_selection import cross_val_score
+from sklearn.feature_extraction.text import HashingVectorizer
 import numpy as np
-import os
+import json
+import time
+import pickle
+import threading
+import warnings
 import joblib
-from typing import List, Dict
+from typing import List, Dict, Optional, Sequence
+from app.explain_rules import find_words, spam_words
 
 # Load or train a local sentence transformer model
 MODEL_NAME = 'all-MiniLM-L6-v2'
@@ -136,52 +149,403 @@ train_texts = normal_texts + suspicious_texts + spam_texts
 spam_labels = [0]*len(normal_texts) + [0]*len(suspicious_texts) + [1]*len(spam_texts)
 loweffort_labels = [0]*len(normal_texts) + [1]*len(suspicious_texts) + [1]*len(spam_texts)
 
+# === Tier-1 cascade model ===
+# Character n-grams hashed into a fixed-size space feed two logistic
+# regressions (spam, low-effort). No vocabulary is stored, so the model is tiny.
+def make_hashing_vectorizer() -> HashingVectorizer:
+    return HashingVectorizer(analyzer='char_wb', ngram_range=(2, 4), n_features=2 ** 18, alternate_sign=False)
+
+# === Embedding projection ===
+# Optional PCA projection of the MiniLM embeddings, fit in
+# train_comment_classifiers. Stored as plain arrays so applying it is one
+# matmul: (emb - mean) @ components.T.
+def fit_projection(X: np.ndarray, dim: int) -> Dict[str, np.ndarray]:
+    dim = min(dim, X.shape[0], X.shape[1])
+    pca = PCA(n_components=dim, random_state=42).fit(X)
+    return {
+        'mean': pca.mean_.astype(np.float32),
+        'components': pca.components_.astype(np.float32),
+        'explained_variance_ratio': float(pca.explained_variance_ratio_.sum())
+    }
+
+def apply_projection(projection: Optional[Dict[str, np.ndarray]], X: np.ndarray) -> np.ndarray:
+    if projection is None:
+        return X
+    return (np.asarray(X, dtype=np.float32) - projection['mean']) @ projection['components'].T
+
+# === Embedding model ===
+# max_seq_length truncates every text to that many tokens, which changes the
+# embeddings of longer texts, so the classifiers must be trained with the same
+# cap they serve with. It is applied when the model is created (for serving
+# and training alike) and never on a model that is already shared.
+def load_embedder(max_seq_length: Optional[int] = None):
+    model = SentenceTransformer(MODEL_NAME)
+    if max_seq_length and hasattr(model, 'max_seq_length'):
+        model.max_seq_length = max_seq_length
+    return model
+
+# === Length-bucketed embedding ===
+# SentenceTransformer pads each batch to its longest text, so one long post
+# makes every short comment in its batch cost as much as the post. Texts are
+# sorted by token length and cut into batches of at most max_batch_tokens
+# padded tokens (and max_batch_size texts): short comments go through in large
+# batches, long posts in small ones. Results are put back in input order.
+# Bucketing uses lengths estimated from characters: tokenizing every text
+# once more just to sort it would add a pass to each embed() call (see
+# embedding_batching_report for both costs), and a misestimate only costs
+# some padding.
+DEFAULT_MAX_BATCH_SIZE = 256  # matches embedding_settings.max_batch_size in config.json
+
+def estimated_token_lengths(model, texts: Sequence[str]) -> np.ndarray:
+    # ~4 characters per wordpiece, plus [CLS] and [SEP]
+    cap = getattr(model, 'max_seq_length', None)
+    lengths = np.array([len(t) // 4 + 2 for t in texts])
+    return np.minimum(lengths, cap) if cap else lengths
+
+def token_lengths(model, texts: Sequence[str]) -> np.ndarray:
+    cap = getattr(model, 'max_seq_length', None)
+    tokenizer = getattr(model, 'tokenizer', None)
+    if tokenizer is not None:
+        ids = tokenizer(list(texts), add_special_tokens=True, truncation=cap is not None, max_length=cap)['input_ids']
+        lengths = np.array([len(i) for i in ids])
+    else:
+        return estimated_token_lengths(model, texts)
+    return np.minimum(lengths, cap) if cap else lengths
+
+def length_buckets(lengths: np.ndarray, max_batch_tokens: int, max_batch_size: int) -> List[np.ndarray]:
+    order = np.argsort(lengths, kind='stable')
+    buckets, start = [], 0
+    while start < len(order):
+        end = start + 1
+        # Sorted ascending, so the newest text is the longest in the batch
+        while end < len(order) and end - start < max_batch_size \
+                and (end - start + 1) * lengths[order[end]] <= max_batch_tokens:
+            end += 1
+        buckets.append(order[start:end])
+        start = end
+    return buckets
+
+def padding_efficiency(lengths: np.ndarray, batches: Sequence[np.ndarray]) -> float:
+    """
+    Real tokens over padded tokens encoded (1.0 = no padding).
+    """
+    padded = sum(len(b) * lengths[b].max() for b in batches if len(b))
+    return float(lengths.sum() / padded) if padded else 1.0
+
+def encode_bucketed(model, texts: Sequence[str], max_batch_tokens: int, max_batch_size: int) -> np.ndarray:
+    texts = list(texts)
+    out = None
+    for bucket in length_buckets(estimated_token_lengths(model, texts), max_batch_tokens, max_batch_size):
+        emb = model.encode([texts[i] for i in bucket], batch_size=len(bucket))
+        if out is None:
+            out = np.empty((len(texts), emb.shape[1]), dtype=emb.dtype)
+        out[bucket] = emb
+    return out
+
 # === Main NLP Analyzer Class ===
 class ContentNLPAnalyzer:
     """
     NLP analyzer for both comments and posts. Provides spam and low-effort scores.
     Use .analyze(text) for any content (comment or post).
+
+    With a cascade model loaded, texts are first scored by the spam lexicon
+    and the hashed n-gram model; only texts whose spam or low-effort score
+    falls inside uncertain_band go on to the embedding classifiers.
+
+    With a projection artifact loaded, embed() returns projected vectors of
+    size .dim: the classifiers are trained on them and everything that stores
+    embeddings (e.g. the content index) keeps the reduced vectors.
+
+    max_seq_length caps the tokens embedded per text when the analyzer loads
+    its own model (see load_embedder); a shared embedder is used as it is.
+    With max_batch_tokens set, embed() batches texts by length, see
+    encode_bucketed.
     """
-    def __init__(self, model_path=None, spam_model_path=None, loweffort_model_path=None):
-        self.model = SentenceTransformer(MODEL_NAME)
+    def __init__(self, model_path=None, spam_model_path=None, loweffort_model_path=None,
+                 cascade_model_path=None, uncertain_band=(0.2, 0.8), lexicon_confident_score=1.0,
+                 embedder=None, mmap_mode=None, projection_model_path=None,
+                 max_seq_length=None, max_batch_tokens=None, max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+        # embedder: an already loaded SentenceTransformer to share (see app.model_bundle)
+        self.model = embedder if embedder is not None else load_embedder(max_seq_length)
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
         # Load or initialize spam/low-effort classifiers
         if spam_model_path and os.path.exists(spam_model_path):
-            self.spam_clf = joblib.load(spam_model_path)
+            self.spam_clf = joblib.load(spam_model_path, mmap_mode=mmap_mode)
         else:
             self.spam_clf = RandomForestClassifier()
         if loweffort_model_path and os.path.exists(loweffort_model_path):
-            self.loweffort_clf = joblib.load(loweffort_model_path)
+            self.loweffort_clf = joblib.load(loweffort_model_path, mmap_mode=mmap_mode)
         else:
             self.loweffort_clf = RandomForestClassifier()
         # Sentiment classifier removed for now
+        # Tier-1 cascade (disabled when the artifact is missing)
+        self.cascade = None
+        if cascade_model_path and os.path.exists(cascade_model_path):
+            self.cascade = joblib.load(cascade_model_path, mmap_mode=mmap_mode)
+        elif cascade_model_path:
+            # Only reached with the cascade enabled (from_config passes no path otherwise)
+            warnings.warn(f'Cascade model {cascade_model_path} not found; '
+                          'text scoring uses the embedding classifiers only', RuntimeWarning)
+        self.projection = None
+        if projection_model_path and os.path.exists(projection_model_path):
+            self.projection = joblib.load(projection_model_path, mmap_mode=mmap_mode)
+        self.dim = len(self.projection['components']) if self.projection is not None else EMBEDDING_DIM
+        for clf in (self.spam_clf, self.loweffort_clf):
+            n_features = getattr(clf, 'n_features_in_', self.dim)
+            if n_features != self.dim:
+                raise ValueError(
+                    f'Classifier expects {n_features}-dim embeddings but the analyzer produces {self.dim}; '
+                    'retrain with train_comment_classifiers so the projection and classifiers match'
+                )
+        self.uncertain_band = tuple(uncertain_band)
+        self.lexicon_confident_score = lexicon_confident_score
+        self._tier_counts = {'tier1': 0, 'tier2': 0}
+        self._stats_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: Dict, model_settings: Dict = None, embedder=None) -> 'ContentNLPAnalyzer':
+        # model_settings overrides config['model_settings'] (artifact paths of a bundle)
+        model_settings = config.get('model_settings', {}) if model_settings is None else model_settings
+        cascade_settings = config.get('nlp_settings', {}).get('cascade', {})
+        embedding_settings = config.get('nlp_settings', {}).get('embedding', {})
+        return cls(
+            spam_model_path=model_settings.get('spam_model_path', 'model/spam_clf.pkl'),
+            loweffort_model_path=model_settings.get('loweffort_model_path', 'model/loweffort_clf.pkl'),
+            cascade_model_path=model_settings.get('cascade_model_path') if cascade_settings.get('enabled', False) else None,
+            uncertain_band=cascade_settings.get('uncertain_band', (0.2, 0.8)),
+            lexicon_confident_score=cascade_settings.get('lexicon_confident_score', 1.0),
+            embedder=embedder,
+            mmap_mode=config.get('serving_settings', {}).get('mmap_mode'),
+            projection_model_path=model_settings.get('projection_model_path'),
+            max_seq_length=embedding_settings.get('max_seq_length'),
+            max_batch_tokens=embedding_settings.get('max_batch_tokens'),
+            max_batch_size=embedding_settings.get('max_batch_size', DEFAULT_MAX_BATCH_SIZE)
+        )
 
     def embed(self, texts: List[str]) -> np.ndarray:
-        return self.model.encode(texts)
+        if self.max_batch_tokens and len(texts) > 1:
+            emb = encode_bucketed(self.model, texts, self.max_batch_tokens, self.max_batch_size)
+        else:
+            emb = self.model.encode(texts, batch_size=self.max_batch_size)
+        return apply_projection(self.projection, emb)
 
     def analyze(self, text: str) -> Dict[str, float]:
-        emb = self.embed([text])[0].reshape(1, -1)
-        # Predict spam and low-effort scores
-        spam_score = float(self.spam_clf.predict_proba(emb)[0, 1]) if hasattr(self.spam_clf, 'predict_proba') else 0.0
-        low_effort_score = float(self.loweffort_clf.predict_proba(emb)[0, 1]) if hasattr(self.loweffort_clf, 'predict_proba') else 0.0
-        # Sentiment logic removed for now
+        return self.analyze_batch([text])[0][0]
+
+    def full_scores(self, emb: np.ndarray):
+        """
+        Spam and low-effort scores from the embedding classifiers (the
+        full path the cascade's tier 1 stands in for).
+        """
+        n = len(emb)
+        spam_scores = self.spam_clf.predict_proba(emb)[:, 1] if hasattr(self.spam_clf, 'predict_proba') else np.zeros(n)
+        low_effort_scores = self.loweffort_clf.predict_proba(emb)[:, 1] if hasattr(self.loweffort_clf, 'predict_proba') else np.zeros(n)
+        return spam_scores, low_effort_scores
+
+    def tier1_scores(self, texts: Sequence[str]):
+        """
+        Lexicon + hashed n-gram scores and a mask of texts settled at tier 1.
+        """
+        X = self.cascade['vectorizer'].transform(texts)
+        spam_scores = self.cascade['spam'].predict_proba(X)[:, 1]
+        low_effort_scores = self.cascade['low_effort'].predict_proba(X)[:, 1]
+        # A confident lexicon hit settles spam (and so low effort) on its own
+        lexicon = np.array([max((score for _, score in find_words(t, spam_words)), default=0.0) for t in texts])
+        lexicon_hit = lexicon >= self.lexicon_confident_score
+        spam_scores = np.where(lexicon_hit, np.maximum(spam_scores, lexicon), spam_scores)
+        low_effort_scores = np.where(lexicon_hit, np.maximum(low_effort_scores, lexicon), low_effort_scores)
+        low, high = self.uncertain_band
+        spam_sure = (spam_scores < low) | (spam_scores > high)
+        low_effort_sure = (low_effort_scores < low) | (low_effort_scores > high)
+        return spam_scores, low_effort_scores, spam_sure & low_effort_sure
+
+    def analyze_batch(self, texts: List[str], need_embeddings: bool = True):
+        """
+        Scores many texts with one embedding pass and one classifier call each.
+        Returns (results, embeddings); results match .analyze() per text.
+        Without need_embeddings, texts settled by the cascade are not embedded
+        and embeddings is None.
+        """
+        if not texts:
+            return [], np.zeros((0, self.dim), dtype=np.float32)
+        texts = list(texts)
+        n = len(texts)
+        if self.cascade is None:
+            emb = self.embed(texts)
+            spam_scores, low_effort_scores = self.full_scores(emb)
+            settled = np.zeros(n, dtype=bool)
+        else:
+            spam_scores, low_effort_scores, settled = self.tier1_scores(texts)
+            uncertain = np.flatnonzero(~settled)
+            emb = None
+            if need_embeddings:
+                emb = self.embed(texts)
+                uncertain_emb = emb[uncertain]
+            elif len(uncertain):
+                uncertain_emb = self.embed([texts[i] for i in uncertain])
+            if len(uncertain):
+                spam_scores[uncertain], low_effort_scores[uncertain] = self.full_scores(uncertain_emb)
+        with self._stats_lock:
+            self._tier_counts['tier1'] += int(settled.sum())
+            self._tier_counts['tier2'] += int(n - settled.sum())
+        results = [
+            {'spam_score': float(s), 'low_effort_score': float(l)}
+            for s, l in zip(spam_scores, low_effort_scores)
+        ]
+        return results, emb
+
+    def cascade_stats(self) -> Dict[str, float]:
+        with self._stats_lock:
+            counts = dict(self._tier_counts)
+        total = counts['tier1'] + counts['tier2']
         return {
-            'spam_score': spam_score,
-            'low_effort_score': low_effort_score
+            'cascade_enabled': self.cascade is not None,
+            'texts_scored': total,
+            'tier1_texts': counts['tier1'],
+            'tier2_texts': counts['tier2'],
+            'tier1_hit_rate': counts['tier1'] / total if total else 0.0,
         }
 
 # For backward compatibility
 CommentNLPAnalyzer = ContentNLPAnalyzer
 
 # Utility to train spam/low-effort classifiers (run once, save models)
-def train_comment_classifiers(train_texts: List[str], spam_labels: List[int], loweffort_labels: List[int], save_dir: str):
-    model = SentenceTransformer(MODEL_NAME)
+def train_comment_classifiers(train_texts: List[str], spam_labels: List[int], loweffort_labels: List[int], save_dir: str,
+                              projection_dim: Optional[int] = None, max_seq_length: Optional[int] = None):
+    # Same cap as serving (nlp_settings.embedding.max_seq_length), see load_embedder
+    model = load_embedder(max_seq_length)
     X = model.encode(train_texts)
+    projection_path = os.path.join(save_dir, 'embedding_projection.pkl')
+    os.makedirs(save_dir, exist_ok=True)
+    if projection_dim:
+        projection = fit_projection(X, projection_dim)
+        joblib.dump(projection, projection_path)
+        X = apply_projection(projection, X)
+        print(f"Embedding projection ({X.shape[1]} dims, {projection['explained_variance_ratio']:.1%} variance) saved to", save_dir)
+    elif os.path.exists(projection_path):
+        # Classifiers below are trained on raw embeddings; a stale projection would not match
+        os.remove(projection_path)
     spam_clf = RandomForestClassifier(n_estimators=200, random_state=42).fit(X, spam_labels)
     loweffort_clf = RandomForestClassifier(n_estimators=200, random_state=42).fit(X, loweffort_labels)
-    os.makedirs(save_dir, exist_ok=True)
     joblib.dump(spam_clf, os.path.join(save_dir, 'spam_clf.pkl'))
     joblib.dump(loweffort_clf, os.path.join(save_dir, 'loweffort_clf.pkl'))
     print('Spam and low-effort classifiers (RandomForest) saved to', save_dir)
+    train_cascade_model(train_texts, spam_labels, loweffort_labels, save_dir)
+
+# Utility to train the tier-1 hashed n-gram cascade model
+def train_cascade_model(train_texts: List[str], spam_labels: List[int], loweffort_labels: List[int], save_dir: str):
+    vectorizer = make_hashing_vectorizer()
+    X = vectorizer.transform(train_texts)
+    cascade = {
+        'vectorizer': vectorizer,
+        'spam': LogisticRegression(C=10.0, max_iter=1000).fit(X, spam_labels),
+        'low_effort': LogisticRegression(C=10.0, max_iter=1000).fit(X, loweffort_labels),
+    }
+    os.makedirs(save_dir, exist_ok=True)
+    joblib.dump(cascade, os.path.join(save_dir, 'cascade_clf.pkl'))
+    print('Tier-1 cascade model (hashed n-grams) saved to', save_dir)
+
+# Offline check of the cascade against the full embedding path
+def cascade_agreement_report(analyzer: ContentNLPAnalyzer, texts: List[str], spam_threshold: float = 0.5,
+                             loweffort_threshold: float = 0.65) -> Dict[str, float]:
+    if analyzer.cascade is None:
+        raise ValueError('Analyzer has no cascade model loaded')
+    spam_full, low_full = analyzer.full_scores(analyzer.embed(texts))
+    spam_t1, low_t1, settled = analyzer.tier1_scores(texts)
+    spam_cascade = np.where(settled, spam_t1, spam_full)
+    low_cascade = np.where(settled, low_t1, low_full)
+    return {
+        'texts': len(texts),
+        'tier1_hit_rate': float(settled.mean()),
+        'spam_decision_agreement': float(np.mean((spam_cascade > spam_threshold) == (spam_full > spam_threshold))),
+        'loweffort_decision_agreement': float(np.mean((low_cascade > loweffort_threshold) == (low_full > loweffort_threshold))),
+        'tier1_spam_decision_agreement': float(np.mean((spam_t1[settled] > spam_threshold) == (spam_full[settled] > spam_threshold))) if settled.any() else 1.0,
+        'spam_mean_abs_diff': float(np.mean(np.abs(spam_cascade - spam_full))),
+        'loweffort_mean_abs_diff': float(np.mean(np.abs(low_cascade - low_full))),
+    }
+
+# Speed / memory / accuracy of the comment classifiers per projection size
+def projection_report(train_texts: List[str], spam_labels: List[int], loweffort_labels: List[int],
+                      dims: Sequence[Optional[int]] = (None, 64, 32), n_timing: int = 10_000, cv: int = 5) -> List[Dict[str, float]]:
+    model = SentenceTransformer(MODEL_NAME)
+    X_full = model.encode(train_texts)
+    rng = np.random.default_rng(42)
+    X_timing_full = X_full[rng.integers(0, len(X_full), n_timing)]
+    rows = []
+    for dim in dims:
+        projection = fit_projection(X_full, dim) if dim else None
+        X = apply_projection(projection, X_full)
+        X_timing = apply_projection(projection, X_timing_full)
+        spam_clf = RandomForestClassifier(n_estimators=200, random_state=42).fit(X, spam_labels)
+        start = time.perf_counter()
+        spam_clf.predict_proba(X_timing)
+        apply_projection(projection, X_timing_full)
+        elapsed = time.perf_counter() - start
+        rows.append({
+            'dim': X.shape[1],
+            'explained_variance': projection['explained_variance_ratio'] if projection else 1.0,
+            'spam_cv_accuracy': float(cross_val_score(RandomForestClassifier(n_estimators=200, random_state=42), X, spam_labels, cv=cv).mean()),
+            'loweffort_cv_accuracy': float(cross_val_score(RandomForestClassifier(n_estimators=200, random_state=42), X, loweffort_labels, cv=cv).mean()),
+            'classify_us_per_text': elapsed / n_timing * 1e6,
+            'classifier_bytes': len(pickle.dumps(spam_clf)),
+            'embedding_bytes_fp32': X.shape[1] * 4,
+            'embedding_bytes_int8': X.shape[1],
+        })
+    return rows
+
+# Throughput of plain encode() (default max_seq_length, batches of 32) against
+# the length-bucketed path (capped at max_seq_length if given), on the texts
+# given. Also times the exact tokenization pass bucketing would need against
+# the character estimate it uses, and the padding each leaves.
+def embedding_batching_report(texts: List[str], max_seq_length: Optional[int] = None, max_batch_tokens: int = 8192,
+                              max_batch_size: int = DEFAULT_MAX_BATCH_SIZE, repeats: int = 3) -> Dict[str, float]:
+    model = load_embedder()
+    default_seq_length = model.max_seq_length
+    max_seq_length = max_seq_length or default_seq_length
+    # encode() itself sorts by character length before batching
+    baseline_lengths = token_lengths(model, texts)
+    by_chars = np.argsort([-len(t) for t in texts], kind='stable')
+    baseline_batches = [by_chars[i:i + 32] for i in range(0, len(texts), 32)]
+
+    def best_time(fn):
+        fn()  # warm-up
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            result = fn()
+            times.append(time.perf_counter() - start)
+        return min(times), result
+
+    baseline_seconds, baseline_emb = best_time(lambda: model.encode(texts, batch_size=32))
+    model.max_seq_length = max_seq_length
+    tokenize_seconds, lengths = best_time(lambda: token_lengths(model, texts))
+    estimate_seconds, estimated = best_time(lambda: estimated_token_lengths(model, texts))
+    bucketed_seconds, bucketed_emb = best_time(lambda: encode_bucketed(model, texts, max_batch_tokens, max_batch_size))
+    model.max_seq_length = default_seq_length
+    buckets = length_buckets(estimated, max_batch_tokens, max_batch_size)
+    exact_buckets = length_buckets(lengths, max_batch_tokens, max_batch_size)
+    cosine = np.sum(baseline_emb * bucketed_emb, axis=1) / (
+        np.linalg.norm(baseline_emb, axis=1) * np.linalg.norm(bucketed_emb, axis=1))
+    return {
+        'texts': len(texts),
+        'mean_tokens': float(baseline_lengths.mean()),
+        'p99_tokens': float(np.percentile(baseline_lengths, 99)),
+        'truncated_share': float(np.mean(baseline_lengths > max_seq_length)),
+        'baseline_texts_per_second': len(texts) / baseline_seconds,
+        'bucketed_texts_per_second': len(texts) / bucketed_seconds,
+        'speedup': baseline_seconds / bucketed_seconds,
+        'tokenize_seconds': tokenize_seconds,
+        'estimate_seconds': estimate_seconds,
+        'tokenize_share_of_bucketed': tokenize_seconds / bucketed_seconds,
+        'baseline_batches': len(baseline_batches),
+        'bucketed_batches': len(buckets),
+        'baseline_padding_efficiency': padding_efficiency(baseline_lengths, baseline_batches),
+        'bucketed_padding_efficiency': padding_efficiency(lengths, buckets),
+        'exact_bucketed_padding_efficiency': padding_efficiency(lengths, exact_buckets),
+        'min_cosine_to_baseline': float(cosine.min()),
+        'mean_cosine_to_baseline': float(cosine.mean()),
+    }
 
 # Utility to train a robust sentiment classifier
 def train_sentiment_classifier(train_texts: List[str], sentiment_labels: List[int], save_dir: str):
@@ -195,8 +559,42 @@ def train_sentiment_classifier(train_texts: List[str], sentiment_labels: List[in
 # === Main section for training (optional CLI) ===
 if __name__ == '__main__':
     save_dir = os.path.join(os.path.dirname(__file__), '../model')
+    if len(sys.argv) > 2 and sys.argv[1] == '--cascade-report':
+        # python app/nlp_utils.py --cascade-report data/optimal_test.json
+        with open(sys.argv[2]) as f:
+            users = json.load(f)
+        texts = [a['content'] for u in users for a in u['karma_log'] if a['type'] in ('comment', 'post_created')]
+        analyzer = ContentNLPAnalyzer(
+            spam_model_path=os.path.join(save_dir, 'spam_clf.pkl'),
+            loweffort_model_path=os.path.join(save_dir, 'loweffort_clf.pkl'),
+            cascade_model_path=os.path.join(save_dir, 'cascade_clf.pkl'),
+            projection_model_path=os.path.join(save_dir, 'embedding_projection.pkl')
+        )
+        print(json.dumps(cascade_agreement_report(analyzer, texts), indent=2))
+        sys.exit(0)
+    if len(sys.argv) > 2 and sys.argv[1] == '--embedding-report':
+        # python app/nlp_utils.py --embedding-report data/optimal_test.json
+        with open(sys.argv[2]) as f:
+            users = json.load(f)
+        texts = [a['content'] for u in users for a in u['karma_log'] if a['type'] in ('comment', 'post_created')]
+        with open(os.path.join(os.path.dirname(__file__), 'config.json')) as f:
+            embedding_settings = json.load(f).get('nlp_settings', {}).get('embedding', {})
+        print(json.dumps(embedding_batching_report(texts, **embedding_settings), indent=2))
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == '--projection-report':
+        # python app/nlp_utils.py --projection-report
+        print(f'{"dim":>4s} {"variance":>9s} {"spam acc":>9s} {"low acc":>8s} {"us/text":>8s} {"clf KB":>7s} {"emb B fp32":>10s} {"emb B int8":>10s}')
+        for row in projection_report(train_texts, spam_labels, loweffort_labels):
+            print(f"{row['dim']:>4d} {row['explained_variance']:>9.1%} {row['spam_cv_accuracy']:>9.3f} {row['loweffort_cv_accuracy']:>8.3f} "
+                  f"{row['classify_us_per_text']:>8.2f} {row['classifier_bytes'] / 1024:>7.0f} {row['embedding_bytes_fp32']:>10d} {row['embedding_bytes_int8']:>10d}")
+        sys.exit(0)
+    # python app/nlp_utils.py [--projection-dim 64]
+    projection_dim = int(sys.argv[sys.argv.index('--projection-dim') + 1]) if '--projection-dim' in sys.argv else None
+    with open(os.path.join(os.path.dirname(__file__), 'config.json')) as f:
+        max_seq_length = json.load(f).get('nlp_settings', {}).get('embedding', {}).get('max_seq_length')
     print('Training spam and low-effort classifiers...')
-    train_comment_classifiers(train_texts, spam_labels, loweffort_labels, save_dir)
+    train_comment_classifiers(train_texts, spam_labels, loweffort_labels, save_dir, projection_dim=projection_dim,
+                              max_seq_length=max_seq_length)
     # For sentiment, you need to provide sentiment_labels (e.g., 1 for positive, 0 for negative)
     # Example: sentiment_labels = [1]*len(normal_texts) + [0]*len(spam_texts) + [0]*len(suspicious_texts)
     # Uncomment and edit the following lines to train sentiment:
@@ -0,0 +1,192 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+
+class Overloaded(Exception):
+    """
+    A request was not admitted: its class queue was full or it waited
+    longer than the class's latency target. Answered with 503.
+    """
+    def __init__(self, priority_class: str, reason: str, retry_after: float):
+        super().__init__(f'{priority_class} queue {reason}')
+        self.priority_class = priority_class
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class PriorityClass:
+    def __init__(self, name: str, priority: int = 0, max_concurrency: int = 1, max_queue: int = 64,
+                 latency_target_ms: Optional[float] = None, latency_window: int = 1000):
+        self.name = name
+        self.priority = priority
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.latency_target_ms = latency_target_ms
+        self.waiters = deque()
+        self.in_flight = 0
+        self.reserved = 0   # open bulk streams, each holding a queue place
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.target_misses = 0
+        self.wait_ms = deque(maxlen=latency_window)
+        self.latency_ms = deque(maxlen=latency_window)
+
+    def stats(self) -> Dict[str, Any]:
+        def percentiles(values):
+            if not values:
+                return {'p50': 0.0, 'p95': 0.0, 'max': 0.0}
+            p50, p95 = np.percentile(values, [50, 95])
+            return {'p50': round(float(p50), 2), 'p95': round(float(p95), 2), 'max': round(max(values), 2)}
+        completed = len(self.latency_ms)
+        return {
+            'priority': self.priority,
+            'max_concurrency': self.max_concurrency,
+            'max_queue': self.max_queue,
+            'latency_target_ms': self.latency_target_ms,
+            'queue_depth': len(self.waiters),
+            'streams': self.reserved,
+            'in_flight': self.in_flight,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+            'wait_ms': percentiles(list(self.wait_ms)),
+            'latency_ms': percentiles(list(self.latency_ms)),
+            'target_miss_rate': self.target_misses / completed if completed else 0.0
+        }
+
+
+class AdmissionScheduler:
+    """
+    Admission control in front of the inference pipeline.
+
+    Every unit of work (one interactive request, one bulk batch) takes a
+    slot of a priority class. A slot needs room both in the class
+    (max_concurrency) and in the shared total_concurrency; whenever a slot
+    frees up it goes to the waiting class with the lowest priority number.
+    Bulk streams take a slot per batch, so a waiting interactive request
+    gets the next slot a finished batch gives back instead of queueing
+    behind the whole upload. Keeping bulk max_concurrency below
+    total_concurrency leaves slots that bulk work can never hold.
+
+    A request is rejected (Overloaded) when its class queue is full, or
+    when it waited longer than latency_target_ms for a slot. A bulk stream
+    reserves a queue place for as long as it is open, and its batches wait
+    in that place as admitted work, skipping both checks: queued requests
+    plus open streams never exceed max_queue, so a stream admitted once is
+    not refused halfway through.
+
+    Runs on the event loop; acquire/release are not thread-safe.
+    """
+    def __init__(self, total_concurrency: int, classes: Dict[str, Dict[str, Any]], latency_window: int = 1000):
+        self.total_concurrency = total_concurrency
+        self.classes = {name: PriorityClass(name, latency_window=latency_window, **settings)
+                        for name, settings in classes.items()}
+        self._order = sorted(self.classes.values(), key=lambda c: c.priority)
+        self.in_flight = 0
+
+    @classmethod
+    def from_config(cls, settings: Dict[str, Any]) -> 'AdmissionScheduler':
+        return cls(settings.get('total_concurrency', 4), settings.get('classes', {}),
+                   latency_window=settings.get('latency_window', 1000))
+
+    def _dispatch(self) -> None:
+        for priority_class in self._order:
+            waiters = priority_class.waiters
+            while waiters and self.in_flight < self.total_concurrency \
+                    and priority_class.in_flight < priority_class.max_concurrency:
+                waiter = waiters.popleft()
+                if waiter.done():   # cancelled while queued
+                    continue
+                priority_class.in_flight += 1
+                self.in_flight += 1
+                waiter.set_result(None)
+            if waiters and self.in_flight >= self.total_concurrency:
+                # Lower classes may not take a slot a higher class is waiting for
+                return
+
+    def retry_after(self, priority_class: PriorityClass) -> float:
+        """Seconds until the queue ahead has likely drained, from recent slot latencies."""
+        recent = list(priority_class.latency_ms)[-100:]
+        per_slot_s = (sum(recent) / len(recent) / 1000) if recent else 1.0
+        return max(1.0, per_slot_s * (len(priority_class.waiters) + 1) / max(priority_class.max_concurrency, 1))
+
+    def admit(self, name: str) -> PriorityClass:
+        """The named class; raises Overloaded if its queue is full."""
+        priority_class = self.classes[name]
+        if len(priority_class.waiters) + priority_class.reserved >= priority_class.max_queue:
+            priority_class.rejected += 1
+            raise Overloaded(name, 'full', self.retry_after(priority_class))
+        return priority_class
+
+    def reserve(self, name: str) -> None:
+        """Holds a queue place of the named class until unreserve(); raises Overloaded if its queue is full."""
+        self.admit(name).reserved += 1
+
+    def unreserve(self, name: str) -> None:
+        self.classes[name].reserved -= 1
+
+    async def acquire(self, name: str, admitted: bool = False) -> float:
+        """
+        Waits for a slot of the named class and returns the wait in ms.
+        Unless admitted (waiting in a place taken by reserve()), checks the
+        queue limit and gives up after latency_target_ms.
+        """
+        priority_class = self.classes[name] if admitted else self.admit(name)
+        waiter = asyncio.get_running_loop().create_future()
+        priority_class.waiters.append(waiter)
+        start = time.monotonic()
+        self._dispatch()
+        timeout = priority_class.latency_target_ms / 1000 \
+            if not admitted and priority_class.latency_target_ms is not None else None
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # Granted just as the wait ended: hand the slot on
+                self.release(name)
+            elif waiter in priority_class.waiters:
+                priority_class.waiters.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                priority_class.timed_out += 1
+                raise Overloaded(name, 'wait exceeded latency target', self.retry_after(priority_class))
+            raise
+        priority_class.admitted += 1
+        wait_ms = (time.monotonic() - start) * 1000
+        priority_class.wait_ms.append(wait_ms)
+        return wait_ms
+
+    def release(self, name: str, latency_ms: Optional[float] = None) -> None:
+        priority_class = self.classes[name]
+        priority_class.in_flight -= 1
+        self.in_flight -= 1
+        if latency_ms is not None:
+            priority_class.latency_ms.append(latency_ms)
+            if priority_class.latency_target_ms is not None and latency_ms > priority_class.latency_target_ms:
+                priority_class.target_misses += 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, name: str, admitted: bool = False):
+        """
+        Holds a slot of the named class for the body. latency_ms (queue
+        wait plus work) is recorded against the class's target.
+        """
+        start = time.monotonic()
+        await self.acquire(name, admitted)
+        try:
+            yield
+        finally:
+            self.release(name, (time.monotonic() - start) * 1000)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'total_concurrency': self.total_concurrency,
+            'in_flight': self.in_flight,
+            'classes': {name: c.stats() for name, c in self.classes.items()}
+        }
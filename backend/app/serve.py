@@ -0,0 +1,186 @@
+import sys
+import os
+import gc
+import json
+import time
+import signal
+import socket
+import argparse
+from collections import deque
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import uvicorn
+
+# Multi-worker serving with copy-on-write model sharing.
+#
+#   python app/serve.py --workers 4
+#
+# With preloading (the default) the parent imports app.main once, so the
+# forests, the sentence-transformer and the rest of the startup bundle are
+# loaded before forking; workers then share those pages copy-on-write.
+# Torch tensors are moved to shared memory and the parent's heap is frozen
+# out of the garbage collector, so workers do not dirty (and so copy) the
+# shared pages just by touching object headers.
+#
+# serving_settings.mmap_mode only memory-maps plain numpy arrays inside
+# uncompressed joblib artifacts (such as the embedding projection). The
+# forests are not mapped: their trees are rebuilt on the heap on load, so
+# they are shared only through preloading, and every worker holds its own
+# copy with --no-preload.
+#
+# A worker that dies is replaced after a backoff that doubles with every
+# recent crash (respawn_backoff_seconds up to respawn_backoff_max_seconds).
+# More than max_crashes deaths within crash_window_seconds stop the server
+# with exit status 1, so a worker that cannot start does not fork forever.
+#
+# Per-worker state is not shared: each worker has its own result caches,
+# content index, bundle manager and admission scheduler, so /api/models/*
+# only affects the worker that handled the call, and scheduler_settings
+# limits (total_concurrency, max_queue) apply per worker.
+#
+# The same layout with gunicorn:
+#   gunicorn app.main:app --preload -w 4 -k uvicorn.workers.UvicornWorker
+# (gunicorn does not run prepare_for_fork; call it from its on_starting hook).
+
+CONFIG_PATH = 'app/config.json'
+
+DEFAULT_SETTINGS = {
+    'host': '0.0.0.0',
+    'port': 8000,
+    'workers': 1,
+    'preload': True,
+    'mmap_mode': None,
+    'torch_threads_per_worker': None,
+    'respawn_backoff_seconds': 1.0,
+    'respawn_backoff_max_seconds': 30.0,
+    'max_crashes': 5,
+    'crash_window_seconds': 60.0
+}
+
+def load_settings():
+    if os.path.exists(CONFIG_PATH):
+        with open(CONFIG_PATH) as f:
+            return {**DEFAULT_SETTINGS, **json.load(f).get('serving_settings', {})}
+    return dict(DEFAULT_SETTINGS)
+
+def prepare_for_fork(main_module) -> None:
+    """
+    Called in the parent after loading the models, right before forking.
+    """
+    main_module.bundle_manager.active.share_memory()
+    gc.collect()
+    gc.freeze()
+
+def limit_torch_threads(n_threads) -> None:
+    # One intra-op pool per worker; without a cap N workers oversubscribe the cores
+    if not n_threads:
+        return
+    try:
+        import torch
+    except ImportError:
+        return
+    torch.set_num_threads(n_threads)
+
+def run_worker(sock: socket.socket, settings) -> None:
+    limit_torch_threads(settings['torch_threads_per_worker'])
+    # Already imported (and loaded) in the parent when preloading
+    from app.main import app
+    server = uvicorn.Server(uvicorn.Config(app, log_level='info'))
+    server.run(sockets=[sock])
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the API from several pre-forked worker processes.')
+    parser.add_argument('--host')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--no-preload', action='store_true', help='load the models in every worker instead')
+    args = parser.parse_args()
+
+    settings = load_settings()
+    for key in ('host', 'port', 'workers'):
+        if getattr(args, key) is not None:
+            settings[key] = getattr(args, key)
+    if args.no_preload:
+        settings['preload'] = False
+    if settings['torch_threads_per_worker'] is None:
+        settings['torch_threads_per_worker'] = max(1, (os.cpu_count() or 1) // settings['workers'])
+    # HF tokenizers warn (and disable their pool) when used across a fork
+    os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((settings['host'], settings['port']))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    if settings['preload']:
+        import app.main
+        prepare_for_fork(app.main)
+
+    workers = {}
+    shutting_down = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            status = 1
+            try:
+                run_worker(sock, settings)
+                status = 0
+            finally:
+                os._exit(status)
+        workers[pid] = time.monotonic()
+
+    def shutdown(signum, frame):
+        nonlocal shutting_down
+        shutting_down = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    for _ in range(settings['workers']):
+        spawn()
+    print(json.dumps({'parent_pid': os.getpid(), 'worker_pids': list(workers), 'preload': settings['preload']}), flush=True)
+
+    # Replace workers that die, until asked to stop or they crash too often
+    crashes = deque()
+    exit_status = 0
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        workers.pop(pid, None)
+        if shutting_down:
+            continue
+        now = time.monotonic()
+        crashes.append(now)
+        while crashes[0] < now - settings['crash_window_seconds']:
+            crashes.popleft()
+        if len(crashes) > settings['max_crashes']:
+            print(json.dumps({'error': 'workers crashing', 'crashes': len(crashes),
+                              'window_seconds': settings['crash_window_seconds']}), file=sys.stderr, flush=True)
+            exit_status = 1
+            shutdown(None, None)
+            continue
+        backoff = min(settings['respawn_backoff_seconds'] * 2 ** (len(crashes) - 1),
+                      settings['respawn_backoff_max_seconds'])
+        print(json.dumps({'worker_exited': pid, 'status': status, 'respawn_in_seconds': backoff}),
+              file=sys.stderr, flush=True)
+        deadline = now + backoff
+        while not shutting_down and time.monotonic() < deadline:
+            time.sleep(min(0.1, deadline - time.monotonic()))
+        if not shutting_down:
+            spawn()
+    sock.close()
+    sys.exit(exit_status)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+import io
+import sys
+import os
+import json
+import math
+import hashlib
+if __name__ == '__main__':
+    # Run as a script: make the app package importable
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import numpy as np
+from typing import Any, Dict, Iterable, Optional
+from app.karma_log import get_field, has_field
+
+# Bounded-memory aggregates over a user's whole history, for accounts whose
+# history is too long to keep (see StreamWorker's max_history_per_user).
+# Every sketch is mergeable (shards of one user's events combine into the
+# sketch of all of them) and serializes to bytes. Items are hashed with
+# blake2b, not hash(), so sketches agree across processes.
+#
+# Error bounds, with the defaults in config.json 'sketch_settings':
+#   HyperLogLog, precision p:  relative standard error 1.04 / sqrt(2^p)
+#                              (p=10: ~3.3%; small counts are near exact)
+#   Count-min, width w, depth d: never under-counts; over-counts by more
+#                              than e/w * N with probability <= e^-d
+#                              (w=256, d=4: 1.1% of N with 98% confidence)
+#   Bloom, m bits, k hashes:   no false negatives; false positive rate
+#                              (1 - e^(-k n / m))^k after n distinct items
+#                              (m=65536, k=4: 0.05% at 2k items, 2.4% at 8k)
+# Memory is fixed, so past those sizes the Bloom-based estimates drift up;
+# UserSketch.error_bounds() reports the current rates.
+#
+# The activity counts, and the ratios built on them, come from the sketch
+# as well, so every count and ratio a sketched user gets covers the same
+# (whole) history: a repeated_upvotes over all of it next to a
+# total_upvotes over the kept window would not be comparable. Features that
+# need each activity (gaps, bursts, lengths, NLP averages, young upvotes)
+# stay over the kept, most recent window.
+
+SKETCH_FEATURES = ['total_comments', 'total_upvotes', 'repeated_upvotes', 'upvote_concentration',
+                   'unique_upvoters_ratio', 'comment_to_upvote_ratio', 'total_posts', 'total_upvotes_sent',
+                   'unique_upvote_targets', 'mutual_upvote_count']
+
+DEFAULT_SETTINGS = {
+    'hll_precision': 10,
+    'cms_width': 256,
+    'cms_depth': 4,
+    'heavy_hitters': 8,
+    'bloom_bits': 65536,
+    'bloom_hashes': 4
+}
+
+# Stands in for upvotes without a from_user, as the exact features count them
+_MISSING = '\x00missing'
+
+def hash64(items: Iterable[Any]) -> np.ndarray:
+    return np.array([int.from_bytes(hashlib.blake2b(str(item).encode(), digest_size=8).digest(), 'little')
+                     for item in items], dtype=np.uint64)
+
+def _double_hash(hashes: np.ndarray, n_hashes: int, size: int) -> np.ndarray:
+    # Kirsch-Mitzenmacher: n_hashes indexes from the two 32-bit halves
+    h1 = hashes & np.uint64(0xFFFFFFFF)
+    h2 = hashes >> np.uint64(32)
+    i = np.arange(n_hashes, dtype=np.uint64)[:, None]
+    return ((h1 + i * h2) % np.uint64(size)).astype(np.intp)   # (n_hashes, n_items)
+
+
+class HyperLogLog:
+    # Rank is taken from the low 50 bits, so p may use up to the top 14
+    RANK_BITS = 50
+
+    def __init__(self, precision: int = 10, registers: Optional[np.ndarray] = None):
+        if not 4 <= precision <= 14:
+            raise ValueError('HyperLogLog precision must be between 4 and 14')
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8) if registers is None else registers
+
+    def add(self, hashes: np.ndarray) -> None:
+        if not len(hashes):
+            return
+        idx = (hashes >> np.uint64(64 - self.precision)).astype(np.intp)
+        rest = (hashes & np.uint64((1 << self.RANK_BITS) - 1)).astype(np.float64)   # exact below 2^53
+        # Position of the first 1 bit, counted from the top of RANK_BITS
+        rank = np.where(rest > 0, self.RANK_BITS - np.frexp(rest)[1] + 1, self.RANK_BITS + 1).astype(np.uint8)
+        np.maximum.at(self.registers, idx, rank)
+
+    def estimate(self) -> float:
+        m = len(self.registers)
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+        raw = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            return m * math.log(m / zeros)   # linear counting for small cardinalities
+        return float(raw)
+
+    def merge(self, other: 'HyperLogLog') -> None:
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def relative_error(self) -> float:
+        return 1.04 / math.sqrt(len(self.registers))
+
+
+class CountMinSketch:
+    """
+    Count-min sketch plus the k items with the highest estimated counts
+    (heavy hitters), re-ranked on every update and merge.
+    """
+    def __init__(self, width: int = 256, depth: int = 4, heavy_hitters: int = 8,
+                 table: Optional[np.ndarray] = None, candidates: Optional[np.ndarray] = None):
+        self.width = width
+        self.depth = depth
+        self.heavy_hitters = heavy_hitters
+        self.table = np.zeros((depth, width), dtype=np.int32) if table is None else table
+        self.candidates = np.zeros(0, dtype=np.uint64) if candidates is None else candidates
+        self.total = int(self.table[0].sum())
+
+    def add(self, hashes: np.ndarray) -> None:
+        if not len(hashes):
+            return
+        idx = _double_hash(hashes, self.depth, self.width)
+        for row in range(self.depth):
+            np.add.at(self.table[row], idx[row], 1)
+        self.total += len(hashes)
+        self._rerank(np.concatenate([self.candidates, hashes]))
+
+    def estimate(self, hashes: np.ndarray) -> np.ndarray:
+        if not len(hashes):
+            return np.zeros(0, dtype=np.int64)
+        idx = _double_hash(hashes, self.depth, self.width)
+        return self.table[np.arange(self.depth)[:, None], idx].min(axis=0).astype(np.int64)
+
+    def _rerank(self, candidates: np.ndarray) -> None:
+        candidates = np.unique(candidates)
+        if len(candidates) > self.heavy_hitters:
+            candidates = candidates[np.argsort(-self.estimate(candidates), kind='stable')[:self.heavy_hitters]]
+        self.candidates = candidates
+
+    def max_count(self) -> int:
+        return int(self.estimate(self.candidates).max()) if len(self.candidates) else 0
+
+    def merge(self, other: 'CountMinSketch') -> None:
+        self.table += other.table
+        self.total += other.total
+        self._rerank(np.concatenate([self.candidates, other.candidates]))
+
+    def error_bound(self, confidence_depth: Optional[int] = None) -> Dict[str, float]:
+        return {'overcount_at_most': math.e / self.width * self.total,
+                'with_probability': 1 - math.exp(-(confidence_depth or self.depth))}
+
+
+class BloomFilter:
+    def __init__(self, n_bits: int = 65536, n_hashes: int = 4, bits: Optional[np.ndarray] = None, n_items: int = 0):
+        self.n_bits = n_bits
+        self.n_hashes = n_hashes
+        self.bits = np.zeros((n_bits + 7) // 8, dtype=np.uint8) if bits is None else bits
+        self.n_items = n_items
+
+    def add(self, hashes: np.ndarray) -> None:
+        idx = _double_hash(hashes, self.n_hashes, self.n_bits).ravel()
+        np.bitwise_or.at(self.bits, idx >> 3, (1 << (idx & 7)).astype(np.uint8))
+        self.n_items += len(hashes)
+
+    def contains(self, hashes: np.ndarray) -> np.ndarray:
+        if not len(hashes):
+            return np.zeros(0, dtype=bool)
+        idx = _double_hash(hashes, self.n_hashes, self.n_bits)
+        return ((self.bits[idx >> 3] >> (idx & 7)) & 1).all(axis=0).astype(bool)
+
+    def merge(self, other: 'BloomFilter') -> None:
+        np.bitwise_or(self.bits, other.bits, out=self.bits)
+        self.n_items += other.n_items
+
+    def false_positive_rate(self) -> float:
+        return (1 - math.exp(-self.n_hashes * self.n_items / self.n_bits)) ** self.n_hashes
+
+
+class UserSketch:
+    """
+    Aggregates of one user in constant memory (~24 KB with the defaults,
+    see nbytes), estimating the SKETCH_FEATURES:
+
+      total_*, comment_to_upvote_ratio
+                             exact counts per activity type
+      unique_upvoters_ratio  HLL of upvoters / exact upvote count
+      repeated_upvotes       HLL of upvoters already in the upvoters Bloom
+                             filter (false positives over-count)
+      upvote_concentration   heavy-hitter count / exact upvote count
+      unique_upvote_targets  HLL of upvote targets
+      mutual_upvote_count    HLL of users found in both directions, checked
+                             against the other direction's Bloom filter when
+                             each upvote arrives (Bloom false positives
+                             over-count)
+
+    Merging is exact for everything but the order-dependent parts: repeated
+    and mutual users whose two sightings landed in different shards are not
+    counted.
+    """
+    def __init__(self, settings: Optional[Dict[str, Any]] = None):
+        s = {**DEFAULT_SETTINGS, **(settings or {})}
+        self.settings = s
+        self.upvotes_received = 0
+        self.upvotes_sent = 0
+        self.comments = 0
+        self.posts = 0
+        self.upvoters = HyperLogLog(s['hll_precision'])
+        self.repeat_upvoters = HyperLogLog(s['hll_precision'])
+        self.targets = HyperLogLog(s['hll_precision'])
+        self.mutual = HyperLogLog(s['hll_precision'])
+        self.upvoter_counts = CountMinSketch(s['cms_width'], s['cms_depth'], s['heavy_hitters'])
+        self.upvoters_bloom = BloomFilter(s['bloom_bits'], s['bloom_hashes'])
+        self.targets_bloom = BloomFilter(s['bloom_bits'], s['bloom_hashes'])
+
+    @classmethod
+    def from_activities(cls, karma_log, settings: Optional[Dict[str, Any]] = None) -> 'UserSketch':
+        sketch = cls(settings)
+        for activity in karma_log:
+            sketch.add(activity)
+        return sketch
+
+    def add(self, activity) -> None:
+        activity_type = get_field(activity, 'type')
+        if activity_type == 'comment':
+            self.comments += 1
+        elif activity_type == 'post_created':
+            self.posts += 1
+        elif activity_type == 'upvote_received':
+            self.upvotes_received += 1
+            present = has_field(activity, 'from_user')
+            h = hash64([get_field(activity, 'from_user') if present else _MISSING])
+            self.upvoter_counts.add(h)
+            self.upvoters.add(h)
+            if self.upvoters_bloom.contains(h)[0]:
+                self.repeat_upvoters.add(h)
+            else:
+                self.upvoters_bloom.add(h)
+                if present and self.targets_bloom.contains(h)[0]:
+                    self.mutual.add(h)
+        elif activity_type == 'upvote_sent':
+            self.upvotes_sent += 1
+            if not has_field(activity, 'to_user'):
+                return
+            h = hash64([get_field(activity, 'to_user')])
+            self.targets.add(h)
+            if not self.targets_bloom.contains(h)[0]:
+                self.targets_bloom.add(h)
+                if self.upvoters_bloom.contains(h)[0]:
+                    self.mutual.add(h)
+
+    def merge(self, other: 'UserSketch') -> None:
+        if other.settings != self.settings:
+            raise ValueError('Cannot merge sketches built with different settings')
+        self.upvotes_received += other.upvotes_received
+        self.upvotes_sent += other.upvotes_sent
+        self.comments += other.comments
+        self.posts += other.posts
+        for name in ('upvoters', 'repeat_upvoters', 'targets', 'mutual', 'upvoter_counts',
+                     'upvoters_bloom', 'targets_bloom'):
+            getattr(self, name).merge(getattr(other, name))
+
+    def features(self) -> Dict[str, Any]:
+        total = self.upvotes_received
+        return {
+            'total_comments': self.comments,
+            'total_upvotes': total,
+            'repeated_upvotes': int(round(self.repeat_upvoters.estimate())),
+            'upvote_concentration': min(self.upvoter_counts.max_count(), total) / total if total > 1 else 0.0,
+            'unique_upvoters_ratio': min(self.upvoters.estimate(), total) / total if total > 1 else 0.0,
+            'comment_to_upvote_ratio': self.comments / max(1, total),
+            'total_posts': self.posts,
+            'total_upvotes_sent': self.upvotes_sent,
+            'unique_upvote_targets': int(round(self.targets.estimate())),
+            'mutual_upvote_count': int(round(self.mutual.estimate())),
+        }
+
+    def error_bounds(self) -> Dict[str, float]:
+        return {
+            'hll_relative_error': self.upvoters.relative_error(),
+            **{f'cms_{k}': v for k, v in self.upvoter_counts.error_bound().items()},
+            'upvoters_bloom_false_positive_rate': self.upvoters_bloom.false_positive_rate(),
+            'targets_bloom_false_positive_rate': self.targets_bloom.false_positive_rate(),
+        }
+
+    def to_bytes(self) -> bytes:
+        buf = io.BytesIO()
+        np.savez_compressed(
+            buf,
+            settings=np.array(json.dumps(self.settings)),
+            counts=np.array([self.upvotes_received, self.upvotes_sent, self.upvoters_bloom.n_items,
+                             self.targets_bloom.n_items, self.comments, self.posts], dtype=np.int64),
+            upvoters=self.upvoters.registers, repeat_upvoters=self.repeat_upvoters.registers,
+            targets=self.targets.registers, mutual=self.mutual.registers,
+            cms_table=self.upvoter_counts.table, cms_candidates=self.upvoter_counts.candidates,
+            upvoters_bloom=self.upvoters_bloom.bits, targets_bloom=self.targets_bloom.bits
+        )
+        return buf.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'UserSketch':
+        with np.load(io.BytesIO(data)) as arrays:
+            sketch = cls(json.loads(str(arrays['settings'])))
+            s = sketch.settings
+            received, sent, upvoters_items, targets_items, comments, posts = arrays['counts'].tolist()
+            sketch.upvotes_received, sketch.upvotes_sent = received, sent
+            sketch.comments, sketch.posts = comments, posts
+            for name in ('upvoters', 'repeat_upvoters', 'targets', 'mutual'):
+                setattr(sketch, name, HyperLogLog(s['hll_precision'], arrays[name].copy()))
+            sketch.upvoter_counts = CountMinSketch(s['cms_width'], s['cms_depth'], s['heavy_hitters'],
+                                                   arrays['cms_table'].copy(), arrays['cms_candidates'].copy())
+            sketch.upvoters_bloom = BloomFilter(s['bloom_bits'], s['bloom_hashes'], arrays['upvoters_bloom'].copy(), upvoters_items)
+            sketch.targets_bloom = BloomFilter(s['bloom_bits'], s['bloom_hashes'], arrays['targets_bloom'].copy(), targets_items)
+        return sketch
+
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in (
+            self.upvoters.registers, self.repeat_upvoters.registers, self.targets.registers, self.mutual.registers,
+            self.upvoter_counts.table, self.upvoter_counts.candidates, self.upvoters_bloom.bits, self.targets_bloom.bits))
+
+# Sketch estimates against the exact features over a dataset:
+#   python app/sketches.py data/optimal_test.json
+if __name__ == '__main__':
+    from app.feature_extractor import extract_features
+    with open(sys.argv[1]) as f:
+        users = json.load(f)
+    errors = {name: [] for name in SKETCH_FEATURES}
+    for user in users:
+        exact = extract_features(user, include_nlp=False, features=SKETCH_FEATURES)
+        estimated = UserSketch.from_activities(user['karma_log']).features()
+        for name in SKETCH_FEATURES:
+            errors[name].append(abs(estimated[name] - exact[name]))
+    print(f'{len(users)} users, {UserSketch().nbytes()} bytes per sketch')
+    for name, errs in errors.items():
+        print(f'{name:24s} mean abs error {np.mean(errs):.4f}  max {np.max(errs):.4f}')
@@ -0,0 +1,429 @@
+import sys
+import os
+import json
+import time
+import base64
+import queue
+import argparse
+import threading
+from collections import deque, OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from joblib import load
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from app.feature_extractor import extract_features_batch
+from app.explain_rules import get_status
+from app.sketches import UserSketch
+
+# Continuous scoring worker: tails an append-only NDJSON activity stream (one
+# karma activity per line, with its 'user_id'), groups events per user into
+# micro-batches, rescores the affected users with the regular extractor and
+# model, and emits a line whenever a user's status changes.
+#
+#   python app/stream_worker.py --input data/activity_stream.ndjson \
+#       --output data/status_changes.ndjson --checkpoint data/stream_worker.checkpoint.json
+
+MODEL_PATH = 'model/model.pkl'
+FEATURE_NAMES_PATH = 'model/feature_names.json'
+CONFIG_PATH = 'app/config.json'
+
+DEFAULT_SETTINGS = {
+    'max_batch_events': 500,        # score once this many events are buffered...
+    'max_batch_seconds': 1.0,       # ...or this long after the first buffered event
+    'queue_max_events': 10_000,     # reader blocks when this many events are unscored
+    'max_history_per_user': 5_000,  # most recent activities kept per user
+    'max_users': 100_000,           # least recently active users are dropped beyond this
+    'poll_seconds': 0.2,
+    'checkpoint_seconds': 5.0,      # at most one checkpoint write per interval
+    'checkpoint_compact_min_bytes': 64 * 2 ** 20,  # log size before it may be folded into the snapshot
+    # Once a user's history outgrows max_history_per_user, count and upvote
+    # aggregates come from a UserSketch (sized by sketch_settings) over the
+    # whole stream history instead of the kept activities (see app.sketches)
+    'sketches': False
+}
+
+
+# --- Sources ---
+class NDJSONTailSource:
+    """
+    Reads complete lines appended to a local NDJSON file, starting at a byte
+    offset. A trailing partial line is left for the next poll.
+    """
+    def __init__(self, path: str, offset: int = 0):
+        self.path = path
+        self.offset = offset
+
+    def poll(self, max_events: int) -> List[Tuple[Dict[str, Any], int]]:
+        """
+        Up to max_events (event, offset_after_event) pairs; [] if nothing new.
+        event is None for a line that is not valid JSON.
+        """
+        if not os.path.exists(self.path):
+            return []
+        events = []
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            while len(events) < max_events:
+                line = f.readline()
+                if not line or not line.endswith(b'\n'):
+                    break
+                self.offset += len(line)
+                if line.strip():
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        event = None
+                    events.append((event, self.offset))
+        return events
+
+
+class QueueSource:
+    """
+    In-process stand-in for a message queue. Offsets count consumed events.
+    """
+    def __init__(self, offset: int = 0):
+        self.offset = offset
+        self._queue = queue.Queue()
+
+    def publish(self, event: Dict[str, Any]) -> None:
+        self._queue.put(event)
+
+    def poll(self, max_events: int) -> List[Tuple[Dict[str, Any], int]]:
+        events = []
+        while len(events) < max_events:
+            try:
+                event = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self.offset += 1
+            events.append((event, self.offset))
+        return events
+
+
+# --- Checkpointing ---
+# A checkpoint is a snapshot (JSON: offset, user histories and statuses) plus
+# an append-only log next to it (<path>.log, NDJSON, one record per scored
+# batch: its events and the statuses they led to). A checkpoint appends the
+# records since the last one, so its I/O follows the event rate, not the
+# size of the state. Once the log is larger than both the snapshot and
+# checkpoint_compact_min_bytes, the state is written as a new snapshot and
+# the log emptied: every snapshot byte is paid for by at least one log byte,
+# so amortised checkpoint I/O stays proportional to the event rate. Loading
+# replays the log over the snapshot, skipping records the snapshot already
+# covers (a crash between writing the snapshot and emptying the log).
+
+def load_checkpoint(path: Optional[str]) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """(snapshot, log records after it)."""
+    snapshot = {'offset': 0, 'users': {}}
+    if path and os.path.exists(path):
+        with open(path) as f:
+            snapshot = json.load(f)
+    records = []
+    if path and os.path.exists(path + '.log'):
+        with open(path + '.log') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break   # torn last record from a crash; its events are read again
+                record = json.loads(line)
+                if record['offset'] > snapshot['offset']:
+                    records.append(record)
+    return snapshot, records
+
+def save_checkpoint(path: Optional[str], state: Dict[str, Any]) -> int:
+    """Writes a snapshot; returns its size in bytes."""
+    # Write-then-rename so a crash never leaves a half-written checkpoint
+    if not path:
+        return 0
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+        size = f.tell()
+    os.replace(tmp_path, path)
+    return size
+
+def append_checkpoint_log(path: Optional[str], records: List[Dict[str, Any]]) -> int:
+    """Appends records to the checkpoint log; returns the bytes written."""
+    if not path or not records:
+        return 0
+    data = ''.join(json.dumps(record) + '\n' for record in records)
+    with open(path + '.log', 'a') as f:
+        f.write(data)
+    return len(data)
+
+
+class StreamWorker:
+    """
+    Reader thread -> bounded queue -> micro-batch scorer.
+
+    The bounded queue is the backpressure: when scoring falls behind, the
+    reader blocks and stops advancing through the stream. A checkpoint holds
+    the offset together with the user histories and statuses as of that
+    offset (a snapshot plus a log of batches, see load_checkpoint), and is
+    only written after a batch is scored and emitted, so a restart never
+    skips events (it may rescore events since the checkpoint).
+
+    Per-text NLP results are kept next to each user's history, so a batch
+    only runs the NLP models over the texts it added; they are not
+    checkpointed and are recomputed on a user's first batch after a restart.
+    """
+    def __init__(self, source, emit, model, feature_names: List[str], thresholds: Dict[str, float],
+                 checkpoint_path: Optional[str] = None, settings: Optional[Dict[str, Any]] = None,
+                 sketch_settings: Optional[Dict[str, Any]] = None):
+        self.source = source
+        self.emit = emit
+        self.model = model
+        self.feature_names = feature_names
+        self.thresholds = thresholds
+        self.checkpoint_path = checkpoint_path
+        self.settings = {**DEFAULT_SETTINGS, **(settings or {})}
+        self.sketch_settings = sketch_settings
+        self.stats = {'events': 0, 'bad_events': 0, 'batches': 0, 'users_scored': 0, 'status_changes': 0,
+                      'reader_blocked_seconds': 0.0, 'texts_nlp_scored': 0, 'checkpoint_bytes': 0, 'compactions': 0}
+        state, records = load_checkpoint(checkpoint_path)
+        self.offset = state['offset']
+        # user_id -> {'account_age_days', 'karma_log' (deque), 'nlp' (deque of per-text NLP
+        # results aligned with karma_log, None until scored), 'status', 'fraud_score'[, 'sketch']}
+        self.users = OrderedDict()
+        max_history = self.settings['max_history_per_user']
+        for user_id, user in state['users'].items():
+            self.users[user_id] = {
+                'account_age_days': user.get('account_age_days', 10),
+                'karma_log': deque(user['karma_log'], maxlen=max_history),
+                'nlp': deque([None] * len(user['karma_log']), maxlen=max_history),
+                'status': user.get('status'),
+                'fraud_score': user.get('fraud_score')
+            }
+            if self.settings['sketches'] and 'sketch' in user:
+                self.users[user_id]['sketch'] = UserSketch.from_bytes(base64.b64decode(user['sketch']))
+        self._snapshot_bytes = os.path.getsize(checkpoint_path) \
+            if checkpoint_path and os.path.exists(checkpoint_path) else 0
+        self._log_bytes = os.path.getsize(checkpoint_path + '.log') \
+            if checkpoint_path and os.path.exists(checkpoint_path + '.log') else 0
+        for record in records:
+            self._replay(record)
+        self.source.offset = self.offset
+        self._pending = []   # log records of batches scored since the last checkpoint
+        self._last_checkpoint = time.monotonic()
+        self._queue = queue.Queue(maxsize=self.settings['queue_max_events'])
+        self._stop = threading.Event()
+        self._reader_error = None
+
+    # --- Reader side ---
+    def _read_loop(self, follow: bool) -> None:
+        try:
+            while not self._stop.is_set():
+                events = self.source.poll(self.settings['max_batch_events'])
+                if not events:
+                    if not follow:
+                        break
+                    time.sleep(self.settings['poll_seconds'])
+                    continue
+                for item in events:
+                    event = item[0]
+                    if not isinstance(event, dict) or 'user_id' not in event:
+                        # Unparseable line or no user to attribute it to: skipped, not retried
+                        self.stats['bad_events'] += 1
+                        continue
+                    start = time.monotonic()
+                    self._queue.put(item)  # blocks while the scorer is behind
+                    self.stats['reader_blocked_seconds'] += time.monotonic() - start
+        except Exception as e:
+            self._reader_error = e  # re-raised by run() once the queued events are scored
+        finally:
+            self._queue.put(None)  # end-of-stream marker
+
+    # --- Scorer side ---
+    def _next_batch(self) -> Tuple[List[Tuple[Dict[str, Any], int]], bool]:
+        batch = []
+        deadline = None
+        while len(batch) < self.settings['max_batch_events']:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                return batch, False
+            if item is None:
+                return batch, True
+            batch.append(item)
+            if deadline is None:
+                deadline = time.monotonic() + self.settings['max_batch_seconds']
+        return batch, False
+
+    def _apply(self, event: Dict[str, Any]) -> str:
+        user_id = event['user_id']
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = {
+                'account_age_days': event.get('account_age_days', 10),
+                'karma_log': deque(maxlen=self.settings['max_history_per_user']),
+                'nlp': deque(maxlen=self.settings['max_history_per_user']),
+                'status': None,
+                'fraud_score': None
+            }
+        self.users.move_to_end(user_id)
+        if 'account_age_days' in event:
+            user['account_age_days'] = event['account_age_days']
+        activity = {k: v for k, v in event.items() if k not in ('user_id', 'account_age_days')}
+        karma_log = user['karma_log']
+        if self.settings['sketches'] and 'sketch' not in user and len(karma_log) == karma_log.maxlen:
+            # The oldest activity is about to be dropped: from here on the sketch covers the whole history
+            user['sketch'] = UserSketch.from_activities(karma_log, self.sketch_settings)
+        karma_log.append(activity)
+        user['nlp'].append(None)
+        if 'sketch' in user:
+            user['sketch'].add(activity)
+        return user_id
+
+    def _evict(self) -> None:
+        while len(self.users) > self.settings['max_users']:
+            self.users.popitem(last=False)
+
+    def _replay(self, record: Dict[str, Any]) -> None:
+        # Same steps as score_batch, with the logged statuses instead of scoring
+        for event in record['events']:
+            self._apply(event)
+        for user_id, (status, fraud_score) in record['scores'].items():
+            self.users[user_id]['status'] = status
+            self.users[user_id]['fraud_score'] = fraud_score
+        self._evict()
+        self.offset = record['offset']
+
+    def score_batch(self, batch: List[Tuple[Dict[str, Any], int]]) -> None:
+        affected = list(OrderedDict.fromkeys(self._apply(event) for event, _ in batch))
+        user_logs = [
+            {'user_id': u, 'account_age_days': self.users[u]['account_age_days'], 'karma_log': list(self.users[u]['karma_log'])}
+            for u in affected
+        ]
+        sketches = [self.users[u].get('sketch') for u in affected] if self.settings['sketches'] else None
+        nlp_caches = [{i: r for i, r in enumerate(self.users[u]['nlp']) if r is not None} for u in affected]
+        cached = [len(cache) for cache in nlp_caches]
+        X_dicts = extract_features_batch(user_logs, features=self.feature_names, sketches=sketches,
+                                         nlp_caches=nlp_caches)
+        for user_id, cache, n_cached in zip(affected, nlp_caches, cached):
+            if len(cache) > n_cached:
+                nlp = self.users[user_id]['nlp']
+                for i, result in cache.items():
+                    if nlp[i] is None:
+                        nlp[i] = result
+                self.stats['texts_nlp_scored'] += len(cache) - n_cached
+        X = np.array([[row[f] for f in self.feature_names] for row in X_dicts])
+        probs = self.model.predict_proba(X)[:, 2]
+        scores = {}
+        for user_id, fraud_score in zip(affected, probs):
+            user = self.users[user_id]
+            status = get_status(float(fraud_score), {'fraud_score_thresholds': self.thresholds})
+            if status != user['status']:
+                self.emit({
+                    'user_id': user_id,
+                    'previous_status': user['status'],
+                    'status': status,
+                    'fraud_score': round(float(fraud_score), 3),
+                    'offset': batch[-1][1]
+                })
+                self.stats['status_changes'] += 1
+            user['status'] = status
+            user['fraud_score'] = round(float(fraud_score), 3)
+            scores[user_id] = [status, user['fraud_score']]
+        self._evict()
+        self.offset = batch[-1][1]
+        if self.checkpoint_path:
+            self._pending.append({'offset': self.offset, 'events': [event for event, _ in batch], 'scores': scores})
+        self.stats['events'] += len(batch)
+        self.stats['batches'] += 1
+        self.stats['users_scored'] += len(affected)
+        if time.monotonic() - self._last_checkpoint >= self.settings['checkpoint_seconds']:
+            self.checkpoint()
+
+    def checkpoint(self) -> None:
+        """Appends the batches since the last checkpoint to the log; compacts a log that outgrew the snapshot."""
+        self._last_checkpoint = time.monotonic()
+        written = append_checkpoint_log(self.checkpoint_path, self._pending)
+        self._pending = []
+        self._log_bytes += written
+        self.stats['checkpoint_bytes'] += written
+        if self._log_bytes > max(self._snapshot_bytes, self.settings['checkpoint_compact_min_bytes']):
+            self.compact()
+
+    def compact(self) -> None:
+        """Writes the whole state as a new snapshot and empties the log."""
+        if not self.checkpoint_path:
+            return
+        self._snapshot_bytes = save_checkpoint(self.checkpoint_path, {
+            'offset': self.offset,
+            'users': {
+                user_id: {
+                    'account_age_days': user['account_age_days'],
+                    'karma_log': list(user['karma_log']),
+                    'status': user['status'],
+                    'fraud_score': user['fraud_score'],
+                    **({'sketch': base64.b64encode(user['sketch'].to_bytes()).decode()} if 'sketch' in user else {})
+                }
+                for user_id, user in self.users.items()
+            }
+        })
+        open(self.checkpoint_path + '.log', 'w').close()
+        self._log_bytes = 0
+        self.stats['checkpoint_bytes'] += self._snapshot_bytes
+        self.stats['compactions'] += 1
+
+    def run(self, follow: bool = True) -> None:
+        reader = threading.Thread(target=self._read_loop, args=(follow,), daemon=True)
+        reader.start()
+        try:
+            while True:
+                batch, done = self._next_batch()
+                if batch:
+                    self.score_batch(batch)
+                if done:
+                    break
+            if self._reader_error is not None:
+                raise self._reader_error
+        finally:
+            self._stop.set()
+            self.checkpoint()
+            # Unblock a reader stuck on a full queue
+            while reader.is_alive():
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    reader.join(0.05)
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Continuously score users from an NDJSON activity stream.')
+    parser.add_argument('--input', required=True, help='append-only NDJSON activity stream')
+    parser.add_argument('--output', help='NDJSON file for status changes (default: stdout)')
+    parser.add_argument('--checkpoint', default='data/stream_worker.checkpoint.json')
+    parser.add_argument('--once', action='store_true', help='stop at end of stream instead of tailing')
+    args = parser.parse_args()
+
+    with open(CONFIG_PATH) as f:
+        config = json.load(f)
+    model = load(MODEL_PATH)
+    with open(FEATURE_NAMES_PATH) as f:
+        feature_names = json.load(f)
+
+    out = open(args.output, 'a') if args.output else sys.stdout
+    def emit(change):
+        out.write(json.dumps(change) + '\n')
+        out.flush()
+
+    worker = StreamWorker(
+        NDJSONTailSource(args.input), emit, model, feature_names,
+        config['fraud_score_thresholds'], checkpoint_path=args.checkpoint,
+        settings=config.get('stream_worker_settings'), sketch_settings=config.get('sketch_settings')
+    )
+    try:
+        worker.run(follow=not args.once)
+    except KeyboardInterrupt:
+        worker.stop()
+    finally:
+        print(json.dumps(worker.stats), file=sys.stderr)
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == '__main__':
+    main()
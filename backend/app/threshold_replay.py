@@ -0,0 +1,207 @@
+import sys
+import os
+import json
+import time
+import argparse
+import itertools
+if __name__ == '__main__':
+    # Run as a script: make the app package importable
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import numpy as np
+from typing import Any, Dict, List, Sequence
+from app.explain_rules import STATUSES, RuleEngine, find_words, spam_words, vague_words
+from app.karma_log import get_field
+
+# What-if replay of threshold changes over a stored scoring run.
+#
+#   python app/predict_user_logs.py --save-run data/run.npz
+#   python app/threshold_replay.py data/run.npz --clean 0.1,0.2 --flagged 0.4,0.5 \
+#       --spam-threshold 0.5,0.6 --rule young_upvote_ratio=0.2,0.3,0.4
+#
+# A run file (np.savez_compressed) holds per user the fraud probability, the
+# label if known and the model + rule feature matrix, and per text the NLP
+# spam / low-effort scores. get_status, the threshold rules and the NLP spam
+# explanation are then re-evaluated for every candidate threshold set at
+# once, without model calls. Spam/vague word and single-activity-type
+# explanations do not depend on thresholds and are stored as a count.
+# Candidates change thresholds only; rule ops and anchors are the config's.
+# Scores and features are stored as float64, the precision get_status and
+# the rules compare them in: a float32 0.7 is below a 0.7 threshold.
+
+CONFIG_PATH = 'app/config.json'
+
+# Dataset labels, matched against statuses in the same order
+LABELS = ['normal', 'suspicious', 'fraudulent']
+
+def fixed_explanation_count(user) -> int:
+    """
+    Explanations of a user that no threshold changes: spam/vague word hits
+    and the single-activity-type record.
+    """
+    karma_log = get_field(user, 'karma_log') or []
+    count = 0
+    for a in karma_log:
+        if get_field(a, 'type') in ('comment', 'post_created'):
+            content = get_field(a, 'content') or ''
+            count += len(find_words(content, spam_words)) + len(find_words(content, vague_words))
+    if len(set(get_field(a, 'type') for a in karma_log)) == 1:
+        count += 1
+    return count
+
+def save_run(path: str, user_logs: List[Dict[str, Any]], fraud_scores: Sequence[float], X: np.ndarray,
+             feature_names: Sequence[str], text_user: Sequence[int], text_scores: List[Dict[str, float]]) -> None:
+    """
+    Writes a run file. text_user[i] is the index in user_logs of the user
+    who wrote the text scored as text_scores[i] (an analyze() result).
+    """
+    labels = [LABELS.index(u['label']) if u.get('label') in LABELS else -1 for u in user_logs]
+    np.savez_compressed(
+        path,
+        user_ids=np.array([str(get_field(u, 'user_id', '')) for u in user_logs]),
+        fraud_score=np.asarray(fraud_scores, dtype=np.float64),
+        labels=np.array(labels, dtype=np.int8),
+        feature_names=np.array(list(feature_names)),
+        X=np.asarray(X, dtype=np.float64).reshape(len(user_logs), len(feature_names)),
+        has_upvote=np.array([any(get_field(a, 'type') == 'upvote_received' for a in get_field(u, 'karma_log') or [])
+                             for u in user_logs], dtype=bool),
+        fixed_explanations=np.array([fixed_explanation_count(u) for u in user_logs], dtype=np.int32),
+        text_user=np.asarray(text_user, dtype=np.int32),
+        text_spam=np.array([s['spam_score'] for s in text_scores], dtype=np.float64),
+        text_low_effort=np.array([s['low_effort_score'] for s in text_scores], dtype=np.float64),
+    )
+
+def load_run(path: str) -> Dict[str, np.ndarray]:
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+def candidate_grid(config: Dict[str, Any], clean=None, flagged=None, spam_threshold=None,
+                   loweffort_threshold=None, rules: Dict[str, Sequence[float]] = None) -> List[Dict[str, Any]]:
+    """
+    Every combination of the given values; anything not given keeps the
+    config's value. The config's own thresholds come first.
+    """
+    base = {
+        'clean': config['fraud_score_thresholds']['clean'],
+        'flagged': config['fraud_score_thresholds']['flagged'],
+        'spam_threshold': config['nlp_settings']['spam_threshold'],
+        'loweffort_threshold': config['nlp_settings'].get('loweffort_threshold', 0.65),
+    }
+    axes = {
+        'clean': clean or [base['clean']],
+        'flagged': flagged or [base['flagged']],
+        'spam_threshold': spam_threshold or [base['spam_threshold']],
+        'loweffort_threshold': loweffort_threshold or [base['loweffort_threshold']],
+        **{f'rule:{name}': values for name, values in (rules or {}).items()}
+    }
+    candidates = [base]
+    for values in itertools.product(*axes.values()):
+        candidate = dict(zip(axes, values))
+        if candidate != base:
+            candidates.append(candidate)
+    return candidates
+
+def replay(run: Dict[str, np.ndarray], config: Dict[str, Any], candidates: List[Dict[str, Any]],
+           chunk_size: int = 256) -> List[Dict[str, Any]]:
+    """
+    Status distribution, label agreement and explanation counts per
+    candidate. Candidates are evaluated chunk_size at a time as
+    (users, candidates) arrays.
+    """
+    engine = RuleEngine.from_config(config)
+    feature_names = list(run['feature_names'])
+    for name in (k[len('rule:'):] for c in candidates for k in c if k.startswith('rule:')):
+        if name not in engine.features:
+            raise KeyError(f"No threshold rule for feature '{name}'")
+    _, rule_values = engine.evaluate(run['X'], feature_names)   # (n, R)
+    # Rules anchored on the first upvote are skipped for users without one
+    rule_applies = np.where(engine.anchors == 1, run['has_upvote'][:, None], True)  # (n, R)
+    scores, labels, n = run['fraud_score'], run['labels'], len(run['fraud_score'])
+    labelled = labels >= 0
+    rows = []
+    for start in range(0, len(candidates), chunk_size):
+        chunk = candidates[start:start + chunk_size]
+        clean = np.array([c['clean'] for c in chunk])
+        flagged = np.array([c['flagged'] for c in chunk])
+        # get_status: < clean -> clean, < flagged -> flagged, else banned
+        status = (scores[:, None] >= clean).astype(np.int8) + (scores[:, None] >= flagged)   # (n, K)
+        thresholds = np.tile(engine.thresholds, (len(chunk), 1))   # (K, R)
+        for r, name in enumerate(engine.features):
+            thresholds[:, r] = [c.get(f'rule:{name}', engine.thresholds[r]) for c in chunk]
+        hits = np.where(engine.is_ge, rule_values[:, None, :] >= thresholds, rule_values[:, None, :] > thresholds)
+        hits &= rule_applies[:, None, :]   # (n, K, R)
+        rule_hits = hits.sum(axis=2)
+        spam = np.array([c['spam_threshold'] for c in chunk])
+        text_hits = np.zeros((n, len(chunk)))
+        np.add.at(text_hits, run['text_user'], run['text_spam'][:, None] > spam)
+        low_effort = np.array([c['loweffort_threshold'] for c in chunk])
+        low_effort_share = (run['text_low_effort'][:, None] > low_effort).mean(axis=0) \
+            if len(run['text_low_effort']) else np.zeros(len(chunk))
+        explanations = rule_hits + text_hits + run['fixed_explanations'][:, None]
+        for k, candidate in enumerate(chunk):
+            row = {
+                'thresholds': candidate,
+                'status_counts': dict(zip(STATUSES, np.bincount(status[:, k], minlength=3).tolist())),
+                'rule_hit_rate': dict(zip(engine.features, hits[:, k].mean(axis=0).round(4).tolist())),
+                'users_with_rule_hit': float((rule_hits[:, k] > 0).mean()),
+                'nlp_spam_explanations_per_user': float(text_hits[:, k].mean()),
+                'low_effort_text_share': float(low_effort_share[k]),
+                'explanations_per_user': float(explanations[:, k].mean()),
+            }
+            if labelled.any():
+                y, pred = labels[labelled], status[labelled, k]
+                row['label_agreement'] = float(np.mean(pred == y))
+                row['fraudulent_recall'] = float(np.mean(pred[y == 2] == 2)) if (y == 2).any() else None
+                row['normal_banned_rate'] = float(np.mean(pred[y == 0] == 2)) if (y == 0).any() else None
+            rows.append(row)
+    return rows
+
+def parse_values(text: str) -> List[float]:
+    return [float(v) for v in text.split(',') if v]
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay candidate thresholds over a stored scoring run.')
+    parser.add_argument('run', help='run file written by predict_user_logs.py --save-run')
+    parser.add_argument('--clean', type=parse_values, help='comma-separated fraud_score_thresholds.clean values')
+    parser.add_argument('--flagged', type=parse_values, help='comma-separated fraud_score_thresholds.flagged values')
+    parser.add_argument('--spam-threshold', type=parse_values)
+    parser.add_argument('--loweffort-threshold', type=parse_values)
+    parser.add_argument('--rule', action='append', default=[], metavar='FEATURE=V1,V2',
+                        help='candidate values for one suspicious_activity_thresholds rule (repeatable)')
+    parser.add_argument('--candidates', help='JSON list of candidate dicts instead of a grid')
+    parser.add_argument('--output', help='write every row as JSON here')
+    parser.add_argument('--sort', default='label_agreement', help='row key to rank the printed table by')
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+
+    with open(CONFIG_PATH) as f:
+        config = json.load(f)
+    run = load_run(args.run)
+    if args.candidates:
+        with open(args.candidates) as f:
+            base = candidate_grid(config)[0]
+            candidates = [base] + [{**base, **c} for c in json.load(f)]
+    else:
+        rules = {}
+        for entry in args.rule:
+            name, _, values = entry.partition('=')
+            rules[name] = parse_values(values)
+        candidates = candidate_grid(config, args.clean, args.flagged, args.spam_threshold,
+                                    args.loweffort_threshold, rules)
+
+    start = time.perf_counter()
+    rows = replay(run, config, candidates)
+    elapsed = time.perf_counter() - start
+    print(f'{len(rows)} candidate sets over {len(run["fraud_score"])} users and {len(run["text_spam"])} texts '
+          f'in {elapsed:.3f}s (first row = current config)')
+    ranked = [rows[0]] + sorted(rows[1:], key=lambda r: -(r.get(args.sort) or 0))[:args.top]
+    for row in ranked:
+        counts = ' '.join(f'{s}={c}' for s, c in row['status_counts'].items())
+        agreement = f" agreement={row['label_agreement']:.3f}" if 'label_agreement' in row else ''
+        print(f"{json.dumps(row['thresholds'])}\n    {counts}{agreement} "
+              f"rule_hit_users={row['users_with_rule_hit']:.3f} explanations/user={row['explanations_per_user']:.2f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+if __name__ == '__main__':
+    main()
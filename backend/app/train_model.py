@@ -2,54 +2,216 @@ import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import json
+import time
+import hashlib
+import argparse
 import numpy as np
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.metrics import f1_score, roc_auc_score, confusion_matrix, classification_report
-from joblib import dump
-from app.feature_extractor import extract_features_batch
+from sklearn.metrics import f1_score, roc_auc_score, confusion_matrix, classification_report, accuracy_score
+from joblib import dump, load
+from app.feature_extractor import (
+    FEATURES, burst_windows_seconds, extract_features_batch, feature_cost, shared_intermediates, NLP_FEATURES
+)
+from app.explain_rules import STATUSES, RuleEngine, get_status
 from sklearn.model_selection import cross_val_score
 
 TRAIN_PATH = 'data/optimal_train.json'
 TEST_PATH = 'data/optimal_test.json'
 MODEL_PATH = 'model/model.pkl'
 FEATURE_NAMES_PATH = 'model/feature_names.json'
+STRUCTURAL_MODEL_PATH = 'model/structural_model.pkl'
+STRUCTURAL_FEATURE_NAMES_PATH = 'model/structural_feature_names.json'
+CONFIG_PATH = 'app/config.json'
+FEATURE_CACHE_DIR = 'model/feature_cache'
 
 LABEL_MAP = {'normal': 0, 'suspicious': 1, 'fraudulent': 2}
 
 # Utility to extract X, y from dataset
-def prepare_data(dataset):
-    X_dicts = extract_features_batch(dataset)
+def prepare_data(dataset, feature_names=None):
+    X_dicts = extract_features_batch(dataset, features=feature_names)
     feature_names = [k for k in X_dicts[0] if k != 'user_id']
     X = np.array([[row[f] for f in feature_names] for row in X_dicts])
     y = np.array([LABEL_MAP.get(row.get('label', 'normal'), 0) for row in dataset])
     return X, y, feature_names
 
+def cached_features(path, feature_names=None, config=None):
+    """
+    prepare_data over the JSON dataset at `path`, cached in FEATURE_CACHE_DIR.
+    The cache key covers the file's contents, the requested features, the
+    burst windows and the NLP artifacts the text features come from.
+    """
+    with open(path, 'rb') as f:
+        raw = f.read()
+    model_settings = (config or {}).get('model_settings', {})
+    nlp_artifacts = [
+        [p, os.path.getmtime(p), os.path.getsize(p)]
+        for p in (model_settings.get(k) for k in ('spam_model_path', 'loweffort_model_path',
+                                                  'cascade_model_path', 'projection_model_path'))
+        if p and os.path.exists(p)
+    ]
+    key = hashlib.sha256(raw + json.dumps([feature_names, burst_windows_seconds, nlp_artifacts]).encode()).hexdigest()[:16]
+    cache_path = os.path.join(FEATURE_CACHE_DIR, f'{os.path.splitext(os.path.basename(path))[0]}-{key}.npz')
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as data:
+            return data['X'], data['y'], list(data['feature_names'])
+    X, y, feature_names = prepare_data(json.loads(raw), feature_names)
+    os.makedirs(FEATURE_CACHE_DIR, exist_ok=True)
+    np.savez_compressed(cache_path, X=X, y=y, feature_names=np.array(feature_names))
+    return X, y, feature_names
+
+def make_classifier():
+    return RandomForestClassifier(
+        n_estimators=50,
+        max_depth=6,
+        min_samples_split=5,
+        min_samples_leaf=3,
+        random_state=42,
+        class_weight='balanced'
+        )
+
+# Two-stage scoring as ModelBundle.score runs it: the structural model's
+# P(fraudulent) is the answer outside the uncertain band, the full model's
+# (with NLP features) inside it. Both sides are compared as the server
+# decides, by get_status over config's fraud_score_thresholds; statuses line
+# up with the labels (clean/normal, flagged/suspicious, banned/fraudulent).
+def two_stage_report(clf, structural_clf, X, X_structural, y, band, split, config):
+    low, high = band
+    prelim = structural_clf.predict_proba(X_structural)[:, 2]
+    uncertain = (prelim >= low) & (prelim <= high)
+    full_score = clf.predict_proba(X)[:, 2]
+    two_stage_score = np.where(uncertain, full_score, prelim)
+    full_pred = np.array([STATUSES.index(get_status(s, config)) for s in full_score])
+    two_stage_pred = np.array([STATUSES.index(get_status(s, config)) for s in two_stage_score])
+    full_acc, two_stage_acc = accuracy_score(y, full_pred), accuracy_score(y, two_stage_pred)
+    full_f1 = f1_score(y, full_pred, average='weighted')
+    two_stage_f1 = f1_score(y, two_stage_pred, average='weighted')
+    print(f'\n=== TWO-STAGE {split.upper()} (uncertain band {low}-{high}, statuses from fraud_score_thresholds) ===')
+    print(f'NLP skip rate:      {1 - uncertain.mean():.3f}')
+    print(f'Accuracy full/2-stage: {full_acc:.4f} / {two_stage_acc:.4f} (delta {two_stage_acc - full_acc:+.4f})')
+    print(f'F1 full/2-stage:       {full_f1:.4f} / {two_stage_f1:.4f} (delta {two_stage_f1 - full_f1:+.4f})')
+    print(f'Status agreement:      {np.mean(two_stage_pred == full_pred):.4f}')
+    print(f'Mean |score delta|:    {np.mean(np.abs(two_stage_score - full_score)):.4f}')
+
+# Feature pruning: a feature whose importance is below min_importance is
+# dropped when dropping it saves at least min_savings extraction cost (see
+# feature_extractor's registry costs). Savings are marginal: an intermediate
+# shared with a kept feature, or with a threshold rule (always extracted),
+# saves nothing. Least important features are considered first.
+#
+# One at a time, a costly shared intermediate (comment_nlp behind
+# avg_spam_score and avg_low_effort) could never be saved, so afterwards
+# every group of kept features sharing an intermediate is dropped as a
+# whole when all its members are below min_importance, largest savings
+# first. A group is reported as one entry, with its highest importance.
+def prune_features(feature_names, importances, min_importance, min_savings, always_extracted=()):
+    kept = list(feature_names)
+    pruned = []
+    importance_of = dict(zip(feature_names, importances))
+    savings_of = lambda names: feature_cost(list(always_extracted) + kept) - \
+        feature_cost(list(always_extracted) + [f for f in kept if f not in names])
+    for name, importance in sorted(zip(feature_names, importances), key=lambda x: x[1]):
+        if importance >= min_importance:
+            break
+        savings = savings_of([name])
+        if savings >= min_savings:
+            kept.remove(name)
+            pruned.append((name, importance, savings))
+    while True:
+        groups = [group for group in shared_intermediates(kept).values()
+                  if all(importance_of[f] < min_importance for f in group)]
+        best = max(groups, key=savings_of, default=None)
+        if best is None or savings_of(best) < min_savings:
+            break
+        pruned.append((' + '.join(best), max(importance_of[f] for f in best), savings_of(best)))
+        kept = [f for f in kept if f not in best]
+    return kept, pruned
+
+# Incremental update: grow add_trees new trees on the new batch only
+# (warm_start keeps the existing ones), then drop the oldest trees beyond
+# max_trees so inference cost stays flat. The new batch must contain every
+# class the forest knows, since all trees share one classes_ layout.
+def incremental_update(clf, X_new, y_new, add_trees, max_trees=None):
+    if not np.array_equal(np.unique(y_new), clf.classes_):
+        raise ValueError(f'New batch has classes {np.unique(y_new).tolist()}, the model {clf.classes_.tolist()}')
+    clf.set_params(warm_start=True, n_estimators=len(clf.estimators_) + add_trees)
+    clf.fit(X_new, y_new)
+    clf.set_params(warm_start=False)
+    if max_trees and len(clf.estimators_) > max_trees:
+        clf.estimators_ = clf.estimators_[-max_trees:]
+        clf.n_estimators = max_trees
+    return clf
+
+def update_report(clf, X, y, n_timing=200):
+    y_prob = clf.predict_proba(X)
+    row = X[:1]
+    start = time.perf_counter()
+    for _ in range(n_timing):
+        clf.predict_proba(row)
+    return {
+        'trees': len(clf.estimators_),
+        'f1': f1_score(y, clf.classes_[y_prob.argmax(axis=1)], average='weighted'),
+        'roc_auc': roc_auc_score(y, y_prob, multi_class='ovr'),
+        'single_row_ms': (time.perf_counter() - start) / n_timing * 1000,
+    }
+
+def train_incremental(args, config):
+    clf = load(MODEL_PATH)
+    with open(FEATURE_NAMES_PATH) as f:
+        feature_names = json.load(f)
+    X_new, y_new, _ = cached_features(args.incremental, feature_names, config)
+    X_test, y_test, _ = cached_features(TEST_PATH, feature_names, config)
+    models = [('model', clf, MODEL_PATH, list(range(len(feature_names))))]
+    if os.path.exists(STRUCTURAL_MODEL_PATH) and os.path.exists(STRUCTURAL_FEATURE_NAMES_PATH):
+        with open(STRUCTURAL_FEATURE_NAMES_PATH) as f:
+            structural_idx = [feature_names.index(name) for name in json.load(f)]
+        models.append(('structural', load(STRUCTURAL_MODEL_PATH), STRUCTURAL_MODEL_PATH, structural_idx))
+
+    print(f'\n=== INCREMENTAL UPDATE ({len(y_new)} new users, +{args.add_trees} trees'
+          f'{f", max {args.max_trees}" if args.max_trees else ""}) ===')
+    print(f'{"model":>10s} {"trees":^12s} {"test F1":^16s} {"test AUC":^16s} {"1-row ms":^12s} {"update s":>9s}')
+    for name, model, path, idx in models:
+        before = update_report(model, X_test[:, idx], y_test)
+        start = time.perf_counter()
+        incremental_update(model, X_new[:, idx], y_new, args.add_trees, args.max_trees)
+        seconds = time.perf_counter() - start
+        after = update_report(model, X_test[:, idx], y_test)
+        print(f"{name:>10s} {before['trees']:>4d} -> {after['trees']:<4d} {before['f1']:.4f} -> {after['f1']:.4f} "
+              f"{before['roc_auc']:.4f} -> {after['roc_auc']:.4f} {before['single_row_ms']:.2f} -> {after['single_row_ms']:.2f} "
+              f"{seconds:>9.2f}")
+        dump(model, path)
+    print(f'\nModel saved to {MODEL_PATH}')
+
 def main():
+    parser = argparse.ArgumentParser(description='Train the fraud model.')
+    parser.add_argument('--prune-importance', type=float, metavar='T',
+                        help='drop features with importance below T that are costly to extract, then retrain')
+    parser.add_argument('--prune-min-savings', type=float, default=10,
+                        help='minimum extraction cost a dropped feature must save (default 10)')
+    parser.add_argument('--incremental', metavar='NEW_DATA',
+                        help='update the saved model with trees grown on this labeled JSON batch instead of retraining')
+    parser.add_argument('--add-trees', type=int, default=10, help='trees grown per incremental update (default 10)')
+    parser.add_argument('--max-trees', type=int, help='drop the oldest trees beyond this many after an update')
+    args = parser.parse_args()
     os.makedirs('model', exist_ok=True)
-    # Load data
-    with open(TRAIN_PATH) as f:
-        train_data = json.load(f)
-    with open(TEST_PATH) as f:
-        test_data = json.load(f)
+    config = {}
+    if os.path.exists(CONFIG_PATH):
+        with open(CONFIG_PATH) as f:
+            config = json.load(f)
+    if args.incremental:
+        train_incremental(args, config)
+        return
 
-    # Prepare features and labels
-    X_train, y_train, feature_names = prepare_data(train_data)
-    X_test, y_test, _ = prepare_data(test_data)
+    # Prepare features and labels (cached per dataset, see cached_features)
+    X_train, y_train, feature_names = cached_features(TRAIN_PATH, config=config)
+    X_test, y_test, _ = cached_features(TEST_PATH, config=config)
 
     print('\nFeatures used for training:')
     for fname in feature_names:
         print(' -', fname)
 
     # Train model
-    clf = RandomForestClassifier(
-        n_estimators=50,
-        max_depth=6,
-        min_samples_split=5,
-        min_samples_leaf=3,
-        random_state=42,
-        class_weight='balanced'
-        )
-    
+    clf = make_classifier()
+
 
     scores = cross_val_score(clf, X_train, y_train, cv=5, scoring='f1_weighted')
     print('Cross-validated F1 scores:', scores)
@@ -57,6 +219,23 @@ def main():
     
     clf.fit(X_train, y_train)
 
+    if args.prune_importance is not None:
+        rule_features = [f for f in RuleEngine.from_config(config).features if f in FEATURES]
+        kept, pruned = prune_features(feature_names, clf.feature_importances_, args.prune_importance,
+                                      args.prune_min_savings, always_extracted=rule_features)
+        print(f'\n=== FEATURE PRUNING (importance < {args.prune_importance}, savings >= {args.prune_min_savings}) ===')
+        for name, importance, savings in pruned:
+            print(f'{name:30s}: importance {importance:.4f}, saves {savings:g}')
+        if pruned:
+            kept_idx = [feature_names.index(f) for f in kept]
+            pruned_clf = make_classifier().fit(X_train[:, kept_idx], y_train)
+            before = f1_score(y_test, clf.predict(X_test), average='weighted')
+            after = f1_score(y_test, pruned_clf.predict(X_test[:, kept_idx]), average='weighted')
+            print(f'Extraction cost: {feature_cost(rule_features + feature_names):g} -> {feature_cost(rule_features + kept):g}')
+            print(f'Test F1:         {before:.4f} -> {after:.4f} (delta {after - before:+.4f})')
+            clf, feature_names = pruned_clf, kept
+            X_train, X_test = X_train[:, kept_idx], X_test[:, kept_idx]
+
     # Save model and feature names
     dump(clf, MODEL_PATH)
     with open(FEATURE_NAMES_PATH, 'w') as f:
@@ -83,8 +262,19 @@ def main():
     for name, score in sorted(zip(feature_names, clf.feature_importances_), key=lambda x: -x[1]):
         print(f'{name:30s}: {score:.4f}')
 
+    # Structural (non-NLP) model for two-stage scoring
+    structural_idx = [i for i, name in enumerate(feature_names) if name not in NLP_FEATURES]
+    structural_names = [feature_names[i] for i in structural_idx]
+    structural_clf = make_classifier().fit(X_train[:, structural_idx], y_train)
+    dump(structural_clf, STRUCTURAL_MODEL_PATH)
+    with open(STRUCTURAL_FEATURE_NAMES_PATH, 'w') as f:
+        json.dump(structural_names, f)
+    band = config.get('two_stage_settings', {}).get('uncertain_band', (0.1, 0.6))
+    two_stage_report(clf, structural_clf, X_test, X_test[:, structural_idx], y_test, band, 'test', config)
+
     print(f'\nModel saved to {MODEL_PATH}')
     print(f'Feature names saved to {FEATURE_NAMES_PATH}')
+    print(f'Structural model saved to {STRUCTURAL_MODEL_PATH}')
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
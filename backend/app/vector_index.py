@@ -0,0 +1,216 @@
+import hashlib
+import threading
+import time
+import numpy as np
+from typing import Optional
+
+
+def owner_code(user_id: str) -> int:
+    # blake2b, not hash(): str hashes are salted per process, so codes would
+    # differ between prefork workers and restarts. 64 bits make collisions
+    # between distinct accounts (which would read as self-copies) negligible.
+    return int.from_bytes(hashlib.blake2b(str(user_id).encode(), digest_size=8).digest(), 'little', signed=True)
+
+
+class ContentIndex:
+    """
+    Bounded in-memory index of recent content embeddings for cross-user
+    near-duplicate detection.
+
+    Vectors are L2-normalised and stored quantised (int8 or float16) in a
+    fixed-size ring buffer, so memory is capacity * dim bytes (int8) no matter
+    how much traffic is seen. Entries older than ttl_seconds are evicted from
+    the tail of the ring; when full, new entries overwrite the oldest.
+    Insertion times are time.monotonic() seconds (the `now` arguments too),
+    so a wall-clock step cannot break their order along the ring.
+
+    Search is exact cosine similarity with blocked matmuls over the stored
+    vectors, or, with lsh_tables > 0, random-hyperplane LSH candidate lookup
+    followed by exact re-ranking of the candidates only.
+
+    Exact search dequantizes and scans every stored vector on each query,
+    so its cost grows with capacity: at 200k int8 vectors a single query
+    took ~180 ms (~9 ms per query in batches of 32), and ~65 ms per
+    batched query at 1M. It is meant for small indexes and offline
+    scoring, not the request path at those sizes. LSH answered in ~0.5 ms
+    at 200k but its buckets (Python sets) took ~270 MB on top of the 76 MB
+    of vectors. config.json ships the index disabled (content_index.enabled)
+    and sets LSH (16 tables x 14 bits) for when it is turned on.
+    """
+    def __init__(self, dim: int = 384, capacity: int = 200_000, ttl_seconds: float = 86_400,
+                 dtype: str = 'int8', similarity_threshold: float = 0.92, block_size: int = 8_192,
+                 lsh_tables: int = 0, lsh_bits: int = 12, seed: int = 42):
+        if dtype not in ('int8', 'float16'):
+            raise ValueError(f"Unsupported index dtype '{dtype}'")
+        self.dim = dim
+        self.capacity = capacity
+        self.ttl_seconds = ttl_seconds
+        self.dtype = dtype
+        self.similarity_threshold = similarity_threshold
+        self.block_size = block_size
+        self.vectors = np.zeros((capacity, dim), dtype=np.int8 if dtype == 'int8' else np.float16)
+        self.owners = np.zeros(capacity, dtype=np.int64)
+        self.added_at = np.zeros(capacity, dtype=np.float64)
+        self._next = 0   # slot the next vector is written to
+        self._size = 0   # number of live slots, ending just before _next
+        self._lock = threading.Lock()
+        # LSH tables: per table, signature -> set of slots
+        self.lsh_tables = lsh_tables
+        if lsh_tables:
+            rng = np.random.default_rng(seed)
+            self._planes = rng.standard_normal((lsh_tables, lsh_bits, dim)).astype(np.float32)
+            self._bit_weights = (1 << np.arange(lsh_bits)).astype(np.int64)
+            self._buckets = [dict() for _ in range(lsh_tables)]
+            self._slot_sigs = np.zeros((capacity, lsh_tables), dtype=np.int64)
+
+    @classmethod
+    def from_config(cls, settings, dim: int) -> 'ContentIndex':
+        keys = ('capacity', 'ttl_seconds', 'dtype', 'similarity_threshold', 'block_size', 'lsh_tables', 'lsh_bits')
+        return cls(dim=dim, **{k: settings[k] for k in keys if k in settings})
+
+    # --- Encoding ---
+    @staticmethod
+    def _normalize(vectors) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors = vectors.reshape(-1, vectors.shape[-1])
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _quantize(self, unit: np.ndarray) -> np.ndarray:
+        if self.dtype == 'int8':
+            return np.round(unit * 127).astype(np.int8)
+        return unit.astype(np.float16)
+
+    def _dequantize(self, stored: np.ndarray) -> np.ndarray:
+        if self.dtype == 'int8':
+            return stored.astype(np.float32) * (1.0 / 127)
+        return stored.astype(np.float32)
+
+    def _signatures(self, unit: np.ndarray) -> np.ndarray:
+        # (n, tables) integer LSH signatures
+        bits = np.einsum('tbd,nd->ntb', self._planes, unit) > 0
+        return bits.astype(np.int64) @ self._bit_weights
+
+    # --- Ring buffer bookkeeping ---
+    def _oldest(self) -> int:
+        return (self._next - self._size) % self.capacity
+
+    def _live_segments(self):
+        # Live slots as at most two contiguous [start, stop) ranges, oldest first
+        start = self._oldest()
+        stop = start + self._size
+        if stop <= self.capacity:
+            return [(start, stop)] if self._size else []
+        return [(start, self.capacity), (0, stop - self.capacity)]
+
+    def _unindex(self, slots: np.ndarray) -> None:
+        if not self.lsh_tables:
+            return
+        for slot in slots:
+            for t, sig in enumerate(self._slot_sigs[slot]):
+                bucket = self._buckets[t].get(sig)
+                if bucket is not None:
+                    bucket.discard(slot)
+                    if not bucket:
+                        del self._buckets[t][sig]
+
+    def _evict_expired(self, now: float) -> None:
+        cutoff = now - self.ttl_seconds
+        oldest = self._oldest()
+        # Insertion times grow along the ring, so binary search for the first live slot
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.added_at[(oldest + mid) % self.capacity] < cutoff:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo:
+            self._unindex((oldest + np.arange(lo)) % self.capacity)
+            self._size -= lo
+
+    # --- Public API ---
+    def add(self, vectors, user_id: str, now: Optional[float] = None) -> None:
+        vectors = np.asarray(vectors)
+        if vectors.size == 0:
+            return
+        unit = self._normalize(vectors)[-self.capacity:]
+        n = len(unit)
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._evict_expired(now)
+            if self._size:
+                # Never older than the newest entry: eviction relies on the order
+                now = max(now, float(self.added_at[(self._next - 1) % self.capacity]))
+            slots = (self._next + np.arange(n)) % self.capacity
+            overwritten = max(0, self._size + n - self.capacity)
+            if overwritten:
+                self._unindex((self._oldest() + np.arange(overwritten)) % self.capacity)
+            self.vectors[slots] = self._quantize(unit)
+            self.owners[slots] = owner_code(user_id)
+            self.added_at[slots] = now
+            if self.lsh_tables:
+                sigs = self._signatures(unit)
+                self._slot_sigs[slots] = sigs
+                for slot, row in zip(slots, sigs):
+                    for t, sig in enumerate(row):
+                        self._buckets[t].setdefault(sig, set()).add(slot)
+            self._next = (self._next + n) % self.capacity
+            self._size = min(self.capacity, self._size + n)
+
+    def query(self, vectors, exclude_user: Optional[str] = None, now: Optional[float] = None) -> np.ndarray:
+        """
+        For each query vector, the number of distinct accounts (other than
+        exclude_user) with stored content at or above similarity_threshold.
+        """
+        vectors = np.asarray(vectors)
+        if vectors.size == 0:
+            return np.zeros(0, dtype=np.int64)
+        unit = self._normalize(vectors)
+        exclude = owner_code(exclude_user) if exclude_user is not None else None
+        matches = [[] for _ in range(len(unit))]
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._evict_expired(now)
+            if self.lsh_tables:
+                self._query_lsh(unit, matches)
+            else:
+                self._query_exact(unit, matches)
+        counts = np.zeros(len(unit), dtype=np.int64)
+        for i, owners in enumerate(matches):
+            if owners:
+                owners = np.unique(np.concatenate(owners))
+                if exclude is not None:
+                    owners = owners[owners != exclude]
+                counts[i] = len(owners)
+        return counts
+
+    def _query_exact(self, unit: np.ndarray, matches) -> None:
+        for start, stop in self._live_segments():
+            for block_start in range(start, stop, self.block_size):
+                block_stop = min(stop, block_start + self.block_size)
+                sims = unit @ self._dequantize(self.vectors[block_start:block_stop]).T
+                rows, cols = np.nonzero(sims >= self.similarity_threshold)
+                for row in np.unique(rows):
+                    matches[row].append(self.owners[block_start + cols[rows == row]])
+
+    def _query_lsh(self, unit: np.ndarray, matches) -> None:
+        sigs = self._signatures(unit)
+        for row, row_sigs in enumerate(sigs):
+            candidates = set()
+            for t, sig in enumerate(row_sigs):
+                candidates.update(self._buckets[t].get(sig, ()))
+            if not candidates:
+                continue
+            slots = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+            sims = self._dequantize(self.vectors[slots]) @ unit[row]
+            hit = slots[sims >= self.similarity_threshold]
+            if hit.size:
+                matches[row].append(self.owners[hit])
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def nbytes(self) -> int:
+        return self.vectors.nbytes + self.owners.nbytes + self.added_at.nbytes
@@ -1,4 +1,4 @@
-import React, { useState } from 'react';
+import React, { useState, useRef } from 'react';
 import {
   Box,
   Card,
@@ -72,6 +72,8 @@ function AnalysisTool() {
   const [loading, setLoading] = useState(false);
   const [result, setResult] = useState(null);
   const [error, setError] = useState('');
+  // Last request body and its ETag, so an unchanged resubmit can be answered with 304
+  const lastAnalysis = useRef({ body: null, etag: null });
 
   const COLORS = ['#0088FE', '#00C49F', '#FFBB28', '#FF8042'];
 
@@ -169,22 +171,31 @@ function AnalysisTool() {
     setLoading(true);
     setError('');
     try {
+      const body = JSON.stringify({
+        user_id: userInfo.user_id,
+        karma_log: activities
+      });
+      const headers = {
+        'Content-Type': 'application/json',
+      };
+      if (result && lastAnalysis.current.etag && lastAnalysis.current.body === body) {
+        headers['If-None-Match'] = lastAnalysis.current.etag;
+      }
       const response = await fetch(`${apiUrl}/api/analyze`, {
         method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-          user_id: userInfo.user_id,
-          karma_log: activities
-        }),
+        headers,
+        body,
       });
 
+      if (response.status === 304) {
+        return;  // unchanged, keep showing the current result
+      }
       if (!response.ok) {
         throw new Error(`HTTP error! status: ${response.status}`);
       }
 
       const data = await response.json();
+      lastAnalysis.current = { body, etag: response.headers.get('ETag') };
       setResult(data);
     } catch (err) {
       setError(err.message);